@@ -29,3 +29,13 @@ class ImageReport:
     status: TStatus
     error_message: str
     error_context: str
+
+
+@dataclass(frozen=True, slots=True)
+class VisionReport:
+    status: TStatus
+    full_matching_images: str
+    partial_matching_images: str
+    pages_with_matching_images: str
+    error_message: str
+    error_context: str
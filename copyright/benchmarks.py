@@ -0,0 +1,538 @@
+import csv
+import json
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from itertools import batched
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+import numpy.typing as npt
+import piexif
+from PIL import Image
+
+from check_image_metadata import check_exif_copyright
+from image_hashing import (
+    COMPOSITE_HASH_LENGTH,
+    HASH_FUNCTIONS,
+    PackedCompositeHash,
+    PackedKnownImage,
+    TCompositeHash,
+    build_known_hash_catalogue,
+    catalogue_top_k_matches,
+    compute_composite_hash,
+    hash_difference,
+    unpack_hash,
+)
+from image_metadata_io import (
+    COPYRIGHTED_IMAGE_FIELDS,
+    HASHES_SEPARATOR,
+    IMAGE_COMPARED_FIELDS,
+    VALIDATION_BATCH_SIZE,
+    parse_copyrighted_image,
+    parse_image_metadata,
+    read_image_metadata,
+    read_known_copyrighted_images,
+    validate_copyrighted_images,
+    validate_image_metadata,
+)
+
+###
+# Synthetic corpora
+###
+
+
+def _synthetic_pixels(rng: np.random.Generator, width: int, height: int) -> npt.NDArray[np.uint8]:
+    """
+    Smooth gradients plus a few blocks and some noise, so that images compress and hash like photographs
+    rather than like white noise.
+    """
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    channels = []
+    for _ in range(3):
+        fx, fy, phase = rng.uniform(0.5, 4.0), rng.uniform(0.5, 4.0), rng.uniform(0, 2 * np.pi)
+        channels.append(127 + 100 * np.sin(fx * 2 * np.pi * x / width + fy * 2 * np.pi * y / height + phase))
+    pixels = np.stack(channels, axis=-1)
+
+    for _ in range(5):
+        x0, y0 = rng.integers(0, width), rng.integers(0, height)
+        pixels[y0 : y0 + height // 5, x0 : x0 + width // 5] = rng.integers(0, 256, size=3)
+
+    pixels += rng.normal(0, 8, size=pixels.shape)
+
+    result: npt.NDArray[np.uint8] = np.clip(pixels, 0, 255).astype(np.uint8)
+
+    return result
+
+
+def generate_synthetic_images(
+    directory: str,
+    count: int,
+    width: int,
+    height: int,
+    extension: str = ".jpg",
+    seed: int = 0,
+    exif_copyright: str = "",
+) -> Tuple[str, ...]:
+    rng = np.random.default_rng(seed)
+    exif = Image.Exif()
+    if exif_copyright:
+        exif[piexif.ImageIFD.Copyright] = exif_copyright
+
+    paths = []
+    for i in range(count):
+        path = Path(directory) / f"synthetic_{seed}_{i:06d}{extension}"
+        Image.fromarray(_synthetic_pixels(rng, width, height)).save(path, quality=90, exif=exif)
+        paths.append(str(path))
+
+    return tuple(paths)
+
+
+def _bytes_read() -> int | None:
+    # Bytes read through read() syscalls by this process so far, Linux only
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    return None
+
+
+def _time_per_call[R](func: Callable[[str], R], paths: Tuple[str, ...]) -> Tuple[float, List[R]]:
+    start = time.perf_counter()
+    results = [func(path) for path in paths]
+    elapsed = time.perf_counter() - start
+
+    return elapsed / len(paths), results
+
+
+def _measure_per_call[R](func: Callable[[str], R], paths: Tuple[str, ...]) -> Tuple[float, float | None, List[R]]:
+    # Latency and bytes read per call. The /proc/self/io read itself is a constant offset, subtracted out.
+    before = _bytes_read()
+    baseline = _bytes_read()
+    elapsed, results = _time_per_call(func, paths)
+    after = _bytes_read()
+
+    if before is None or baseline is None or after is None:
+        return elapsed, None, results
+
+    probe = baseline - before
+    return elapsed, (after - baseline - probe) / len(paths), results
+
+
+###
+# Benchmarks
+###
+
+
+def _reference_composite_hash(image_path: str) -> TCompositeHash:
+    # Pre-optimization implementation: every hash function converts the full-resolution image on its own
+    with Image.open(image_path) as img:
+        return tuple(f"{f(img)}" for f in HASH_FUNCTIONS)
+
+
+def benchmark_hashing(count: int, width: int, height: int, extension: str) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        paths = generate_synthetic_images(directory, count, width, height, extension)
+
+        # Warm up, so that the lazy scipy/pywt imports of the hash functions are not billed to the first run
+        _reference_composite_hash(generate_synthetic_images(directory, 1, 64, 64, extension, seed=1)[0])
+
+        reference_time, reference_hashes = _time_per_call(_reference_composite_hash, paths)
+        exact_time, exact_hashes = _time_per_call(compute_composite_hash, paths)
+        fast_time, fast_hashes = _time_per_call(lambda path: compute_composite_hash(path, fast_decode=True), paths)
+
+    identical = exact_hashes == reference_hashes
+    fast_max_difference = max(hash_difference(ref, fast) for ref, fast in zip(reference_hashes, fast_hashes))
+
+    print(f"compute_composite_hash on {count} {width}x{height} '{extension}' images, per image:")
+    print(f"  reference:   {reference_time * 1000:8.1f} ms")
+    print(f"  exact:       {exact_time * 1000:8.1f} ms  (bit-identical: {identical})")
+    print(f"  fast_decode: {fast_time * 1000:8.1f} ms  (max averaged distance to reference: {fast_max_difference})")
+
+
+def _format_bytes(bytes_read: float | None) -> str:
+    return "n/a bytes read" if bytes_read is None else f"{bytes_read:10.0f} bytes read"
+
+
+def _reference_exif_copyright(image_path: str) -> Any:
+    # Pre-optimization implementation: open with Pillow and parse the whole EXIF block with piexif
+    with Image.open(image_path) as img:
+        exif_data = img.info.get("exif")
+        if exif_data:
+            return piexif.load(exif_data)["0th"].get(piexif.ImageIFD.Copyright)
+        return None
+
+
+def benchmark_exif(count: int, width: int, height: int) -> None:
+    print(f"check_exif_copyright on {count} {width}x{height} images per format, per image:")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for extension in (".jpg", ".png", ".webp"):
+            paths = generate_synthetic_images(
+                directory, count, width, height, extension, exif_copyright="Philosophie.ch"
+            )
+
+            reference_time, reference_bytes, _ = _measure_per_call(_reference_exif_copyright, paths)
+            header_time, header_bytes, reports = _measure_per_call(check_exif_copyright, paths)
+            found = sum(1 for report in reports if report.exif_copyright == "Philosophie.ch")
+
+            print(f"  {extension}")
+            print(f"    reference:   {reference_time * 1000:8.3f} ms  {_format_bytes(reference_bytes)}")
+            print(
+                f"    header-only: {header_time * 1000:8.3f} ms  {_format_bytes(header_bytes)}  ({found}/{count} found)"
+            )
+
+
+def _write_synthetic_csv(path: str, count: int, fieldnames: List[str]) -> None:
+    rng = np.random.default_rng(0)
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+        writer.writeheader()
+        for i in range(count):
+            parts = rng.integers(0, 1 << 63, size=COMPOSITE_HASH_LENGTH, dtype=np.int64)
+            writer.writerow(
+                {
+                    "id": f"{i}",
+                    "hash": HASHES_SEPARATOR.join(f"{part:016x}" for part in parts),
+                    "original_name": f"image_{i}.jpg",
+                    "link": f"https://example.org/images/{i}.jpg",
+                    "request": "COMPARE",
+                    "asset_path": f"images/{i}.jpg",
+                }
+            )
+
+
+def _rows_per_second(func: Callable[[], object], count: int) -> float:
+    start = time.perf_counter()
+    func()
+    return count / (time.perf_counter() - start)
+
+
+def benchmark_validation(count: int) -> None:
+    print(f"Validating {count} CSV rows, rows per second:")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, fieldnames, parse, validate_batch, read in (
+            (
+                "CopyrightedImage",
+                COPYRIGHTED_IMAGE_FIELDS,
+                parse_copyrighted_image,
+                validate_copyrighted_images,
+                read_known_copyrighted_images,
+            ),
+            (
+                "ImageCompared",
+                IMAGE_COMPARED_FIELDS,
+                parse_image_metadata,
+                validate_image_metadata,
+                read_image_metadata,
+            ),
+        ):
+            path = str(Path(directory) / f"{name}.csv")
+            _write_synthetic_csv(path, count, fieldnames)
+            with open(path, newline="") as f:
+                rows = list(csv.DictReader(f))
+            batches = list(batched(rows, VALIDATION_BATCH_SIZE))
+
+            # Pre-optimization path: one `model_validate` per row
+            reference_rate = _rows_per_second(lambda: [parse(row) for row in rows], count)
+            batched_rate = _rows_per_second(lambda: [validate_batch(list(batch)) for batch in batches], count)
+            reader_rate = _rows_per_second(lambda: sum(1 for _ in read(path)[0]), count)
+
+            print(f"  {name}")
+            print(f"    per-row model_validate: {reference_rate:12,.0f}")
+            print(f"    batched:                {batched_rate:12,.0f}  ({batched_rate / reference_rate:.1f}x)")
+            print(f"    full reader, from disk: {reader_rate:12,.0f}")
+
+
+###
+# Suite
+###
+
+SUITE_FORMAT_VERSION = 1
+
+SUITE_FORMATS = (".jpg", ".png", ".webp")
+
+SUITE_TOP_K = 10
+
+
+@dataclass(frozen=True, slots=True)
+class SuiteCorpus:
+    images: Dict[str, Tuple[str, ...]]  # extension -> image paths
+    known_images_csv: str
+    image_metadata_csv: str
+    csv_rows: int
+    pairs: int
+    queries: int
+
+
+class StageResult(NamedTuple):
+    stage: str
+    format: str
+    items: int
+    seconds: float
+    items_per_second: float
+    peak_rss_bytes: int
+
+
+def _random_packed_hashes(count: int, seed: int) -> List[PackedCompositeHash]:
+    rng = np.random.default_rng(seed)
+    parts = rng.integers(0, 1 << 63, size=(count, COMPOSITE_HASH_LENGTH), dtype=np.int64).tolist()
+    return [PackedCompositeHash(parts=tuple(p)) for p in parts]
+
+
+def _time_stage[T](items: Sequence[T] | Iterable[T], func: Callable[[T], object]) -> Tuple[int, float]:
+    # The first call of a fresh process pays for lazy imports and library initialization, keep it out of the timing
+    if isinstance(items, Sequence) and items:
+        func(items[0])
+
+    count = 0
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+        count += 1
+    return count, time.perf_counter() - start
+
+
+def _stage_hashing(corpus: SuiteCorpus, extension: str) -> Tuple[int, float]:
+    return _time_stage(corpus.images[extension], compute_composite_hash)
+
+
+def _stage_hashing_fast_decode(corpus: SuiteCorpus, extension: str) -> Tuple[int, float]:
+    return _time_stage(corpus.images[extension], lambda path: compute_composite_hash(path, fast_decode=True))
+
+
+def _stage_exif(corpus: SuiteCorpus, extension: str) -> Tuple[int, float]:
+    return _time_stage(corpus.images[extension], check_exif_copyright)
+
+
+def _stage_hash_difference(corpus: SuiteCorpus, extension: str) -> Tuple[int, float]:
+    hashes = [unpack_hash(h) for h in _random_packed_hashes(corpus.pairs + 1, seed=0)]
+    return _time_stage(zip(hashes, hashes[1:]), lambda pair: hash_difference(*pair))
+
+
+def _stage_top_k(corpus: SuiteCorpus, extension: str) -> Tuple[int, float]:
+    catalogue = build_known_hash_catalogue(
+        PackedKnownImage(id=f"{i}", hash=h) for i, h in enumerate(_random_packed_hashes(corpus.csv_rows, seed=0))
+    )
+    queries = _random_packed_hashes(corpus.queries, seed=1)
+    return _time_stage(queries, lambda query: catalogue_top_k_matches(query, catalogue, SUITE_TOP_K, 5, 10))
+
+
+def _stage_read_known_images(corpus: SuiteCorpus, extension: str) -> Tuple[int, float]:
+    return _time_stage(read_known_copyrighted_images(corpus.known_images_csv)[0], lambda _: None)
+
+
+def _stage_read_image_metadata(corpus: SuiteCorpus, extension: str) -> Tuple[int, float]:
+    return _time_stage(read_image_metadata(corpus.image_metadata_csv)[0], lambda _: None)
+
+
+# Stage name -> (measurement, whether it runs once per image format)
+SUITE_STAGES: Dict[str, Tuple[Callable[[SuiteCorpus, str], Tuple[int, float]], bool]] = {
+    "compute_composite_hash": (_stage_hashing, True),
+    "compute_composite_hash[fast_decode]": (_stage_hashing_fast_decode, True),
+    "check_exif_copyright": (_stage_exif, True),
+    "hash_difference": (_stage_hash_difference, False),
+    "catalogue_top_k_matches": (_stage_top_k, False),
+    "read_known_copyrighted_images": (_stage_read_known_images, False),
+    "read_image_metadata": (_stage_read_image_metadata, False),
+}
+
+
+def _run_stage(stage: str, corpus: SuiteCorpus, extension: str) -> StageResult:
+    # Runs in a fresh process, so that the peak RSS is the one of this stage alone
+    measure, _ = SUITE_STAGES[stage]
+    items, seconds = measure(corpus, extension)
+
+    return StageResult(
+        stage=stage,
+        format=extension,
+        items=items,
+        seconds=seconds,
+        items_per_second=items / seconds if seconds > 0 else 0.0,
+        peak_rss_bytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    )
+
+
+def run_suite(
+    count: int, width: int, height: int, csv_rows: int, pairs: int, queries: int, stages: Sequence[str]
+) -> Dict[str, Any]:
+    """
+    Generate synthetic corpora and measure the throughput and peak RSS of every stage of the pipeline.
+
+    Each stage runs in its own freshly spawned process, so that neither memory nor warm caches carry over from one
+    stage to the next. Peak RSS includes the interpreter and imported libraries, which is what a job would use.
+
+    :return: JSON-serializable report.
+    """
+    report: Dict[str, Any] = {
+        "format_version": SUITE_FORMAT_VERSION,
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "count": count,
+            "width": width,
+            "height": height,
+            "csv_rows": csv_rows,
+            "pairs": pairs,
+            "queries": queries,
+        },
+        "stages": [],
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        corpus = SuiteCorpus(
+            images={
+                extension: generate_synthetic_images(
+                    directory, count, width, height, extension, exif_copyright="Philosophie.ch"
+                )
+                for extension in SUITE_FORMATS
+            },
+            known_images_csv=str(Path(directory) / "known_images.csv"),
+            image_metadata_csv=str(Path(directory) / "image_metadata.csv"),
+            csv_rows=csv_rows,
+            pairs=pairs,
+            queries=queries,
+        )
+        _write_synthetic_csv(corpus.known_images_csv, csv_rows, COPYRIGHTED_IMAGE_FIELDS)
+        _write_synthetic_csv(corpus.image_metadata_csv, csv_rows, IMAGE_COMPARED_FIELDS)
+
+        for stage in stages:
+            _, per_format = SUITE_STAGES[stage]
+            for extension in SUITE_FORMATS if per_format else ("",):
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                    result = executor.submit(_run_stage, stage, corpus, extension).result()
+
+                print(
+                    f"{result.stage:<38} {result.format:<6} {result.items_per_second:14,.1f} items/s  "
+                    f"{result.peak_rss_bytes / 2**20:8.1f} MiB peak RSS",
+                    file=sys.stderr,
+                )
+                report["stages"].append(result._asdict())
+
+    return report
+
+
+def compare_reports(baseline_file: str, current_file: str, tolerance: float) -> bool:
+    """
+    Print the change in throughput and peak RSS of every stage between two suite reports.
+
+    :return: Whether no stage lost more than `tolerance` of its throughput, or grew its peak RSS by more than that.
+    """
+    with open(baseline_file) as f:
+        baseline = {(s["stage"], s["format"]): s for s in json.load(f)["stages"]}
+    with open(current_file) as f:
+        current = {(s["stage"], s["format"]): s for s in json.load(f)["stages"]}
+
+    ok = True
+    for key in sorted(baseline.keys() & current.keys()):
+        before, after = baseline[key], current[key]
+        speed = after["items_per_second"] / before["items_per_second"] if before["items_per_second"] else 1.0
+        memory = after["peak_rss_bytes"] / before["peak_rss_bytes"] if before["peak_rss_bytes"] else 1.0
+        regression = speed < 1 - tolerance or memory > 1 + tolerance
+        ok = ok and not regression
+
+        stage, extension = key
+        print(
+            f"{stage:<38} {extension:<6} throughput {speed:6.2f}x  peak RSS {memory:6.2f}x"
+            f"{'  REGRESSION' if regression else ''}"
+        )
+
+    for stage, extension in sorted(baseline.keys() ^ current.keys()):
+        print(f"{stage:<38} {extension:<6} only in one of the reports")
+
+    return ok
+
+
+def cli() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the copyright pipeline on synthetic images and CSV files.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    hashing = subparsers.add_parser("hashing", help="Benchmark compute_composite_hash against the reference.")
+    hashing.add_argument("-n", "--count", type=int, default=10, help="Number of images to generate.")
+    hashing.add_argument("--width", type=int, default=4000, help="Width of the generated images.")
+    hashing.add_argument("--height", type=int, default=3000, help="Height of the generated images.")
+    hashing.add_argument(
+        "-e", "--extension", type=str, default=".jpg", help="Format of the generated images, e.g. '.jpg', '.png'."
+    )
+
+    exif = subparsers.add_parser("exif", help="Benchmark check_exif_copyright against the reference.")
+    exif.add_argument("-n", "--count", type=int, default=50, help="Number of images to generate per format.")
+    exif.add_argument("--width", type=int, default=2000, help="Width of the generated images.")
+    exif.add_argument("--height", type=int, default=1500, help="Height of the generated images.")
+
+    validation = subparsers.add_parser("validation", help="Benchmark the bulk validation of CSV rows.")
+    validation.add_argument("-n", "--count", type=int, default=200_000, help="Number of rows to generate.")
+
+    suite = subparsers.add_parser(
+        "suite", help="Measure the throughput and peak RSS of every stage of the pipeline, as JSON."
+    )
+    suite.add_argument("-n", "--count", type=int, default=20, help="Number of images to generate per format.")
+    suite.add_argument("--width", type=int, default=2000, help="Width of the generated images.")
+    suite.add_argument("--height", type=int, default=1500, help="Height of the generated images.")
+    suite.add_argument(
+        "--csv_rows", type=int, default=100_000, help="Number of rows of the CSV files, and of the known catalogue."
+    )
+    suite.add_argument("--pairs", type=int, default=200_000, help="Number of hash pairs compared one by one.")
+    suite.add_argument("--queries", type=int, default=100, help="Number of hashes looked up in the catalogue.")
+    suite.add_argument(
+        "--stages",
+        type=str,
+        nargs="+",
+        choices=list(SUITE_STAGES),
+        default=list(SUITE_STAGES),
+        help="Stages to run. Defaults to all of them.",
+    )
+    suite.add_argument(
+        "-o", "--output_file", type=str, default="", help="Path to the JSON report. Defaults to standard output."
+    )
+
+    compare = subparsers.add_parser("compare", help="Compare two suite reports, e.g. of two versions.")
+    compare.add_argument("baseline", type=str, help="Path to the baseline JSON report.")
+    compare.add_argument("current", type=str, help="Path to the JSON report to check against the baseline.")
+    compare.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Relative loss of throughput, or growth of peak RSS, reported as a regression.",
+    )
+
+    args = parser.parse_args()
+
+    match args.benchmark:
+        case "hashing":
+            benchmark_hashing(args.count, args.width, args.height, args.extension)
+        case "exif":
+            benchmark_exif(args.count, args.width, args.height)
+        case "validation":
+            benchmark_validation(args.count)
+        case "suite":
+            report = run_suite(
+                args.count, args.width, args.height, args.csv_rows, args.pairs, args.queries, args.stages
+            )
+            if args.output_file:
+                with open(args.output_file, "w") as f:
+                    json.dump(report, f, indent=2)
+            else:
+                json.dump(report, sys.stdout, indent=2)
+        case "compare":
+            if not compare_reports(args.baseline, args.current, args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
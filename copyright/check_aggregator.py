@@ -1,51 +1,290 @@
 import csv
+from concurrent.futures import ThreadPoolExecutor, wait
 from dataclasses import asdict
 import traceback
-from typing import Iterable, Tuple
-from base_types import ImageReport
+from typing import Dict, Iterable, Iterator, List, Literal, Protocol, Sequence, Tuple
+from base_types import ExifReport, VisionReport
 from pathlib import Path
 from aletk.utils import get_logger
 from aletk.ResultMonad import main_try_except_wrapper, Ok, Err
-from check_image_metadata import check_exif_copyright
+from check_google_vision import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_MAX_RESULTS,
+    DEFAULT_MAX_RETRIES,
+    DEFAULT_REQUESTS_PER_SECOND,
+    DEFAULT_VISION_CACHE_FILE,
+    MAX_IMAGES_PER_REQUEST,
+    VISION_ENDPOINT,
+    VisionBatcher,
+    add_vision_arguments,
+    vision_credentials,
+)
+from check_image_metadata import check_exif_copyright_file
+from hash_index import BKTree, indexed_top_k_matches
+from image_cache import FileFingerprint, ImageCache, add_cache_arguments, open_image_cache
+from image_decoding import (
+    DEFAULT_DECODE_POLICY,
+    DEFAULT_MAX_PIXELS,
+    DecodePolicy,
+    ImageHandle,
+    TOversizePolicy,
+    add_decode_arguments,
+)
+from image_hashing import (
+    TAlgorithmThresholds,
+    TCompositeHash,
+    handle_composite_hash,
+    parse_algorithm_thresholds,
+    serialize_hash,
+    serialize_hash_matches,
+)
+from image_job_runner import (
+    DEFAULT_IDENTITY_THRESHOLD,
+    DEFAULT_SIMILARITY_THRESHOLD,
+    DEFAULT_TOP_K,
+    load_known_images_index,
+)
+from job_metrics import add_metrics_arguments, count_status, open_metrics, stage_timer
+from parallel import bounded_map
 
 lgr = get_logger(__name__)
 
 
-def multi_check(image_path: str) -> ImageReport:
+###
+# Checks
+###
+
+type TCheckName = Literal["exif", "hash", "vision"]
+
+CHECK_NAMES: Tuple[TCheckName, ...] = ("exif", "hash", "vision")
+
+# Fields framing the signals of the checks in every row
+ROW_PREFIX_FIELDS = ["image_name", "image_path"]
+ROW_SUFFIX_FIELDS = ["status", "error_message", "error_context"]
+
+
+class ImageCheck(Protocol):
+    """
+    One signal of the aggregate report: a check run on an image shared with the other checks, concurrently with
+    them, and returning the values of its `fields`. Checks report their own failures in their fields; an exception
+    only reaches the row status.
+    """
+
+    @property
+    def fields(self) -> Sequence[str]: ...
+
+    @property
+    def needs_contents(self) -> bool:
+        """
+        Whether the check reads the whole file, which is then read once, up front, for all checks.
+        """
+        ...
+
+    def run(self, handle: ImageHandle) -> Dict[str, str]: ...
+
+
+def cached_fingerprint(handle: ImageHandle, cache: ImageCache) -> FileFingerprint:
+    """
+    Fingerprint of the image in the image cache, computed once per handle.
+    """
+    return handle.memo("fingerprint", lambda: cache.fingerprint(handle.image_path, handle.file))
+
+
+def cached_composite_hash(handle: ImageHandle, cache: ImageCache | None, policy: DecodePolicy) -> TCompositeHash:
+    """
+    Composite hash of the image, served from the image cache if set, and computed once per handle otherwise, so
+    that the checks needing it share a single decode.
+    """
+    if cache is None:
+        return handle_composite_hash(handle, policy=policy)
+
+    def compute() -> TCompositeHash:
+        fp = cached_fingerprint(handle, cache)
+        hash = cache.get_hash(fp, policy=policy)
+        if hash is None:
+            hash = handle_composite_hash(handle, policy=policy)
+            cache.put_hash(fp, hash, policy=policy, downsampled=handle.downsampled(policy=policy))
+        return hash
+
+    return handle.memo("cached_composite_hash", compute)
+
+
+class ExifCheck:
+    """
+    EXIF Copyright tag of the image, with the fields of `ImageReport`.
+    """
+
+    fields = ["exif_status", "exif_copyright", "exif_error_message", "exif_error_context"]
+    needs_contents = False
+
+    def __init__(self, cache: ImageCache | None) -> None:
+        self.cache = cache
+
+    def run(self, handle: ImageHandle) -> Dict[str, str]:
+        with stage_timer("exif"):
+            exif_report = self._exif_copyright(handle)
+
+        return {
+            "exif_status": exif_report.status,
+            "exif_copyright": exif_report.exif_copyright,
+            "exif_error_message": exif_report.error_message,
+            "exif_error_context": exif_report.error_context,
+        }
+
+    def _exif_copyright(self, handle: ImageHandle) -> ExifReport:
+        if self.cache is None:
+            return check_exif_copyright_file(handle.stream(), handle.image_path)
+
+        fp = cached_fingerprint(handle, self.cache)
+        cached = self.cache.get_exif(fp)
+        if cached is not None:
+            return cached
+
+        exif_report = check_exif_copyright_file(handle.stream(), handle.image_path)
+        self.cache.put_exif(fp, exif_report)
+
+        return exif_report
+
+
+class HashCheck:
+    """
+    Composite hash of the image and, given the index of the known images, the closest of them, as in the 'COMPARE'
+    requests of `image_job_runner`.
+    """
+
+    fields = ["hash", "hash_matches", "hash_status", "hash_error_message"]
+    needs_contents = True
+
+    def __init__(
+        self,
+        index: BKTree | None,
+        cache: ImageCache | None,
+        top_k: int = DEFAULT_TOP_K,
+        identity_threshold: int = DEFAULT_IDENTITY_THRESHOLD,
+        similarity_threshold: int = DEFAULT_SIMILARITY_THRESHOLD,
+        algorithm_thresholds: TAlgorithmThresholds | None = None,
+        policy: DecodePolicy = DEFAULT_DECODE_POLICY,
+    ) -> None:
+        self.index = index
+        self.cache = cache
+        self.top_k = top_k
+        self.identity_threshold = identity_threshold
+        self.similarity_threshold = similarity_threshold
+        self.algorithm_thresholds = algorithm_thresholds
+        self.policy = policy
+
+    def run(self, handle: ImageHandle) -> Dict[str, str]:
+        try:
+            hash = cached_composite_hash(handle, self.cache, self.policy)
+        except Exception as e:
+            return {
+                "hash": "",
+                "hash_matches": "",
+                "hash_status": "error",
+                "hash_error_message": f"Error hashing image '{handle.image_path}': {e.__class__.__name__}: {e}",
+            }
+
+        if self.index is None:
+            return {"hash": serialize_hash(hash), "hash_matches": "", "hash_status": "ok", "hash_error_message": ""}
+
+        with stage_timer("compare"):
+            matches = indexed_top_k_matches(
+                hash,
+                self.index,
+                self.top_k,
+                self.identity_threshold,
+                self.similarity_threshold,
+                self.algorithm_thresholds,
+            )
+
+        return {
+            "hash": serialize_hash(hash),
+            "hash_matches": serialize_hash_matches(matches),
+            "hash_status": "ok" if matches else "not_found",
+            "hash_error_message": "" if matches else "No identical or similar known image found.",
+        }
+
+
+class VisionCheck:
+    """
+    Copies of the image on the web, found by Google Vision web detection, with the fields of `VisionReport`.
+    Requests are batched across the images checked concurrently, and deduplicated by composite hash.
+    """
+
+    fields = [f"vision_{field}" for field in VisionReport.__annotations__]
+    needs_contents = True
+
+    def __init__(self, batcher: VisionBatcher, cache: ImageCache | None, policy: DecodePolicy) -> None:
+        self.batcher = batcher
+        self.cache = cache
+        self.policy = policy
+
+    def run(self, handle: ImageHandle) -> Dict[str, str]:
+        try:
+            hash = serialize_hash(cached_composite_hash(handle, self.cache, self.policy))
+            report = self.batcher.web_detection(hash, handle.contents())
+        except Exception as e:
+            report = VisionReport(
+                status="error",
+                full_matching_images="",
+                partial_matching_images="",
+                pages_with_matching_images="",
+                error_message=f"{e.__class__.__name__}: {e}",
+                error_context=f"Error hashing image: '{handle.image_path}'",
+            )
+
+        return {f"vision_{field}": f"{value}" for field, value in asdict(report).items()}
+
+
+def report_fields(checks: Sequence[ImageCheck]) -> List[str]:
+    return ROW_PREFIX_FIELDS + [field for check in checks for field in check.fields] + ROW_SUFFIX_FIELDS
+
+
+###
+# Aggregation
+###
+
+
+def multi_check(
+    image_path: str, checks: Sequence[ImageCheck], executor: ThreadPoolExecutor | None = None
+) -> Dict[str, str]:
+    """
+    Run every check on an image opened once for all of them, concurrently on `executor` if set, and merge their
+    signals into one row, in the order of `report_fields`. A missing image, or a check raising, gives an error row,
+    with the signals of the checks before it.
+    """
+
+    row = {field: "" for field in report_fields(checks)}
+    row["image_path"] = str(image_path)
 
     try:
 
-        image_name = Path(image_path).name
-        image_path_abs = Path(image_path).absolute()
-        if not image_path_abs.is_file():
-            raise FileNotFoundError(f"The file {image_path} does not exist.")
-
-        exif_report = check_exif_copyright(image_path)
-
-        return ImageReport(
-            image_name=image_name,
-            image_path=str(image_path),
-            exif_copyright=exif_report.exif_copyright,
-            exif_status=exif_report.status,
-            exif_error_message=exif_report.error_message,
-            exif_error_context=exif_report.error_context,
-            status="ok",
-            error_message="",
-            error_context="",
-        )
+        # Unbuffered, as the EXIF check only reads small header fragments, unless a check reads the whole file
+        with stage_timer("open"):
+            handle = ImageHandle(image_path, read_contents=any(check.needs_contents for check in checks))
+
+        with handle:
+            if executor is None or len(checks) == 1:
+                for check in checks:
+                    row.update(check.run(handle))
+            else:
+                futures = [executor.submit(check.run, handle) for check in checks]
+                # All checks are done with the handle before it is closed, even if one of them raised
+                wait(futures)
+                for future in futures:
+                    row.update(future.result())
+
+        row.update(image_name=Path(image_path).name, status="ok")
 
     except Exception as e:
-        return ImageReport(
-            image_name="",
-            image_path=image_path,
-            exif_copyright="",
-            exif_status="",
-            exif_error_message="",
+        row.update(
             status="error",
             error_message=str(e),
             error_context=f"Error processing image: '{image_path}'. Traceback: {traceback.format_exc()}",
         )
 
+    return row
+
 
 def read_image_paths_from_file(file_path: str) -> Tuple[str, ...]:
     """
@@ -61,20 +300,56 @@ def read_image_paths_from_file(file_path: str) -> Tuple[str, ...]:
         return ()
 
 
-def write_image_reports_to_csv(image_reports: Iterable[ImageReport], output_file: str) -> None:
+def check_images(
+    image_paths: Iterable[str], checks: Sequence[ImageCheck], workers: int, ordered: bool
+) -> Iterator[Dict[str, str]]:
     """
-    Write image reports to a CSV file, using .asdict() and write DictWriter.
+    Run `multi_check` over the images, on a pool of `workers` threads when there is more than one, the checks of
+    each image running concurrently on a pool of their own.
+
+    The checks are I/O bound, so threads overlap the file system latency. At most four images per worker are in
+    flight, so reports can be streamed out in bounded memory, in input order if `ordered`, else in completion order.
     """
-    if not image_reports:
-        raise ValueError("No image reports to write.")
+    # Separate from the image pool, whose threads wait for the checks of their image
+    check_executor = ThreadPoolExecutor(max_workers=max(workers, 1) * len(checks)) if len(checks) > 1 else None
+
+    try:
+        if workers <= 1:
+            yield from (multi_check(image_path, checks, check_executor) for image_path in image_paths)
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            yield from bounded_map(
+                executor,
+                lambda image_path: multi_check(image_path, checks, check_executor),
+                image_paths,
+                4 * workers,
+                ordered,
+            )
+
+    finally:
+        if check_executor is not None:
+            check_executor.shutdown()
+
+
+def write_image_reports_to_csv(
+    image_reports: Iterable[Dict[str, str]], fieldnames: Sequence[str], output_file: str
+) -> None:
+    """
+    Write image reports to a CSV file, one row at a time, as they come.
+    """
+    status_fields = [field for field in fieldnames if field.endswith("_status")]
 
     with open(output_file, "w", newline="") as csvfile:
-        fieldnames = list(ImageReport.__annotations__.keys())
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writeheader()
 
         for report in image_reports:
-            writer.writerow(asdict(report))
+            with stage_timer("csv_write"):
+                writer.writerow(report)
+            count_status(report["status"])
+            for field in status_fields:
+                count_status(report[field], field=field)
 
     lgr.info(f"Image reports written to {output_file}")
 
@@ -83,18 +358,109 @@ def write_image_reports_to_csv(image_reports: Iterable[ImageReport], output_file
 def main(
     input_file: str,
     output_file: str,
+    cache_file: str,
+    no_cache: bool,
+    rebuild_cache: bool,
+    cache_digest: bool,
+    cache_max_entries: int,
+    workers: int,
+    ordered: bool,
+    metrics_textfile: str = "",
+    metrics_port: int = 0,
+    metrics_address: str = "127.0.0.1",
+    checks: Sequence[TCheckName] = ("exif",),
+    known_images_file: str = "",
+    index_file: str = "",
+    top_k: int = DEFAULT_TOP_K,
+    identity_threshold: int = DEFAULT_IDENTITY_THRESHOLD,
+    similarity_threshold: int = DEFAULT_SIMILARITY_THRESHOLD,
+    algorithm_thresholds: TAlgorithmThresholds | None = None,
+    max_pixels: int = DEFAULT_MAX_PIXELS,
+    oversize: TOversizePolicy = "downsample",
+    endpoint: str = VISION_ENDPOINT,
+    api_key: str = "",
+    json_key_filepath: str = "",
+    no_auth: bool = False,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    max_results: int = DEFAULT_MAX_RESULTS,
+    vision_cache_file: str = DEFAULT_VISION_CACHE_FILE,
+    no_vision_cache: bool = False,
 ) -> None:
     """
-    Main function to read image paths from a file, check each image for copyright information, and write the reports to a CSV file.
+    Main function to read image paths from a file, run the requested checks on each image, and write one row per
+    image with all their signals to a CSV file.
+
+    Each image is opened once for all its checks, which run concurrently: 'exif' reads the EXIF Copyright tag, 'hash'
+    computes the composite hash and, given the known images, finds the closest ones, and 'vision' looks for copies on
+    the web with Google Vision. The image is decoded and hashed only once for 'hash' and 'vision', within the pixel
+    limit set by `max_pixels` and `oversize`.
+    EXIF reports and hashes of unchanged images are served from the image cache unless `no_cache` is set, and web
+    detection results from the Vision cache unless `no_vision_cache` is set.
+    With more than one worker, images are checked concurrently and, unless `ordered`, written in completion order.
+    Stage durations and report statuses are exported as Prometheus metrics if `metrics_textfile` or `metrics_port`
+    is set.
     """
     lgr.info(f"Reading image paths from '{input_file}'")
     image_paths = read_image_paths_from_file(input_file)
 
-    lgr.info(f"Checking {len(image_paths)} images for copyright information and writing to '{output_file}'...")
-    image_reports = (multi_check(image_path) for image_path in image_paths)
+    policy = DecodePolicy(max_pixels=max_pixels, oversize=oversize)
+    index = (
+        load_known_images_index(known_images_file, index_file)
+        if "hash" in checks and (known_images_file or index_file)
+        else None
+    )
+
+    cache = open_image_cache(cache_file, no_cache, rebuild_cache, cache_digest, cache_max_entries)
+    batcher = None
+    metrics = None
+
+    try:
+        image_checks: List[ImageCheck] = []
+        for name in CHECK_NAMES:
+            if name not in checks:
+                continue
+
+            match name:
+                case "exif":
+                    image_checks.append(ExifCheck(cache))
+                case "hash":
+                    image_checks.append(
+                        HashCheck(
+                            index, cache, top_k, identity_threshold, similarity_threshold, algorithm_thresholds, policy
+                        )
+                    )
+                case "vision":
+                    batcher = VisionBatcher(
+                        endpoint,
+                        api_key,
+                        vision_credentials(api_key, json_key_filepath, no_auth),
+                        concurrency,
+                        requests_per_second,
+                        max_retries,
+                        max_results,
+                        "" if no_vision_cache else vision_cache_file,
+                    )
+                    image_checks.append(VisionCheck(batcher, cache, policy))
 
-    # Stream the reports to CSV, line by line directly
-    write_image_reports_to_csv(image_reports, output_file)
+        metrics = open_metrics("check_aggregator", metrics_textfile, metrics_port, metrics_address)
+
+        lgr.info(
+            f"Running the {', '.join(checks)} checks on {len(image_paths)} images and writing to '{output_file}'..."
+        )
+        image_reports = check_images(image_paths, image_checks, workers, ordered)
+
+        # Stream the reports to CSV, line by line directly
+        write_image_reports_to_csv(image_reports, report_fields(image_checks), output_file)
+
+    finally:
+        if batcher is not None:
+            batcher.close()
+        if cache is not None:
+            cache.close()
+        if metrics is not None:
+            metrics.close()
 
     lgr.info(f"All image reports written to '{output_file}'")
 
@@ -122,11 +488,117 @@ def cli() -> None:
         help="Path to the output CSV file.",
     )
 
+    parser.add_argument(
+        "--checks",
+        type=str,
+        nargs="+",
+        choices=CHECK_NAMES,
+        default=["exif"],
+        help="Checks to run on each image, concurrently, their signals written in one row: 'exif' for the EXIF "
+        "Copyright tag, 'hash' for the composite hash and the closest known images, see --known_images, 'vision' for "
+        "copies on the web, see the Vision options.",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads checking images concurrently. Worth raising on network file systems, and with "
+        f"'vision', as only images checked concurrently share requests, of up to {MAX_IMAGES_PER_REQUEST} images.",
+    )
+
+    parser.add_argument(
+        "--ordered",
+        action="store_true",
+        help="With several workers, write the reports in input order instead of completion order.",
+    )
+
+    parser.add_argument(
+        "-k",
+        "--known_images",
+        type=str,
+        default="",
+        help="Path to the known copyrighted images, as a '.csv' or '.chash' catalogue, to compare against with "
+        "'hash'. Without it, only the hash is reported.",
+    )
+
+    parser.add_argument(
+        "--index_file",
+        type=str,
+        default="",
+        help="Path to the index of the known images. Loaded if it exists and --known_images did not change since it "
+        "was built, otherwise built and saved there.",
+    )
+
+    parser.add_argument(
+        "--top_k",
+        type=int,
+        default=DEFAULT_TOP_K,
+        help="Maximum number of identical or similar known images reported per image, the closest ones.",
+    )
+
+    parser.add_argument(
+        "--identity_threshold",
+        type=int,
+        default=DEFAULT_IDENTITY_THRESHOLD,
+        help="Maximum averaged Hamming distance for images to be considered identical.",
+    )
+
+    parser.add_argument(
+        "--similarity_threshold",
+        type=int,
+        default=DEFAULT_SIMILARITY_THRESHOLD,
+        help="Maximum averaged Hamming distance for images to be considered similar.",
+    )
+
+    parser.add_argument(
+        "--algorithm_thresholds",
+        type=parse_algorithm_thresholds,
+        default=None,
+        help="Comma-separated maximum Hamming distance of each sub-hash (average, perceptual, difference, wavelet), "
+        "e.g. '8,12,10,8'. Images with any sub-hash farther than its threshold are considered different.",
+    )
+
+    add_decode_arguments(parser)
+    add_vision_arguments(parser)
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+
     args = parser.parse_args()
 
     result = main(
         input_file=args.input_file,
         output_file=args.output_file,
+        cache_file=args.cache_file,
+        no_cache=args.no_cache,
+        rebuild_cache=args.rebuild_cache,
+        cache_digest=args.cache_digest,
+        cache_max_entries=args.cache_max_entries,
+        workers=args.workers,
+        ordered=args.ordered,
+        metrics_textfile=args.metrics_textfile,
+        metrics_port=args.metrics_port,
+        metrics_address=args.metrics_address,
+        checks=args.checks,
+        known_images_file=args.known_images,
+        index_file=args.index_file,
+        top_k=args.top_k,
+        identity_threshold=args.identity_threshold,
+        similarity_threshold=args.similarity_threshold,
+        algorithm_thresholds=args.algorithm_thresholds,
+        max_pixels=args.max_pixels,
+        oversize=args.oversize,
+        endpoint=args.endpoint,
+        api_key=args.api_key,
+        json_key_filepath=args.json_key_filepath,
+        no_auth=args.no_auth,
+        concurrency=args.concurrency,
+        requests_per_second=args.requests_per_second,
+        max_retries=args.max_retries,
+        max_results=args.max_results,
+        vision_cache_file=args.vision_cache_file,
+        no_vision_cache=args.no_vision_cache,
     )
 
     match result:
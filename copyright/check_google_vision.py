@@ -0,0 +1,834 @@
+import argparse
+import asyncio
+import base64
+import csv
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import traceback
+from collections import defaultdict
+from dataclasses import asdict
+from email.utils import parsedate_to_datetime
+from itertools import islice
+from pathlib import Path
+from types import TracebackType
+from typing import Any, AsyncIterator, Dict, Iterable, List, Mapping, Sequence, Set, Tuple, Type
+
+import aiohttp
+from google.auth.credentials import Credentials
+
+from aletk.utils import get_logger
+from aletk.ResultMonad import main_try_except_wrapper, Ok, Err
+from base_types import VisionReport
+from check_image_hashes import DEFAULT_CHUNK_SIZE, hash_images, iter_image_paths
+from google_auth_gateway import google_credentials
+from image_cache import DEFAULT_CACHE_FILE, add_cache_arguments, open_image_cache
+
+lgr = get_logger(__name__)
+
+VISION_ENDPOINT = "https://vision.googleapis.com"
+ANNOTATE_PATH = "/v1/images:annotate"
+VISION_SCOPES = ("https://www.googleapis.com/auth/cloud-vision",)
+
+# Limits of one `images:annotate` request: 16 images, and a 10 MB JSON body, which base64 content inflates by 4/3
+MAX_IMAGES_PER_REQUEST = 16
+MAX_REQUEST_CONTENT_BYTES = 7 * 2**20
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_REQUESTS_PER_SECOND = 5.0
+DEFAULT_MAX_RESULTS = 20
+DEFAULT_TIMEOUT = 120.0
+
+DEFAULT_MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+RETRYABLE_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
+# Images submitted to a `VisionBatcher` wait at most this many seconds for others to share their request
+BATCH_WAIT = 0.05
+
+DEFAULT_VISION_CACHE_FILE = str(Path(DEFAULT_CACHE_FILE).with_name("vision_cache.sqlite3"))
+
+URL_SEPARATOR = " | "
+
+VISION_FIELDS = ["image_path", "hash"] + list(VisionReport.__annotations__.keys())
+
+type TWebDetection = Dict[str, Any]
+
+
+class VisionRequestError(Exception):
+    """
+    An `images:annotate` request failed for good, after its retries if the failure was transient.
+    """
+
+
+###
+# Rate limiting
+###
+
+
+class TokenBucket:
+    """
+    Allow `rate` acquisitions per second on average, in bursts of at most `capacity`. Waiters are served in order.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0) -> None:
+        if rate <= 0:
+            raise ValueError(f"Invalid rate {rate}, expected a positive number of requests per second")
+
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def retry_after_seconds(value: str | None) -> float | None:
+    """
+    Parse a Retry-After header, given either in seconds or as an HTTP date.
+    """
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: float | None) -> float:
+    """
+    Exponential backoff with full jitter, but never sooner than the server asked for.
+    """
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+    return max(delay, retry_after or 0.0)
+
+
+###
+# Cache
+###
+
+
+class VisionCache:
+    """
+    Local SQLite cache of web detection results, keyed by the composite hash of the image, so that an image is never
+    sent twice, whatever its path. Only successful results are cached.
+    """
+
+    def __init__(self, db_path: str) -> None:
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+
+        self._connection = sqlite3.connect(db_path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS vision_cache ("
+            "composite_hash TEXT PRIMARY KEY, web_detection TEXT NOT NULL, created INTEGER NOT NULL)"
+        )
+
+    def __enter__(self) -> "VisionCache":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Type[BaseException] | None,
+        exc_value: BaseException | None,
+        exc_traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def get(self, composite_hash: str) -> TWebDetection | None:
+        row = self._connection.execute(
+            "SELECT web_detection FROM vision_cache WHERE composite_hash = ?", (composite_hash,)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        web_detection: TWebDetection = json.loads(row[0])
+        return web_detection
+
+    def put(self, composite_hash: str, web_detection: TWebDetection) -> None:
+        # Committed right away: every entry was paid for
+        self._connection.execute(
+            "INSERT OR REPLACE INTO vision_cache (composite_hash, web_detection, created) VALUES (?, ?, ?)",
+            (composite_hash, json.dumps(web_detection), int(time.time())),
+        )
+        self._connection.commit()
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+###
+# Client
+###
+
+
+def _urls(web_detection: TWebDetection, key: str) -> str:
+    return URL_SEPARATOR.join(f"{entry.get('url', '')}" for entry in web_detection.get(key, ()))
+
+
+def web_detection_report(web_detection: TWebDetection) -> VisionReport:
+    full = _urls(web_detection, "fullMatchingImages")
+    partial = _urls(web_detection, "partialMatchingImages")
+    pages = _urls(web_detection, "pagesWithMatchingImages")
+
+    return VisionReport(
+        status="ok" if full or partial else "not_found",
+        full_matching_images=full,
+        partial_matching_images=partial,
+        pages_with_matching_images=pages,
+        error_message="" if full or partial else "No matching images found on the web.",
+        error_context="",
+    )
+
+
+def _vision_error_report(message: str, context: str) -> VisionReport:
+    return VisionReport(
+        status="error",
+        full_matching_images="",
+        partial_matching_images="",
+        pages_with_matching_images="",
+        error_message=message,
+        error_context=context,
+    )
+
+
+class VisionClient:
+    """
+    Client of the Vision `images:annotate` endpoint, for web detection.
+
+    At most `concurrency` requests are in flight, and they are started at no more than `requests_per_second`.
+    Transient failures (connection errors, timeouts, 408, 429 and 5xx) are retried up to `max_retries` times with
+    exponential backoff, honouring Retry-After.
+
+    Requests are authenticated with `api_key` if set, else with OAuth `credentials` if set, else not at all, e.g. for
+    a local fake server.
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        endpoint: str = VISION_ENDPOINT,
+        api_key: str = "",
+        credentials: Credentials | None = None,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        max_results: int = DEFAULT_MAX_RESULTS,
+    ) -> None:
+        self.session = session
+        self.url = endpoint.rstrip("/") + ANNOTATE_PATH
+        self.api_key = api_key
+        self.credentials = credentials
+        self.max_retries = max_retries
+        self.max_results = max_results
+        self.concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._bucket = TokenBucket(requests_per_second)
+        self._credentials_lock = asyncio.Lock()
+
+    async def _auth(self) -> Tuple[Dict[str, str], Dict[str, str]]:
+        # Headers and query parameters authenticating a request
+        if self.api_key:
+            return {}, {"key": self.api_key}
+
+        if self.credentials is None:
+            return {}, {}
+
+        async with self._credentials_lock:
+            if not self.credentials.valid:
+                import google.auth.transport.requests
+
+                await asyncio.to_thread(self.credentials.refresh, google.auth.transport.requests.Request())
+
+        return {"Authorization": f"Bearer {self.credentials.token}"}, {}
+
+    async def _post(self, body: Mapping[str, Any]) -> List[Dict[str, Any]]:
+        error = ""
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            await self._bucket.acquire()
+
+            try:
+                headers, params = await self._auth()
+                async with self._semaphore:
+                    async with self.session.post(self.url, json=body, headers=headers, params=params) as response:
+                        if response.status == 200:
+                            responses: List[Dict[str, Any]] = (await response.json())["responses"]
+                            return responses
+
+                        error = f"HTTP {response.status}: {(await response.text())[:500]}"
+                        if response.status not in RETRYABLE_STATUSES:
+                            raise VisionRequestError(error)
+                        retry_after = retry_after_seconds(response.headers.get("Retry-After"))
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = f"{e.__class__.__name__}: {e}"
+
+            if attempt < self.max_retries:
+                delay = backoff_delay(attempt, retry_after)
+                lgr.warning(f"Vision request failed ({error}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+        raise VisionRequestError(f"Giving up after {self.max_retries + 1} attempts, last error: {error}")
+
+    async def web_detection_contents(
+        self, contents: Sequence[bytes], image_names: Sequence[str]
+    ) -> List[TWebDetection | VisionReport]:
+        """
+        Annotate up to `MAX_IMAGES_PER_REQUEST` images, given by their file contents, in one request. Never raises:
+        returns, for each image, either its web detection, or an error report.
+        """
+        requests = [
+            {
+                "image": {"content": base64.b64encode(content).decode("ascii")},
+                "features": [{"type": "WEB_DETECTION", "maxResults": self.max_results}],
+            }
+            for content in contents
+        ]
+
+        try:
+            responses = await self._post({"requests": requests})
+            if len(responses) != len(requests):
+                raise VisionRequestError(f"Expected {len(requests)} responses, got {len(responses)}")
+        except Exception as e:
+            return [_vision_error_report(f"{e.__class__.__name__}: {e}", traceback.format_exc())] * len(requests)
+
+        results: List[TWebDetection | VisionReport] = []
+        for image_name, response in zip(image_names, responses):
+            if "error" in response:
+                status = response["error"]
+                results.append(
+                    _vision_error_report(
+                        f"Vision error {status.get('code', '')}: {status.get('message', '')}",
+                        f"Error annotating image: '{image_name}'",
+                    )
+                )
+            else:
+                results.append(response.get("webDetection", {}))
+
+        return results
+
+    async def web_detection(self, image_paths: Sequence[str]) -> List[TWebDetection | VisionReport]:
+        """
+        Same as `web_detection_contents`, reading the images from their paths. Unreadable images get an error report.
+        """
+        results: List[TWebDetection | VisionReport] = []
+        contents: List[bytes] = []
+        readable: List[int] = []
+
+        for image_path in image_paths:
+            try:
+                contents.append(await asyncio.to_thread(Path(image_path).read_bytes))
+            except OSError as e:
+                results.append(_vision_error_report(str(e), f"Error reading image: '{image_path}'"))
+                continue
+
+            readable.append(len(results))
+            results.append(_vision_error_report("", ""))  # placeholder
+
+        if contents:
+            annotated = await self.web_detection_contents(contents, [image_paths[i] for i in readable])
+            for i, result in zip(readable, annotated):
+                results[i] = result
+
+        return results
+
+
+def request_batches(images: Iterable[Tuple[str, str]]) -> Iterable[List[Tuple[str, str]]]:
+    """
+    Group (composite hash, image path) pairs into batches that fit in one `images:annotate` request, by number of
+    images and by total content size. An image larger than the size limit gets a batch of its own.
+    """
+    batch: List[Tuple[str, str]] = []
+    batch_bytes = 0
+
+    for hash, image_path in images:
+        try:
+            size = os.stat(image_path).st_size
+        except OSError:
+            size = 0
+
+        if batch and (len(batch) == MAX_IMAGES_PER_REQUEST or batch_bytes + size > MAX_REQUEST_CONTENT_BYTES):
+            yield batch
+            batch, batch_bytes = [], 0
+
+        batch.append((hash, image_path))
+        batch_bytes += size
+
+    if batch:
+        yield batch
+
+
+async def check_images_vision(
+    hashed_images: Iterable[Tuple[str, str]], client: VisionClient, cache: VisionCache | None
+) -> AsyncIterator[Tuple[str, str, VisionReport]]:
+    """
+    Run web detection on images given as (image path, composite hash) pairs, yielding (image path, composite hash,
+    report) in completion order.
+
+    Images are deduplicated by composite hash: each distinct image is sent at most once, cached ones not at all, and
+    its report is yielded for all its paths.
+    """
+    paths_by_hash: Dict[str, List[str]] = defaultdict(list)
+    for image_path, hash in hashed_images:
+        paths_by_hash[hash].append(image_path)
+
+    misses: List[Tuple[str, str]] = []
+    for hash, image_paths in paths_by_hash.items():
+        cached = cache.get(hash) if cache is not None else None
+        if cached is None:
+            misses.append((hash, image_paths[0]))
+            continue
+
+        report = web_detection_report(cached)
+        for image_path in image_paths:
+            yield image_path, hash, report
+
+    lgr.info(f"{len(paths_by_hash) - len(misses)} distinct images served from the cache, {len(misses)} to annotate")
+
+    async def annotate(batch: List[Tuple[str, str]]) -> List[Tuple[str, TWebDetection | VisionReport]]:
+        results = await client.web_detection([image_path for _, image_path in batch])
+        return [(hash, result) for (hash, _), result in zip(batch, results)]
+
+    # A batch reads its images when its task starts, so only as many tasks as the client has requests in flight are
+    # started at once: the batches waiting for their turn hold nothing but their paths
+    batches = iter(request_batches(misses))
+    pending: Set[asyncio.Task[List[Tuple[str, TWebDetection | VisionReport]]]] = {
+        asyncio.create_task(annotate(batch)) for batch in islice(batches, client.concurrency)
+    }
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.update(asyncio.create_task(annotate(batch)) for batch in islice(batches, len(done)))
+
+            for task in done:
+                for hash, result in task.result():
+                    if isinstance(result, VisionReport):
+                        report = result
+                    else:
+                        report = web_detection_report(result)
+                        if cache is not None:
+                            cache.put(hash, result)
+
+                    for image_path in paths_by_hash[hash]:
+                        yield image_path, hash, report
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+###
+# Batcher
+###
+
+
+class VisionBatcher:
+    """
+    Synchronous front of `VisionClient`, for checks running in threads. Images submitted concurrently are gathered
+    into shared requests, sent as soon as one is full or after `BATCH_WAIT` seconds, and an image already in flight,
+    by composite hash, is not sent again. Successful results are cached in `vision_cache_file`, unless empty.
+
+    The client runs on an event loop in a background thread, which owns the HTTP session and the cache.
+    """
+
+    def __init__(
+        self,
+        endpoint: str = VISION_ENDPOINT,
+        api_key: str = "",
+        credentials: Credentials | None = None,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        max_results: int = DEFAULT_MAX_RESULTS,
+        vision_cache_file: str = "",
+    ) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+        self._pending: List[Tuple[str, bytes]] = []
+        self._pending_bytes = 0
+        self._flush_timer: asyncio.TimerHandle | None = None
+        self._in_flight: Dict[str, asyncio.Future[VisionReport]] = {}
+        self._tasks: Set[asyncio.Task[None]] = set()
+
+        async def start() -> Tuple[aiohttp.ClientSession, VisionClient, VisionCache | None]:
+            session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=DEFAULT_TIMEOUT))
+            client = VisionClient(
+                session, endpoint, api_key, credentials, concurrency, requests_per_second, max_retries, max_results
+            )
+            return session, client, VisionCache(vision_cache_file) if vision_cache_file else None
+
+        try:
+            self._session, self._client, self._cache = asyncio.run_coroutine_threadsafe(start(), self._loop).result()
+        except BaseException:
+            self._stop_loop()
+            raise
+
+    def web_detection(self, composite_hash: str, contents: bytes) -> VisionReport:
+        """
+        Run web detection on an image, given by its serialized composite hash and its file contents. Blocks until
+        its request is answered. Never raises.
+        """
+        return asyncio.run_coroutine_threadsafe(self._web_detection(composite_hash, contents), self._loop).result()
+
+    async def _web_detection(self, composite_hash: str, contents: bytes) -> VisionReport:
+        future = self._in_flight.get(composite_hash)
+        if future is None:
+            cached = self._cache.get(composite_hash) if self._cache is not None else None
+            if cached is not None:
+                return web_detection_report(cached)
+
+            future = self._loop.create_future()
+            self._in_flight[composite_hash] = future
+            self._submit(composite_hash, contents)
+
+        return await asyncio.shield(future)
+
+    def _submit(self, composite_hash: str, contents: bytes) -> None:
+        # Same batching as `request_batches`, an image larger than the size limit being sent on its own
+        if self._pending and self._pending_bytes + len(contents) > MAX_REQUEST_CONTENT_BYTES:
+            self._flush()
+
+        self._pending.append((composite_hash, contents))
+        self._pending_bytes += len(contents)
+
+        if len(self._pending) == MAX_IMAGES_PER_REQUEST:
+            self._flush()
+        elif self._flush_timer is None:
+            self._flush_timer = self._loop.call_later(BATCH_WAIT, self._flush)
+
+    def _flush(self) -> None:
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+        batch, self._pending, self._pending_bytes = self._pending, [], 0
+        if batch:
+            task = self._loop.create_task(self._annotate(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _annotate(self, batch: List[Tuple[str, bytes]]) -> None:
+        # Every image of the batch gets a report, an error one if anything fails, or its caller would wait forever
+        error = _vision_error_report("Request interrupted", "")
+        try:
+            results = await self._client.web_detection_contents(
+                [contents for _, contents in batch], [composite_hash for composite_hash, _ in batch]
+            )
+
+            detections: List[Tuple[str, TWebDetection]] = []
+            for (composite_hash, _), result in zip(batch, results):
+                if isinstance(result, VisionReport):
+                    report = result
+                else:
+                    report = web_detection_report(result)
+                    detections.append((composite_hash, result))
+
+                self._in_flight.pop(composite_hash).set_result(report)
+
+            if self._cache is not None:
+                for composite_hash, detection in detections:
+                    self._cache.put(composite_hash, detection)
+
+        except Exception as e:
+            lgr.error(f"Error annotating a batch of {len(batch)} images: {e.__class__.__name__}: {e}")
+            error = _vision_error_report(f"{e.__class__.__name__}: {e}", traceback.format_exc())
+
+        finally:
+            for composite_hash, _ in batch:
+                future = self._in_flight.pop(composite_hash, None)
+                if future is not None and not future.done():
+                    future.set_result(error)
+
+    def _stop_loop(self) -> None:
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self) -> "VisionBatcher":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Type[BaseException] | None,
+        exc_value: BaseException | None,
+        exc_traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        async def stop() -> None:
+            self._flush()
+            if self._tasks:
+                await asyncio.wait(self._tasks)
+            await self._session.close()
+            if self._cache is not None:
+                self._cache.close()
+
+        asyncio.run_coroutine_threadsafe(stop(), self._loop).result()
+        self._stop_loop()
+
+
+###
+# Main
+###
+
+
+async def _run_vision_checks(
+    hashed_images: List[Tuple[str, str]],
+    writer: "csv.DictWriter[str]",
+    endpoint: str,
+    api_key: str,
+    credentials: Credentials | None,
+    concurrency: int,
+    requests_per_second: float,
+    max_retries: int,
+    max_results: int,
+    vision_cache: VisionCache | None,
+) -> None:
+    timeout = aiohttp.ClientTimeout(total=DEFAULT_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        client = VisionClient(
+            session, endpoint, api_key, credentials, concurrency, requests_per_second, max_retries, max_results
+        )
+        async for image_path, hash, report in check_images_vision(hashed_images, client, vision_cache):
+            writer.writerow({"image_path": image_path, "hash": hash, **asdict(report)})
+
+
+@main_try_except_wrapper(logger=lgr)
+def main(
+    input_path: str,
+    output_file: str,
+    endpoint: str,
+    api_key: str,
+    json_key_filepath: str,
+    no_auth: bool,
+    concurrency: int,
+    requests_per_second: float,
+    max_retries: int,
+    max_results: int,
+    vision_cache_file: str,
+    no_vision_cache: bool,
+    workers: int,
+    cache_file: str,
+    no_cache: bool,
+    rebuild_cache: bool,
+    cache_digest: bool,
+    cache_max_entries: int,
+) -> None:
+    """
+    Run Google Vision web detection on the images listed in a file or found in a directory, and write one report per
+    image to a CSV file.
+
+    Images are first hashed, through the image cache unless `no_cache` is set, so that identical images are sent only
+    once, and web detection results are cached by composite hash unless `no_vision_cache` is set.
+    """
+    credentials = vision_credentials(api_key, json_key_filepath, no_auth)
+
+    image_cache = open_image_cache(cache_file, no_cache, rebuild_cache, cache_digest, cache_max_entries)
+    vision_cache = None if no_vision_cache else VisionCache(vision_cache_file)
+
+    try:
+        with open(output_file, "w", newline="") as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=VISION_FIELDS)
+            writer.writeheader()
+
+            lgr.info(f"Hashing images from '{input_path}' with {workers} workers...")
+            hashed_images: List[Tuple[str, str]] = []
+            for result in hash_images(iter_image_paths(input_path), workers, DEFAULT_CHUNK_SIZE, cache=image_cache):
+                if result.status == "success":
+                    hashed_images.append((result.image_path, result.hash))
+                else:
+                    report = _vision_error_report(result.message, result.traceback)
+                    writer.writerow({"image_path": result.image_path, "hash": "", **asdict(report)})
+
+            lgr.info(f"Running web detection on {len(hashed_images)} images against '{endpoint}'...")
+            asyncio.run(
+                _run_vision_checks(
+                    hashed_images,
+                    writer,
+                    endpoint,
+                    api_key,
+                    credentials,
+                    concurrency,
+                    requests_per_second,
+                    max_retries,
+                    max_results,
+                    vision_cache,
+                )
+            )
+    finally:
+        if image_cache is not None:
+            image_cache.close()
+        if vision_cache is not None:
+            vision_cache.close()
+
+    lgr.info(f"All Vision reports written to '{output_file}'")
+
+
+def vision_credentials(api_key: str, json_key_filepath: str, no_auth: bool) -> Credentials | None:
+    """
+    OAuth credentials for the Vision API as requested by the `--api_key`, `--json_key_filepath` and `--no_auth`
+    command line options, None if requests are authenticated with the API key or not at all.
+    """
+    return None if no_auth or api_key else google_credentials(json_key_filepath, VISION_SCOPES)
+
+
+def add_vision_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--endpoint",
+        type=str,
+        default=VISION_ENDPOINT,
+        help="Base URL of the Vision API, e.g. 'http://127.0.0.1:8765' for a local fake server.",
+    )
+
+    parser.add_argument(
+        "--api_key",
+        type=str,
+        default=os.environ.get("GOOGLE_VISION_API_KEY", ""),
+        help="API key to authenticate with. Defaults to $GOOGLE_VISION_API_KEY, else a service account is used.",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--json_key_filepath",
+        type=str,
+        default="",
+        help="Path to the service account key file. Defaults to the application default credentials.",
+    )
+
+    parser.add_argument(
+        "--no_auth",
+        action="store_true",
+        help="Send unauthenticated requests, e.g. to a local fake server.",
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"Maximum number of requests in flight, each of up to {MAX_IMAGES_PER_REQUEST} images.",
+    )
+
+    parser.add_argument(
+        "--requests_per_second",
+        type=float,
+        default=DEFAULT_REQUESTS_PER_SECOND,
+        help="Maximum average rate at which requests are started, retries included.",
+    )
+
+    parser.add_argument(
+        "--max_retries",
+        type=int,
+        default=DEFAULT_MAX_RETRIES,
+        help="Number of retries of a request failing with a transient error, with exponential backoff.",
+    )
+
+    parser.add_argument(
+        "--max_results",
+        type=int,
+        default=DEFAULT_MAX_RESULTS,
+        help="Maximum number of web detection results per image.",
+    )
+
+    parser.add_argument(
+        "--vision_cache_file",
+        type=str,
+        default=DEFAULT_VISION_CACHE_FILE,
+        help=f"Path to the cache of web detection results. Defaults to '{DEFAULT_VISION_CACHE_FILE}'.",
+    )
+
+    parser.add_argument(
+        "--no_vision_cache",
+        action="store_true",
+        help="Neither read nor write the cache of web detection results. Every image is sent again.",
+    )
+
+
+def cli() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Look for copies of images on the web with Google Vision.")
+
+    parser.add_argument(
+        "-i",
+        "--input_path",
+        type=str,
+        required=True,
+        help="Path to a file containing image paths, one per line, or to a directory to walk.",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output_file",
+        type=str,
+        required=True,
+        help="Path to the output CSV file.",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes hashing images. Defaults to the number of CPUs.",
+    )
+
+    add_vision_arguments(parser)
+    add_cache_arguments(parser)
+
+    args = parser.parse_args()
+
+    result = main(
+        input_path=args.input_path,
+        output_file=args.output_file,
+        endpoint=args.endpoint,
+        api_key=args.api_key,
+        json_key_filepath=args.json_key_filepath,
+        no_auth=args.no_auth,
+        concurrency=args.concurrency,
+        requests_per_second=args.requests_per_second,
+        max_retries=args.max_retries,
+        max_results=args.max_results,
+        vision_cache_file=args.vision_cache_file,
+        no_vision_cache=args.no_vision_cache,
+        workers=args.workers,
+        cache_file=args.cache_file,
+        no_cache=args.no_cache,
+        rebuild_cache=args.rebuild_cache,
+        cache_digest=args.cache_digest,
+        cache_max_entries=args.cache_max_entries,
+    )
+
+    match result:
+        case Ok(out=_):
+            pass
+        case Err(err):
+            lgr.error(f"Error: {err}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,391 @@
+import csv
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from itertools import batched
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Literal, Tuple
+
+from aletk.utils import get_logger
+from aletk.ResultMonad import main_try_except_wrapper, Ok, Err
+from image_cache import FileFingerprint, ImageCache, add_cache_arguments, fingerprint_file, open_image_cache
+from image_decoding import (
+    DEFAULT_DECODE_POLICY,
+    DEFAULT_MAX_PIXELS,
+    DecodePolicy,
+    TOversizePolicy,
+    add_decode_arguments,
+)
+from image_hashing import compute_composite_hash_downsampling, deserialize_hash, serialize_hash
+from image_metadata_io import COPYRIGHTED_IMAGE_FIELDS, IMAGE_COMPARED_FIELDS
+from job_metrics import (
+    add_metrics_arguments,
+    count_status,
+    enable_worker_metrics,
+    merge_observations,
+    metrics_enabled,
+    observed,
+    open_metrics,
+    stage_timer,
+)
+from parallel import bounded_map
+
+lgr = get_logger(__name__)
+
+IMAGE_EXTENSIONS = frozenset((".jpg", ".jpeg", ".png", ".webp", ".gif", ".tif", ".tiff", ".bmp"))
+
+DEFAULT_CHUNK_SIZE = 16
+
+# Number of input paths looked up in the cache before the misses are sent to the workers
+CACHE_LOOKUP_WINDOW = 10_000
+
+PROGRESS_LOG_INTERVAL = 1000
+
+type TOutputSchema = Literal["image_compared", "copyrighted_image"]
+
+
+@dataclass(frozen=True, slots=True)
+class HashResult:
+    index: int
+    image_path: str
+    hash: str
+    status: Literal["success", "error"]
+    message: str
+    traceback: str
+    downsampled: bool = False  # to fit the pixel limit of the decode policy
+
+
+def hash_image(
+    index: int, image_path: str, fast_decode: bool, policy: DecodePolicy = DEFAULT_DECODE_POLICY
+) -> HashResult:
+    try:
+        hash, downsampled = compute_composite_hash_downsampling(image_path, fast_decode=fast_decode, policy=policy)
+
+        return HashResult(
+            index=index,
+            image_path=image_path,
+            hash=serialize_hash(hash),
+            status="success",
+            message="",
+            traceback="",
+            downsampled=downsampled,
+        )
+
+    except Exception as e:
+        return HashResult(
+            index=index,
+            image_path=image_path,
+            hash="",
+            status="error",
+            message=f"Error hashing image '{image_path}': {e.__class__.__name__}: {e}",
+            traceback=traceback.format_exc(),
+        )
+
+
+def _hash_chunk(chunk: Tuple[Tuple[int, str], ...], fast_decode: bool, policy: DecodePolicy) -> Tuple[HashResult, ...]:
+    return tuple(hash_image(index, image_path, fast_decode, policy) for index, image_path in chunk)
+
+
+def iter_image_paths(input_path: str) -> Iterator[str]:
+    """
+    Yield image paths, either listed one per line in a file, or found by walking a directory.
+    """
+    path = Path(input_path)
+
+    if path.is_dir():
+        for root, _, files in os.walk(path):
+            for file in sorted(files):
+                if Path(file).suffix.lower() in IMAGE_EXTENSIONS:
+                    yield os.path.join(root, file)
+        return
+
+    with path.open("r") as f:
+        for line in f:
+            image_path = line.strip()
+            if image_path:
+                yield image_path
+
+
+def _fingerprint(image_path: str, use_digest: bool) -> FileFingerprint | None:
+    try:
+        return fingerprint_file(image_path, use_digest)
+    except OSError:
+        # Unreadable or missing file, left to the worker to report
+        return None
+
+
+def _fingerprint_chunk(
+    chunk: Tuple[Tuple[int, str], ...], use_digest: bool
+) -> Tuple[Tuple[int, str, FileFingerprint | None], ...]:
+    return tuple((index, image_path, _fingerprint(image_path, use_digest)) for index, image_path in chunk)
+
+
+def _fingerprint_window(
+    executor: ProcessPoolExecutor,
+    window: Tuple[Tuple[int, str], ...],
+    use_digest: bool,
+    chunk_size: int,
+    workers: int,
+) -> Iterator[Tuple[int, str, FileFingerprint | None]]:
+    """
+    Fingerprint a window of paths, in completion order. Digests read every file in full, so they are computed on the
+    workers; without them, a stat is cheaper in this process than a round trip to a worker.
+    """
+    if not use_digest:
+        for index, image_path in window:
+            yield index, image_path, _fingerprint(image_path, use_digest)
+        return
+
+    fingerprint_chunk = partial(_fingerprint_chunk, use_digest=use_digest)
+    for results in bounded_map(executor, fingerprint_chunk, batched(window, chunk_size), 2 * workers):
+        yield from results
+
+
+def _cache_lookup(
+    cache: ImageCache, index: int, image_path: str, fp: FileFingerprint, fast_decode: bool, policy: DecodePolicy
+) -> HashResult | None:
+    hash = cache.get_hash(fp, fast_decode, policy)
+    if hash is None:
+        return None
+
+    return HashResult(
+        index=index,
+        image_path=image_path,
+        hash=serialize_hash(hash),
+        status="success",
+        message="",
+        traceback="",
+    )
+
+
+def hash_images(
+    image_paths: Iterable[str],
+    workers: int,
+    chunk_size: int,
+    fast_decode: bool = False,
+    cache: ImageCache | None = None,
+    policy: DecodePolicy = DEFAULT_DECODE_POLICY,
+) -> Iterator[HashResult]:
+    """
+    Hash images on a process pool, yielding the results in completion order.
+
+    Paths are submitted in chunks of `chunk_size` to amortize the inter-process overhead, and at most two chunks
+    per worker are in flight, so the input is consumed lazily. With a cache, the input is looked up in windows of
+    `CACHE_LOOKUP_WINDOW` paths, fingerprinted on the workers when the cache uses digests, which read every file in
+    full: hits are yielded right away and only misses are sent to the workers, their results being cached as they
+    come back. Images are decoded within the pixel limit of `policy`. With metrics enabled, the stage durations
+    observed by the workers are sent back along with each chunk.
+    """
+    hash_chunk = observed(partial(_hash_chunk, fast_decode=fast_decode, policy=policy))
+    initializer = enable_worker_metrics if metrics_enabled() else None
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer) as executor:
+        if cache is None:
+            chunks = batched(enumerate(image_paths), chunk_size)
+            for results, observations in bounded_map(executor, hash_chunk, chunks, 2 * workers):
+                merge_observations(observations)
+                yield from results
+            return
+
+        for window in batched(enumerate(image_paths), CACHE_LOOKUP_WINDOW):
+            misses: List[Tuple[int, str]] = []
+            fingerprints: Dict[int, FileFingerprint] = {}
+
+            for index, image_path, fp in _fingerprint_window(executor, window, cache.use_digest, chunk_size, workers):
+                cached = _cache_lookup(cache, index, image_path, fp, fast_decode, policy) if fp is not None else None
+                if cached is not None:
+                    yield cached
+                    continue
+
+                misses.append((index, image_path))
+                if fp is not None:
+                    fingerprints[index] = fp
+
+            chunks = batched(misses, chunk_size)
+            for results, observations in bounded_map(executor, hash_chunk, chunks, 2 * workers):
+                merge_observations(observations)
+                for result in results:
+                    fp = fingerprints.get(result.index)
+                    if result.status == "success" and fp is not None:
+                        cache.put_hash(fp, deserialize_hash(result.hash), fast_decode, policy, result.downsampled)
+                    yield result
+
+
+def _image_compared_row(result: HashResult) -> Dict[str, str]:
+    return {
+        "id": f"{result.index}",
+        "request": "COMPUTE HASH",
+        "asset_path": result.image_path,
+        "hash": result.hash,
+        "copyright_comparisons": "",
+        "status": result.status,
+        "message": result.message,
+        "traceback": result.traceback,
+        "object_dump": "",
+    }
+
+
+def _copyrighted_image_row(result: HashResult) -> Dict[str, str]:
+    return {
+        "id": f"{result.index}",
+        "hash": result.hash,
+        "original_name": Path(result.image_path).name,
+        "link": result.image_path,
+    }
+
+
+def write_hash_results_to_csv(results: Iterable[HashResult], output_file: str, schema: TOutputSchema) -> None:
+    """
+    Stream hash results to a CSV file, in the `ImageCompared` or `CopyrightedImage` schema. The latter has no room
+    for errors, so failed images are logged and left out.
+    """
+    fieldnames = IMAGE_COMPARED_FIELDS if schema == "image_compared" else COPYRIGHTED_IMAGE_FIELDS
+
+    with open(output_file, "w", newline="") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+
+        for n, result in enumerate(results, start=1):
+            with stage_timer("csv_write"):
+                if schema == "image_compared":
+                    writer.writerow(_image_compared_row(result))
+                elif result.status == "success":
+                    writer.writerow(_copyrighted_image_row(result))
+                else:
+                    lgr.error(result.message)
+            count_status(result.status)
+
+            if n % PROGRESS_LOG_INTERVAL == 0:
+                lgr.info(f"{n} images hashed")
+
+
+@main_try_except_wrapper(logger=lgr)
+def main(
+    input_path: str,
+    output_file: str,
+    schema: TOutputSchema,
+    workers: int,
+    chunk_size: int,
+    fast_decode: bool,
+    cache_file: str,
+    no_cache: bool,
+    rebuild_cache: bool,
+    cache_digest: bool,
+    cache_max_entries: int,
+    max_pixels: int = DEFAULT_MAX_PIXELS,
+    oversize: TOversizePolicy = "downsample",
+    metrics_textfile: str = "",
+    metrics_port: int = 0,
+    metrics_address: str = "127.0.0.1",
+) -> None:
+    """
+    Compute the composite hash of every image listed in a file or found in a directory, and write them to a CSV file.
+    Unchanged images are served from the image cache unless `no_cache` is set. Images above `max_pixels` are
+    downsampled or skipped according to `oversize`, see `DecodePolicy`. Stage durations and result statuses
+    are exported as Prometheus metrics if `metrics_textfile` or `metrics_port` is set.
+    """
+    lgr.info(f"Hashing images from '{input_path}' with {workers} workers, in chunks of {chunk_size}...")
+
+    cache = open_image_cache(cache_file, no_cache, rebuild_cache, cache_digest, cache_max_entries)
+    metrics = open_metrics("check_image_hashes", metrics_textfile, metrics_port, metrics_address)
+    try:
+        policy = DecodePolicy(max_pixels=max_pixels, oversize=oversize)
+        results = hash_images(iter_image_paths(input_path), workers, chunk_size, fast_decode, cache, policy)
+        write_hash_results_to_csv(results, output_file, schema)
+    finally:
+        if cache is not None:
+            cache.close()
+        if metrics is not None:
+            metrics.close()
+
+    lgr.info(f"All image hashes written to '{output_file}'")
+
+
+def cli() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compute perceptual composite hashes of images in parallel.")
+
+    parser.add_argument(
+        "-i",
+        "--input_path",
+        type=str,
+        required=True,
+        help="Path to a file containing image paths, one per line, or to a directory to walk.",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output_file",
+        type=str,
+        required=True,
+        help="Path to the output CSV file.",
+    )
+
+    parser.add_argument(
+        "-s",
+        "--schema",
+        type=str,
+        choices=["image_compared", "copyrighted_image"],
+        default="image_compared",
+        help="Output CSV schema: 'image_compared' for assets to check, 'copyrighted_image' to build a known catalogue.",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes. Defaults to the number of CPUs.",
+    )
+
+    parser.add_argument(
+        "-c",
+        "--chunk_size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="Number of images sent to a worker at once.",
+    )
+
+    parser.add_argument(
+        "--fast_decode",
+        action="store_true",
+        help="Decode images at reduced resolution. Faster, but hashes are not bit-identical to the exact ones.",
+    )
+
+    add_decode_arguments(parser)
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+
+    result = main(
+        input_path=args.input_path,
+        output_file=args.output_file,
+        schema=args.schema,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        fast_decode=args.fast_decode,
+        cache_file=args.cache_file,
+        no_cache=args.no_cache,
+        rebuild_cache=args.rebuild_cache,
+        cache_digest=args.cache_digest,
+        cache_max_entries=args.cache_max_entries,
+        max_pixels=args.max_pixels,
+        oversize=args.oversize,
+        metrics_textfile=args.metrics_textfile,
+        metrics_port=args.metrics_port,
+        metrics_address=args.metrics_address,
+    )
+
+    match result:
+        case Ok(out=_):
+            pass
+        case Err(err):
+            lgr.error(f"Error: {err}")
+
+
+if __name__ == "__main__":
+    cli()
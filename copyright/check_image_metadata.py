@@ -1,29 +1,212 @@
+import struct
 import traceback
-from PIL import Image
+from typing import BinaryIO
 import piexif
-from pathlib import Path
 
 from base_types import ExifReport
+from image_decoding import open_image
 
+# Reading stops, and the Pillow path takes over, past this many header bytes
+MAX_HEADER_BYTES = 256 * 1024
 
-def check_exif_copyright(image_path: str) -> ExifReport:
+EXIF_HEADER = b"Exif\x00\x00"
 
-    try:
-        if not Path(image_path).is_file():
-            raise FileNotFoundError(f"The file {image_path} does not exist.")
+JPEG_SOI = b"\xff\xd8"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# TIFF field types whose values are 1 byte each, the only ones the Copyright tag comes in
+_BYTE_SIZED_TYPES = (1, 2, 7)  # BYTE, ASCII, UNDEFINED
+
+
+class UnsupportedHeaderError(Exception):
+    """
+    The file is not in a format, or a layout, that the header-only parser handles.
+    """
+
+
+class _BoundedReader:
+    """
+    Binary file wrapper that refuses to read more than `limit` bytes in total. Seeking is free.
+    """
+
+    def __init__(self, file: BinaryIO, limit: int) -> None:
+        self._file = file
+        self._remaining = limit
+
+    def read_exact(self, size: int) -> bytes:
+        if size > self._remaining:
+            raise UnsupportedHeaderError(f"Header larger than {MAX_HEADER_BYTES} bytes")
+        data = self._file.read(size)
+        if len(data) != size:
+            raise EOFError(f"Truncated file, expected {size} bytes, got {len(data)}")
+        self._remaining -= size
+        return data
+
+    def seek(self, offset: int, whence: int = 0) -> None:
+        self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+
+def _tiff_copyright(reader: _BoundedReader, base: int) -> bytes | None:
+    """
+    Return the raw Copyright (0x8298) value of IFD0 of the TIFF structure starting at offset `base`.
+    """
+    reader.seek(base)
+    header = reader.read_exact(8)
+    match header[:2]:
+        case b"II":
+            order = "<"
+        case b"MM":
+            order = ">"
+        case _:
+            raise ValueError(f"Invalid TIFF byte order marker {header[:2]!r}")
+
+    (ifd0_offset,) = struct.unpack(f"{order}L", header[4:8])
+
+    reader.seek(base + ifd0_offset)
+    (entry_count,) = struct.unpack(f"{order}H", reader.read_exact(2))
+    entries = reader.read_exact(12 * entry_count)
+
+    for i in range(entry_count):
+        tag, field_type, count = struct.unpack(f"{order}HHL", entries[12 * i : 12 * i + 8])
+        if tag != piexif.ImageIFD.Copyright:
+            continue
+
+        if field_type not in _BYTE_SIZED_TYPES:
+            raise ValueError(f"Unexpected TIFF type {field_type} for the Copyright tag")
+
+        value = entries[12 * i + 8 : 12 * i + 12]
+        if count <= 4:
+            return value[:count]
+
+        (value_offset,) = struct.unpack(f"{order}L", value)
+        reader.seek(base + value_offset)
+        return reader.read_exact(count)
+
+    return None
+
+
+def _jpeg_copyright(reader: _BoundedReader) -> bytes | None:
+    # Walk the marker segments up to the first Exif APP1, seeking over all the others
+    reader.seek(len(JPEG_SOI))
+    while True:
+        marker = reader.read_exact(2)
+        while marker[1] == 0xFF:  # fill bytes
+            marker = marker[1:] + reader.read_exact(1)
+        if marker[0] != 0xFF:
+            raise ValueError(f"Invalid JPEG marker {marker!r} at offset {reader.tell() - 2}")
+
+        if marker[1] in (0xDA, 0xD9):  # start of scan or end of image, no metadata past this point
+            return None
+        if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD7:  # standalone markers
+            continue
+
+        (length,) = struct.unpack(">H", reader.read_exact(2))
+        payload_start = reader.tell()
+        if marker[1] == 0xE1 and length - 2 >= len(EXIF_HEADER) and reader.read_exact(6) == EXIF_HEADER:
+            return _tiff_copyright(reader, payload_start + len(EXIF_HEADER))
+
+        reader.seek(payload_start + length - 2)
+
+
+def _png_copyright(reader: _BoundedReader) -> bytes | None:
+    # Same as Pillow on open: only an eXIf chunk before the image data is considered
+    reader.seek(len(PNG_SIGNATURE))
+    while True:
+        length, chunk_type = struct.unpack(">L4s", reader.read_exact(8))
+        if chunk_type in (b"IDAT", b"IEND"):
+            return None
+        if chunk_type == b"eXIf":
+            return _tiff_copyright(reader, reader.tell())
+
+        reader.seek(length + 4, 1)  # chunk data and CRC
 
-        img = Image.open(image_path)
 
+def _webp_copyright(reader: _BoundedReader, file_size: int) -> bytes | None:
+    # The EXIF chunk comes after the image data in extended WebP files, seek over everything else
+    position = 12
+    while position + 8 <= file_size:
+        reader.seek(position)
+        chunk_type, length = struct.unpack("<4sL", reader.read_exact(8))
+        if chunk_type == b"EXIF":
+            start = reader.tell()
+            base = start + len(EXIF_HEADER) if reader.read_exact(6) == EXIF_HEADER else start
+            return _tiff_copyright(reader, base)
+
+        position += 8 + length + (length & 1)
+
+    return None
+
+
+def exif_copyright_from_header(file: BinaryIO) -> bytes | None:
+    """
+    Return the raw EXIF Copyright value of an image, reading only the headers up to it.
+
+    JPEG (APP1), PNG (eXIf), WebP (EXIF) and TIFF (IFD0) are parsed directly, seeking over image data and unrelated
+    metadata, and reading at most `MAX_HEADER_BYTES`. Any other format raises `UnsupportedHeaderError`.
+    """
+    reader = _BoundedReader(file, MAX_HEADER_BYTES)
+    file.seek(0)
+    signature = file.read(12)
+
+    if signature.startswith(JPEG_SOI):
+        return _jpeg_copyright(reader)
+    if signature.startswith(PNG_SIGNATURE):
+        return _png_copyright(reader)
+    if signature[:4] == b"RIFF" and signature[8:12] == b"WEBP":
+        file_size = file.seek(0, 2)
+        return _webp_copyright(reader, file_size)
+    if signature[:4] in (b"II*\x00", b"MM\x00*"):
+        return _tiff_copyright(reader, 0)
+
+    raise UnsupportedHeaderError(f"Unsupported file signature {signature[:4]!r}")
+
+
+def exif_copyright_from_pillow(file: BinaryIO) -> bytes | None:
+    """
+    Return the raw EXIF Copyright value through Pillow and piexif, for the formats the header parser does not handle.
+    """
+    file.seek(0)
+    with open_image(file) as img:
         exif_data = img.info.get("exif")
 
-        if exif_data:
-            exif_dict = piexif.load(exif_data)
-            copyright_info = exif_dict.get(piexif.ImageIFD.Copyright)
-            if copyright_info:
-                if isinstance(copyright_info, bytes):
-                    copyright_info = copyright_info.decode("utf-8")
+    if not exif_data:
+        return None
+
+    exif_dict = piexif.load(exif_data)
+    copyright_info = exif_dict.get("0th", {}).get(piexif.ImageIFD.Copyright)
+
+    return copyright_info if isinstance(copyright_info, bytes) else None
+
+
+def _exif_error_report(e: Exception, image_path: str) -> ExifReport:
+    return ExifReport(
+        exif_copyright="",
+        status="error",
+        error_message=str(e),
+        error_context=f"Error processing image: '{image_path}'. Traceback: {traceback.format_exc()}",
+    )
+
+
+def check_exif_copyright_file(file: BinaryIO, image_path: str) -> ExifReport:
+    """
+    Same as `check_exif_copyright`, on an image already opened in binary mode, preferably unbuffered.
+    """
+
+    try:
+        try:
+            copyright_info = exif_copyright_from_header(file)
+        except UnsupportedHeaderError:
+            copyright_info = exif_copyright_from_pillow(file)
+
+        if copyright_info:
+            # ASCII values are NUL-terminated
+            copyright_str = copyright_info.rstrip(b"\x00").decode("utf-8")
+            if copyright_str:
                 return ExifReport(
-                    exif_copyright=f"{copyright_info}",
+                    exif_copyright=copyright_str,
                     status="ok",
                     error_message="",
                     error_context="",
@@ -37,9 +220,15 @@ def check_exif_copyright(image_path: str) -> ExifReport:
         )
 
     except Exception as e:
-        return ExifReport(
-            exif_copyright="",
-            status="error",
-            error_message=str(e),
-            error_context=f"Error processing image: '{image_path}'. Traceback: {traceback.format_exc()}",
-        )
+        return _exif_error_report(e, image_path)
+
+
+def check_exif_copyright(image_path: str) -> ExifReport:
+
+    try:
+        # Unbuffered, so that every small header read is exactly one read of that size
+        with open(image_path, "rb", buffering=0) as file:
+            return check_exif_copyright_file(file, image_path)
+
+    except Exception as e:
+        return _exif_error_report(e, image_path)
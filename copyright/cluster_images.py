@@ -0,0 +1,415 @@
+import csv
+import os
+from array import array
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+from aletk.utils import get_logger
+from aletk.ResultMonad import main_try_except_wrapper, Ok, Err
+from check_image_hashes import DEFAULT_CHUNK_SIZE, PROGRESS_LOG_INTERVAL, HashResult, hash_images, iter_image_paths
+from image_cache import add_cache_arguments, open_image_cache
+from image_decoding import DEFAULT_MAX_PIXELS, DecodePolicy, TOversizePolicy, add_decode_arguments
+from image_hashing import (
+    COMPOSITE_HASH_LENGTH,
+    SINGLE_HASH_BITS,
+    PackedCompositeHash,
+    THashComparison,
+    THashMatrix,
+    categorize_distance,
+    deserialize_hash,
+    pack_hash,
+    serialize_hash,
+    unpack_hash,
+)
+
+lgr = get_logger(__name__)
+
+DEFAULT_IDENTITY_THRESHOLD = 5
+DEFAULT_SIMILARITY_THRESHOLD = 10
+
+# With these, pairs at the default identity threshold are missed with probability 3e-5, closer ones almost never
+DEFAULT_LSH_TABLES = 48
+DEFAULT_LSH_BITS = 20
+
+# Within a bucket of an LSH table, each hash is compared with this many of the next ones only, so that a huge bucket,
+# e.g. of blank scans, costs linear rather than quadratic time
+DEFAULT_LSH_WINDOW = 64
+
+# Signatures are 64-bit integers
+MAX_LSH_BITS = 64
+
+CLUSTER_FIELDS = ["cluster_id", "cluster_size", "image_path", "hash", "category", "distance"]
+
+
+class DisjointSet:
+    """
+    Union-find over the integers 0 to n - 1, with union by size and path halving.
+    """
+
+    __slots__ = ("_parents", "_sizes")
+
+    def __init__(self) -> None:
+        self._parents: List[int] = []
+        self._sizes: List[int] = []
+
+    def add(self) -> int:
+        self._parents.append(len(self._parents))
+        self._sizes.append(1)
+        return len(self._parents) - 1
+
+    def find(self, item: int) -> int:
+        parents = self._parents
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+
+    def union(self, item1: int, item2: int) -> None:
+        root1, root2 = self.find(item1), self.find(item2)
+        if root1 == root2:
+            return
+        if self._sizes[root1] < self._sizes[root2]:
+            root1, root2 = root2, root1
+        self._parents[root2] = root1
+        self._sizes[root1] += self._sizes[root2]
+
+    def __len__(self) -> int:
+        return len(self._parents)
+
+
+class ClusterMember(NamedTuple):
+    cluster_id: int
+    cluster_size: int
+    image_path: str
+    hash: str
+    category: THashComparison  # with respect to the first image of the cluster, its representative
+    distance: int  # total Hamming distance to the representative
+
+
+def lsh_recall(distance: int, bits: int, tables: int) -> float:
+    """
+    Probability for two hashes at `distance` to share the signature of at least one of the LSH tables.
+    """
+    total_bits = COMPOSITE_HASH_LENGTH * SINGLE_HASH_BITS
+    collision = (1 - distance / total_bits) ** bits
+
+    return float(1 - (1 - collision) ** tables)
+
+
+def _lsh_signatures(hashes: THashMatrix, rng: np.random.Generator, bits: int) -> npt.NDArray[np.uint64]:
+    # Signature of every row: the values of `bits` randomly sampled bit positions of its composite hash
+    positions = rng.choice(COMPOSITE_HASH_LENGTH * SINGLE_HASH_BITS, size=bits, replace=False)
+    signatures = np.zeros(len(hashes), dtype=np.uint64)
+    for j, position in enumerate(positions.tolist()):
+        column, bit = divmod(position, SINGLE_HASH_BITS)
+        signatures |= ((hashes[:, column] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(j)
+
+    return signatures
+
+
+def _colliding_pairs(
+    signatures: npt.NDArray[np.uint64], window: int
+) -> Tuple[npt.NDArray[np.intp], npt.NDArray[np.intp]]:
+    # Pairs of rows sharing a signature, found by sorting instead of comparing. Rows keep their order within a run, and
+    # each one is only paired with the `window` next ones
+    order = np.argsort(signatures, kind="stable")
+    sorted_signatures = signatures[order]
+    boundaries = np.flatnonzero(sorted_signatures[1:] != sorted_signatures[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(signatures)]))
+
+    # Pair every sorted position with the ones `offset` after it in the same run, for growing offsets
+    run_ends = np.repeat(ends, ends - starts)
+    positions = np.flatnonzero(run_ends - np.arange(len(signatures)) > 1)
+    firsts = []
+    seconds = []
+    offset = 1
+    while len(positions) and offset <= window:
+        firsts.append(order[positions])
+        seconds.append(order[positions + offset])
+        offset += 1
+        positions = positions[positions + offset < run_ends[positions]]
+
+    if not firsts:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def cluster_hashes(
+    hash_results: Iterable[HashResult],
+    identity_threshold: int,
+    similarity_threshold: int,
+    include_similar: bool,
+    lsh_tables: int = DEFAULT_LSH_TABLES,
+    lsh_bits: int = DEFAULT_LSH_BITS,
+    lsh_window: int = DEFAULT_LSH_WINDOW,
+    seed: int = 0,
+) -> List[ClusterMember]:
+    """
+    Group images whose composite hashes are identical, or also similar with `include_similar`, into clusters.
+
+    Exact duplicates are merged first. The distinct hashes are then put in `lsh_tables` locality-sensitive hash
+    tables, each keyed on `lsh_bits` randomly sampled bits: near-duplicates are likely to share the key of at least
+    one table, while unrelated hashes almost never do. Only pairs sharing a key are compared, with the exact
+    distance, and merged in a union-find. This scales with the number of images, not with the number of pairs.
+    Within a large bucket, each hash is only compared with the `lsh_window` next ones: the distinct hashes being
+    sorted, these are its closest neighbours in the lexicographic order, and the union-find chains them together.
+
+    Results are therefore exact for the pairs found, but a pair right at the threshold is missed with a small
+    probability, see `lsh_recall`. Being near-duplicates is not transitive either: a cluster is a chain of
+    near-duplicate pairs, and its members are reported with their distance to the first image of the cluster.
+
+    :param hash_results: Hashed images. Failed ones are logged and skipped.
+    :param identity_threshold: Threshold for identical images.
+    :param similarity_threshold: Threshold for similar images.
+    :param include_similar: Also cluster similar images, not only identical ones.
+    :param lsh_tables: Number of LSH tables. More tables find more pairs at the threshold, and cost more time.
+    :param lsh_bits: Number of bits keying each table, from 1 to `MAX_LSH_BITS`. More bits mean fewer unrelated
+        pairs to compare.
+    :param lsh_window: Number of next hashes each hash is compared with in a bucket.
+    :param seed: Seed of the sampled bit positions, for reproducible results.
+    :return: Members of the clusters of at least two images, largest clusters first.
+    """
+    if not 1 <= lsh_bits <= MAX_LSH_BITS:
+        raise ValueError(f"lsh_bits must be between 1 and {MAX_LSH_BITS}, got {lsh_bits}")
+    if lsh_window < 1:
+        raise ValueError(f"lsh_window must be at least 1, got {lsh_window}")
+
+    max_distance = (similarity_threshold if include_similar else identity_threshold) * COMPOSITE_HASH_LENGTH
+
+    paths: List[str] = []
+    hash_parts = array("Q")
+    for n, result in enumerate(hash_results, start=1):
+        if result.status != "success":
+            lgr.error(result.message)
+            continue
+
+        paths.append(result.image_path)
+        hash_parts.extend(pack_hash(deserialize_hash(result.hash)).parts)
+
+        if n % PROGRESS_LOG_INTERVAL == 0:
+            lgr.info(f"{n} images hashed")
+
+    hashes: THashMatrix = np.frombuffer(hash_parts, dtype=np.uint64).reshape(-1, COMPOSITE_HASH_LENGTH)
+
+    # Exact duplicates share a row of `unique_hashes`, and therefore a cluster
+    unique_hashes, inverse = np.unique(hashes, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    lgr.info(
+        f"Clustering {len(paths)} images, {len(unique_hashes)} distinct hashes, with {lsh_tables} LSH tables. "
+        f"Pairs at the threshold are found with probability {lsh_recall(max_distance, lsh_bits, lsh_tables):.3f}"
+    )
+
+    clusters = DisjointSet()
+    for _ in range(len(unique_hashes)):
+        clusters.add()
+
+    rng = np.random.default_rng(seed)
+    for _ in range(lsh_tables):
+        firsts, seconds = _colliding_pairs(_lsh_signatures(unique_hashes, rng, lsh_bits), lsh_window)
+        distances = np.bitwise_count(unique_hashes[firsts] ^ unique_hashes[seconds]).sum(axis=1)
+        close = distances <= max_distance
+        for first, second in zip(firsts[close].tolist(), seconds[close].tolist()):
+            clusters.union(first, second)
+
+    members: Dict[int, List[int]] = defaultdict(list)
+    for item, row in enumerate(inverse.tolist()):
+        members[clusters.find(row)].append(item)
+
+    groups = sorted((items for items in members.values() if len(items) > 1), key=lambda items: (-len(items), items[0]))
+
+    cluster_members = []
+    for cluster_id, items in enumerate(groups, start=1):
+        representative = hashes[items[0]]
+        distances = np.bitwise_count(hashes[items] ^ representative).sum(axis=1)
+        for item, distance in zip(items, distances.tolist()):
+            cluster_members.append(
+                ClusterMember(
+                    cluster_id=cluster_id,
+                    cluster_size=len(items),
+                    image_path=paths[item],
+                    hash=serialize_hash(unpack_hash(PackedCompositeHash(parts=tuple(hashes[item].tolist())))),
+                    category=categorize_distance(distance, identity_threshold, similarity_threshold),
+                    distance=distance,
+                )
+            )
+
+    return cluster_members
+
+
+def write_clusters_to_csv(cluster_members: Iterable[ClusterMember], output_file: str) -> None:
+    with open(output_file, "w", newline="") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=CLUSTER_FIELDS)
+        writer.writeheader()
+        for member in cluster_members:
+            writer.writerow(member._asdict())
+
+
+@main_try_except_wrapper(logger=lgr)
+def main(
+    input_path: str,
+    output_file: str,
+    identity_threshold: int,
+    similarity_threshold: int,
+    include_similar: bool,
+    lsh_tables: int,
+    lsh_bits: int,
+    lsh_window: int,
+    workers: int,
+    chunk_size: int,
+    fast_decode: bool,
+    cache_file: str,
+    no_cache: bool,
+    rebuild_cache: bool,
+    cache_digest: bool,
+    cache_max_entries: int,
+    max_pixels: int = DEFAULT_MAX_PIXELS,
+    oversize: TOversizePolicy = "downsample",
+) -> None:
+    """
+    Find clusters of duplicate and near-duplicate images among the images listed in a file or found in a directory,
+    and write them to a CSV file. Hashes of unchanged images are served from the image cache unless `no_cache` is set.
+    Images above `max_pixels` are downsampled or skipped according to `oversize`, see `DecodePolicy`.
+    """
+    lgr.info(f"Hashing and clustering images from '{input_path}' with {workers} workers...")
+
+    cache = open_image_cache(cache_file, no_cache, rebuild_cache, cache_digest, cache_max_entries)
+    try:
+        policy = DecodePolicy(max_pixels=max_pixels, oversize=oversize)
+        results = hash_images(iter_image_paths(input_path), workers, chunk_size, fast_decode, cache, policy)
+        cluster_members = cluster_hashes(
+            results, identity_threshold, similarity_threshold, include_similar, lsh_tables, lsh_bits, lsh_window
+        )
+    finally:
+        if cache is not None:
+            cache.close()
+
+    write_clusters_to_csv(cluster_members, output_file)
+
+    cluster_count = len({member.cluster_id for member in cluster_members})
+    lgr.info(f"{cluster_count} clusters of {len(cluster_members)} images written to '{output_file}'")
+
+
+def cli() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Find clusters of duplicate and near-duplicate images.")
+
+    parser.add_argument(
+        "-i",
+        "--input_path",
+        type=str,
+        required=True,
+        help="Path to a file containing image paths, one per line, or to a directory to walk.",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output_file",
+        type=str,
+        required=True,
+        help="Path to the output CSV file, one row per image in a cluster.",
+    )
+
+    parser.add_argument(
+        "--identity_threshold",
+        type=int,
+        default=DEFAULT_IDENTITY_THRESHOLD,
+        help="Maximum averaged Hamming distance for images to be considered identical.",
+    )
+
+    parser.add_argument(
+        "--similarity_threshold",
+        type=int,
+        default=DEFAULT_SIMILARITY_THRESHOLD,
+        help="Maximum averaged Hamming distance for images to be considered similar.",
+    )
+
+    parser.add_argument(
+        "--include_similar",
+        action="store_true",
+        help="Also cluster similar images, not only identical ones.",
+    )
+
+    parser.add_argument(
+        "--lsh_tables",
+        type=int,
+        default=DEFAULT_LSH_TABLES,
+        help="Number of LSH tables. Raise it with --include_similar, so that fewer pairs at the threshold are missed.",
+    )
+
+    parser.add_argument(
+        "--lsh_bits",
+        type=int,
+        default=DEFAULT_LSH_BITS,
+        help=f"Number of sampled bits keying each LSH table, from 1 to {MAX_LSH_BITS}.",
+    )
+
+    parser.add_argument(
+        "--lsh_window",
+        type=int,
+        default=DEFAULT_LSH_WINDOW,
+        help="Number of next hashes each hash is compared with in an LSH bucket, which bounds the cost of huge buckets.",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes hashing images. Defaults to the number of CPUs.",
+    )
+
+    parser.add_argument(
+        "-c",
+        "--chunk_size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="Number of images sent to a worker at once.",
+    )
+
+    parser.add_argument(
+        "--fast_decode",
+        action="store_true",
+        help="Decode images at reduced resolution. Faster, but hashes are not bit-identical to the exact ones.",
+    )
+
+    add_decode_arguments(parser)
+    add_cache_arguments(parser)
+
+    args = parser.parse_args()
+
+    result = main(
+        input_path=args.input_path,
+        output_file=args.output_file,
+        identity_threshold=args.identity_threshold,
+        similarity_threshold=args.similarity_threshold,
+        include_similar=args.include_similar,
+        lsh_tables=args.lsh_tables,
+        lsh_bits=args.lsh_bits,
+        lsh_window=args.lsh_window,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        fast_decode=args.fast_decode,
+        cache_file=args.cache_file,
+        no_cache=args.no_cache,
+        rebuild_cache=args.rebuild_cache,
+        cache_digest=args.cache_digest,
+        cache_max_entries=args.cache_max_entries,
+        max_pixels=args.max_pixels,
+        oversize=args.oversize,
+    )
+
+    match result:
+        case Ok(out=_):
+            pass
+        case Err(err):
+            lgr.error(f"Error: {err}")
+
+
+if __name__ == "__main__":
+    cli()
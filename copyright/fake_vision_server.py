@@ -0,0 +1,121 @@
+import asyncio
+import base64
+import hashlib
+import random
+from typing import Any, Dict, List
+
+from aiohttp import web
+
+from aletk.utils import get_logger
+from check_google_vision import ANNOTATE_PATH, MAX_IMAGES_PER_REQUEST
+
+lgr = get_logger(__name__)
+
+DEFAULT_PORT = 8765
+
+
+def _fake_web_detection(content: bytes, max_results: int) -> Dict[str, Any]:
+    # Deterministic per image: about half of the images have matches, named after their digest
+    digest = hashlib.blake2b(content, digest_size=8).hexdigest()
+    if int(digest[0], 16) % 2:
+        return {}
+
+    count = min(max_results, 1 + int(digest[1], 16) % 3)
+    return {
+        "fullMatchingImages": [{"url": f"https://example.org/{digest}/{i}.jpg"} for i in range(count)],
+        "pagesWithMatchingImages": [{"url": f"https://example.org/{digest}/page.html"}],
+    }
+
+
+class FakeVisionServer:
+    """
+    Local stand-in for the Vision `images:annotate` endpoint, answering web detection requests offline.
+
+    Failures are injected at random: a share `rate_limited` of the requests is answered with 429 and a Retry-After of
+    `retry_after` seconds, and a share `failures` with 503. Every answer is delayed by `latency` seconds.
+    """
+
+    def __init__(
+        self, rate_limited: float = 0.0, failures: float = 0.0, retry_after: float = 1.0, latency: float = 0.0
+    ) -> None:
+        self.rate_limited = rate_limited
+        self.failures = failures
+        self.retry_after = retry_after
+        self.latency = latency
+        self.requests = 0
+        self.images = 0
+        self.max_in_flight = 0
+        self._in_flight = 0
+
+    async def annotate(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        self._in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self._in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+
+            draw = random.random()
+            if draw < self.rate_limited:
+                return web.json_response(
+                    {"error": {"code": 429, "message": "Quota exceeded", "status": "RESOURCE_EXHAUSTED"}},
+                    status=429,
+                    headers={"Retry-After": f"{self.retry_after:g}"},
+                )
+            if draw < self.rate_limited + self.failures:
+                return web.json_response({"error": {"code": 503, "status": "UNAVAILABLE"}}, status=503)
+
+            body = await request.json()
+            image_requests: List[Dict[str, Any]] = body.get("requests", [])
+            if not 0 < len(image_requests) <= MAX_IMAGES_PER_REQUEST:
+                return web.json_response(
+                    {"error": {"code": 400, "message": f"Invalid number of images: {len(image_requests)}"}},
+                    status=400,
+                )
+
+            responses = []
+            for image_request in image_requests:
+                self.images += 1
+                try:
+                    content = base64.b64decode(image_request["image"]["content"], validate=True)
+                    max_results = int(image_request["features"][0].get("maxResults", 10))
+                except (KeyError, IndexError, ValueError) as e:
+                    responses.append({"error": {"code": 3, "message": f"Bad image request: {e}"}})
+                    continue
+
+                responses.append({"webDetection": _fake_web_detection(content, max_results)})
+
+            return web.json_response({"responses": responses})
+
+        finally:
+            self._in_flight -= 1
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=16 * 2**20)
+        app.router.add_post(ANNOTATE_PATH, self.annotate)
+        return app
+
+
+def cli() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve a fake Google Vision API, to run web detection offline.")
+
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on, on localhost.")
+    parser.add_argument(
+        "--rate_limited", type=float, default=0.0, help="Share of the requests answered with 429 Too Many Requests."
+    )
+    parser.add_argument(
+        "--failures", type=float, default=0.0, help="Share of the requests answered with 503 Service Unavailable."
+    )
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Retry-After of the 429 answers, in seconds.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Delay of every answer, in seconds.")
+
+    args = parser.parse_args()
+
+    server = FakeVisionServer(args.rate_limited, args.failures, args.retry_after, args.latency)
+    lgr.info(f"Serving a fake Vision API on http://127.0.0.1:{args.port}{ANNOTATE_PATH}")
+    web.run_app(server.app(), host="127.0.0.1", port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    cli()
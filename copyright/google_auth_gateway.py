@@ -1,10 +1,29 @@
 import os
+from typing import Sequence
+
+import google.auth
+from google.auth.credentials import Credentials
+from google.oauth2 import service_account
 
 
 def authenticate_google(json_key_filepath: str) -> None:
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = json_key_filepath
 
 
+def google_credentials(json_key_filepath: str, scopes: Sequence[str]) -> Credentials:
+    """
+    Credentials of a service account key file, or the application default credentials if `json_key_filepath` is
+    empty. They still have to be refreshed before use.
+    """
+    if json_key_filepath:
+        from_file = service_account.Credentials.from_service_account_file
+        key_credentials: Credentials = from_file(json_key_filepath, scopes=scopes)  # type: ignore[no-untyped-call]
+        return key_credentials
+
+    credentials, _ = google.auth.default(scopes=scopes)
+    return credentials
+
+
 def main(
     json_key_filepath: str,
 ) -> None:
@@ -0,0 +1,284 @@
+import heapq
+import os
+import pickle
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Tuple
+
+from image_hashing import (
+    COMPOSITE_HASH_LENGTH,
+    HashMatch,
+    KnownImage,
+    KnownImageComparison,
+    PackedCompositeHash,
+    PackedKnownImage,
+    SINGLE_HASH_BITS,
+    TAlgorithmThresholds,
+    TCompositeHash,
+    categorize_distance,
+    compute_composite_hash,
+    fname,
+    pack_hash,
+    packed_hash_key,
+)
+
+INDEX_FORMAT_VERSION = 2
+
+
+class CatalogueStamp(NamedTuple):
+    """
+    Identity of the catalogue an index was built from, to tell whether the index is still up to date.
+    """
+
+    path: str
+    size: int
+    mtime_ns: int
+
+
+def catalogue_stamp(file_path: str) -> CatalogueStamp:
+    stat = os.stat(file_path)
+    return CatalogueStamp(path=os.path.abspath(file_path), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+def _key_distance(key1: int, key2: int) -> int:
+    return (key1 ^ key2).bit_count()
+
+
+_SINGLE_HASH_MASK = (1 << SINGLE_HASH_BITS) - 1
+
+
+def _within_algorithm_thresholds(key1: int, key2: int, algorithm_thresholds: TAlgorithmThresholds) -> bool:
+    # The first sub-hash holds the most significant bits of a key, see `packed_hash_key`
+    xor = key1 ^ key2
+    for i, threshold in enumerate(algorithm_thresholds):
+        shift = (COMPOSITE_HASH_LENGTH - 1 - i) * SINGLE_HASH_BITS
+        if ((xor >> shift) & _SINGLE_HASH_MASK).bit_count() > threshold:
+            return False
+
+    return True
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over composite hash keys, using the total Hamming distance as metric.
+
+    Nodes are kept in flat lists (node index -> key / ids / children) so that deep trees never hit the recursion
+    limit and the whole index pickles cheaply. Images with the exact same key share a node.
+    """
+
+    __slots__ = ("_keys", "_ids", "_children")
+
+    def __init__(self) -> None:
+        self._keys: List[int] = []
+        self._ids: List[List[str]] = []
+        self._children: List[Dict[int, int]] = []
+
+    def __len__(self) -> int:
+        return sum(len(ids) for ids in self._ids)
+
+    def _new_node(self, key: int, image_id: str) -> int:
+        self._keys.append(key)
+        self._ids.append([image_id])
+        self._children.append({})
+        return len(self._keys) - 1
+
+    def add(self, key: int, image_id: str) -> None:
+        if not self._keys:
+            self._new_node(key, image_id)
+            return
+
+        node = 0
+        while True:
+            distance = _key_distance(key, self._keys[node])
+            if distance == 0:
+                self._ids[node].append(image_id)
+                return
+
+            children = self._children[node]
+            child = children.get(distance)
+            if child is None:
+                children[distance] = self._new_node(key, image_id)
+                return
+
+            node = child
+
+    def search(self, key: int, max_distance: int) -> List[Tuple[str, int]]:
+        """
+        Return all (image id, total distance) pairs within `max_distance` of `key`.
+
+        Thanks to the triangle inequality, only children whose edge distance lies in
+        [d - max_distance, d + max_distance] can contain matches, so most of the tree is never visited.
+        """
+        if not self._keys:
+            return []
+
+        found: List[Tuple[str, int]] = []
+        pending = [0]
+        while pending:
+            node = pending.pop()
+            distance = _key_distance(key, self._keys[node])
+            if distance <= max_distance:
+                found.extend((image_id, distance) for image_id in self._ids[node])
+
+            low = distance - max_distance
+            high = distance + max_distance
+            pending.extend(child for edge, child in self._children[node].items() if low <= edge <= high)
+
+        return found
+
+    def nearest(
+        self, key: int, k: int, max_distance: int, accept: Callable[[int], bool] | None = None
+    ) -> List[Tuple[str, int]]:
+        """
+        Return the `k` (image id, total distance) pairs closest to `key` within `max_distance`, sorted by distance.
+
+        The candidates are kept in a bounded max-heap. Once it holds `k` of them, the search radius shrinks to the
+        distance of the worst one, pruning every subtree that could only hold farther images.
+
+        With `accept`, only nodes whose key it accepts are candidates. Their subtrees are still searched.
+        """
+        if k < 1:
+            raise ValueError(f"{fname()}::k must be at least 1, got {k}")
+        if not self._keys:
+            return []
+
+        # Max-heap on the distance, through negated distances
+        heap: List[Tuple[int, str]] = []
+        radius = max_distance
+        pending = [0]
+        while pending:
+            node = pending.pop()
+            distance = _key_distance(key, self._keys[node])
+            if distance <= radius and (accept is None or accept(self._keys[node])):
+                for image_id in self._ids[node]:
+                    if len(heap) < k:
+                        heapq.heappush(heap, (-distance, image_id))
+                    elif -distance > heap[0][0]:
+                        heapq.heapreplace(heap, (-distance, image_id))
+                if len(heap) == k:
+                    radius = min(radius, -heap[0][0])
+
+            low = distance - radius
+            high = distance + radius
+            pending.extend(child for edge, child in self._children[node].items() if low <= edge <= high)
+
+        return sorted(((image_id, -negated) for negated, image_id in heap), key=lambda match: (match[1], match[0]))
+
+
+def build_known_image_index(known_images: Iterable[KnownImage | PackedKnownImage]) -> BKTree:
+    """
+    Build a BK-tree index over known image hashes.
+
+    :param known_images: Known images with their composite hashes.
+    :return: Index to be reused across queries.
+    """
+    index = BKTree()
+    for img in known_images:
+        packed = img.hash if isinstance(img.hash, PackedCompositeHash) else pack_hash(img.hash)
+        index.add(packed_hash_key(packed), img.id)
+
+    return index
+
+
+def save_known_image_index(index: BKTree, file_path: str, stamp: CatalogueStamp | None = None) -> None:
+    """
+    Save an index, along with the stamp of the catalogue it was built from, if any.
+    """
+    with Path(file_path).open("wb") as file:
+        pickle.dump((INDEX_FORMAT_VERSION, stamp, index._keys, index._ids, index._children), file)
+
+
+def load_known_image_index(file_path: str) -> Tuple[BKTree, CatalogueStamp | None]:
+    """
+    Load an index saved by `save_known_image_index`, and the stamp of the catalogue it was built from.
+    """
+    with Path(file_path).open("rb") as file:
+        version, *contents = pickle.load(file)
+
+    if version != INDEX_FORMAT_VERSION:
+        raise ValueError(
+            f"{fname()}::Unsupported index format version {version}, expected {INDEX_FORMAT_VERSION}. "
+            "Remove the index file to build it again."
+        )
+
+    stamp, keys, ids, children = contents
+    index = BKTree()
+    index._keys, index._ids, index._children = keys, ids, children
+
+    return index, stamp
+
+
+def indexed_hash_categorizations(
+    source_hash: TCompositeHash | PackedCompositeHash,
+    index: BKTree,
+    identity_threshold: int,
+    similarity_threshold: int,
+) -> KnownImageComparison:
+    """
+    Compare a source hash against an index of known images, returning only the identical and similar ones.
+
+    Same categories as `all_hash_categorizations`, except that 'different' images are never visited and therefore
+    not part of the result.
+
+    :param source_hash: Composite hash of the source image.
+    :param index: Index built with `build_known_image_index`.
+    :param identity_threshold: Threshold for identical images.
+    :param similarity_threshold: Threshold for similar images.
+    :return: Dictionary with image IDs as keys and comparison results as values.
+    """
+    packed = source_hash if isinstance(source_hash, PackedCompositeHash) else pack_hash(source_hash)
+    matches = index.search(packed_hash_key(packed), similarity_threshold * COMPOSITE_HASH_LENGTH)
+
+    return {
+        image_id: categorize_distance(distance, identity_threshold, similarity_threshold)
+        for image_id, distance in matches
+    }
+
+
+def indexed_top_k_matches(
+    source_hash: TCompositeHash | PackedCompositeHash,
+    index: BKTree,
+    k: int,
+    identity_threshold: int,
+    similarity_threshold: int,
+    algorithm_thresholds: TAlgorithmThresholds | None = None,
+) -> List[HashMatch]:
+    """
+    Indexed counterpart of `catalogue_top_k_matches`: the `k` known images closest to the source hash, among the
+    identical and similar ones, sorted by increasing distance.
+    """
+    packed = source_hash if isinstance(source_hash, PackedCompositeHash) else pack_hash(source_hash)
+    key = packed_hash_key(packed)
+
+    accept = None
+    if algorithm_thresholds is not None:
+        if len(algorithm_thresholds) != COMPOSITE_HASH_LENGTH:
+            raise ValueError(
+                f"{fname()}::Expected {COMPOSITE_HASH_LENGTH} per-algorithm thresholds, got {len(algorithm_thresholds)}"
+            )
+        accept = partial(_within_algorithm_thresholds, key, algorithm_thresholds=algorithm_thresholds)
+
+    matches = index.nearest(key, k, similarity_threshold * COMPOSITE_HASH_LENGTH, accept)
+
+    return [
+        HashMatch(
+            image_id=image_id,
+            distance=distance,
+            category=categorize_distance(distance, identity_threshold, similarity_threshold),
+        )
+        for image_id, distance in matches
+    ]
+
+
+def indexed_image_categorizations(
+    source_image_path: str,
+    index: BKTree,
+    identity_threshold: int,
+    similarity_threshold: int,
+) -> KnownImageComparison:
+    """
+    Same as `indexed_hash_categorizations`, computing the source hash from the image first.
+    """
+    source_hash = compute_composite_hash(source_image_path)
+
+    return indexed_hash_categorizations(source_hash, index, identity_threshold, similarity_threshold)
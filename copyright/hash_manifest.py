@@ -0,0 +1,305 @@
+import mmap
+import struct
+from array import array
+from pathlib import Path
+from typing import Generator, Iterable, Iterator, List, NamedTuple, Sequence, Tuple, overload
+
+import numpy as np
+
+from aletk.utils import get_logger
+from aletk.ResultMonad import main_try_except_wrapper, Ok, Err
+from image_hashing import (
+    COMPOSITE_HASH_LENGTH,
+    KnownHashCatalogue,
+    PackedCompositeHash,
+    THashMatrix,
+    deserialize_hash,
+    fname,
+    pack_hash,
+    serialize_hash,
+    unpack_hash,
+)
+from image_metadata_io import CopyrightedImage, read_known_copyrighted_images
+
+lgr = get_logger(__name__)
+
+MANIFEST_EXTENSION = ".chash"
+
+MANIFEST_MAGIC = b"CHASHMF\x00"
+MANIFEST_FORMAT_VERSION = 1
+
+STRING_COLUMNS = ("id", "original_name", "link")
+
+# Little-endian throughout: magic, version, hash length, entry count, then the data length of each string column
+_HEADER = struct.Struct(f"<8sIIQ{len(STRING_COLUMNS)}Q")
+
+_WORD = 8
+
+# Layout of a manifest file, every section starting at a multiple of 8 bytes:
+#
+#   header
+#   hashes        uint64[count, hash length], one packed composite hash per row
+#   for each string column:
+#       offsets   uint64[count + 1], entry `i` spanning data[offsets[i]:offsets[i + 1]]
+#       data      concatenated UTF-8 strings, zero-padded to a multiple of 8 bytes
+
+
+def _padded(length: int) -> int:
+    return -(-length // _WORD) * _WORD
+
+
+class ManifestEntry(NamedTuple):
+    id: str
+    hash: PackedCompositeHash
+    original_name: str
+    link: str
+
+
+class StringColumn(Sequence[str]):
+    """
+    Read-only column of strings stored as an offsets array and a UTF-8 data section. Only the requested entries are
+    ever decoded.
+    """
+
+    __slots__ = ("_buffer", "_offsets", "_data_start")
+
+    def __init__(self, buffer: mmap.mmap, offsets: np.ndarray, data_start: int) -> None:
+        self._buffer = buffer
+        self._offsets = offsets
+        self._data_start = data_start
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __iter__(self) -> Iterator[str]:
+        # Faster than the default index by index iteration, which bounds-checks every access
+        offsets = self._offsets.tolist()
+        data = self._buffer
+        base = self._data_start
+        for start, end in zip(offsets, offsets[1:]):
+            yield data[base + start : base + end].decode("utf-8")
+
+    @overload
+    def __getitem__(self, index: int) -> str: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[str]: ...
+
+    def __getitem__(self, index: int | slice) -> str | List[str]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"{fname()}::Index {index} out of range for a column of {len(self)} entries")
+
+        start = self._data_start + int(self._offsets[index])
+        end = self._data_start + int(self._offsets[index + 1])
+
+        return self._buffer[start:end].decode("utf-8")
+
+
+class HashManifest:
+    """
+    Known copyrighted images loaded from a manifest file.
+
+    The file is memory-mapped and every column is a view over the mapping, so loading costs the same whatever the
+    number of entries, and pages are only read from disk once accessed. The mapping is released when the manifest
+    and all the columns taken from it are garbage collected.
+    """
+
+    __slots__ = ("path", "hashes", "ids", "original_names", "links")
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+        with open(path, "rb") as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(buffer) < _HEADER.size:
+            raise ValueError(f"{fname()}::'{path}' is too small to be a hash manifest")
+
+        magic, version, hash_length, count, *data_lengths = _HEADER.unpack_from(buffer)
+        if magic != MANIFEST_MAGIC:
+            raise ValueError(f"{fname()}::'{path}' is not a hash manifest")
+        if version != MANIFEST_FORMAT_VERSION:
+            raise ValueError(
+                f"{fname()}::Unsupported hash manifest version {version} in '{path}', expected {MANIFEST_FORMAT_VERSION}"
+            )
+        if hash_length != COMPOSITE_HASH_LENGTH:
+            raise ValueError(
+                f"{fname()}::Hash manifest '{path}' holds composite hashes of length {hash_length}, "
+                f"expected {COMPOSITE_HASH_LENGTH}"
+            )
+
+        position = _HEADER.size
+        self.hashes: THashMatrix = np.frombuffer(
+            buffer, dtype="<u8", count=count * hash_length, offset=position
+        ).reshape(count, hash_length)
+        position += count * hash_length * _WORD
+
+        columns = []
+        for data_length in data_lengths:
+            offsets = np.frombuffer(buffer, dtype="<u8", count=count + 1, offset=position)
+            position += (count + 1) * _WORD
+            columns.append(StringColumn(buffer, offsets, position))
+            position += _padded(data_length)
+
+        if position != len(buffer):
+            raise ValueError(
+                f"{fname()}::Hash manifest '{path}' is {len(buffer)} bytes long, expected {position}. Truncated file?"
+            )
+
+        self.ids, self.original_names, self.links = columns
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def catalogue(self) -> KnownHashCatalogue:
+        """
+        The manifest as a catalogue for the batch comparison functions, without copying anything.
+        """
+        return KnownHashCatalogue(ids=self.ids, hashes=self.hashes)
+
+    def entry(self, index: int) -> ManifestEntry:
+        return ManifestEntry(
+            id=self.ids[index],
+            hash=PackedCompositeHash(parts=tuple(int(part) for part in self.hashes[index])),
+            original_name=self.original_names[index],
+            link=self.links[index],
+        )
+
+
+def write_hash_manifest(entries: Iterable[ManifestEntry], output_file: str) -> int:
+    """
+    Write known copyrighted images to a manifest file. The file is first written next to the target, then moved
+    into place, so that readers never see a partial manifest.
+
+    :param entries: Images to write, in the order they get their row in the manifest.
+    :param output_file: Path to the manifest file.
+    :return: Number of written entries.
+    """
+    hash_parts = array("Q")
+    columns: Tuple[bytearray, ...] = tuple(bytearray() for _ in STRING_COLUMNS)
+    offsets: Tuple[array[int], ...] = tuple(array("Q", [0]) for _ in STRING_COLUMNS)
+
+    count = 0
+    for entry in entries:
+        if len(entry.hash.parts) != COMPOSITE_HASH_LENGTH:
+            raise ValueError(
+                f"{fname()}::Invalid composite hash for image '{entry.id}', expected {COMPOSITE_HASH_LENGTH} parts, "
+                f"got {len(entry.hash.parts)}"
+            )
+        hash_parts.extend(entry.hash.parts)
+
+        for data, column_offsets, value in zip(columns, offsets, (entry.id, entry.original_name, entry.link)):
+            data += value.encode("utf-8")
+            column_offsets.append(len(data))
+
+        count += 1
+
+    header = _HEADER.pack(
+        MANIFEST_MAGIC, MANIFEST_FORMAT_VERSION, COMPOSITE_HASH_LENGTH, count, *(len(data) for data in columns)
+    )
+
+    output_path = Path(output_file)
+    tmp_path = output_path.with_name(f".{output_path.name}.tmp")
+    with tmp_path.open("wb") as file:
+        file.write(header)
+        file.write(np.asarray(hash_parts, dtype="<u8").tobytes())
+        for data, column_offsets in zip(columns, offsets):
+            file.write(np.asarray(column_offsets, dtype="<u8").tobytes())
+            file.write(data)
+            file.write(b"\x00" * (_padded(len(data)) - len(data)))
+    tmp_path.replace(output_path)
+
+    return count
+
+
+def iter_manifest_images(manifest: HashManifest) -> Generator[CopyrightedImage, None, None]:
+    """
+    Yield the entries of a manifest as `CopyrightedImage`s. They were validated when the manifest was written.
+    """
+    for index in range(len(manifest)):
+        entry = manifest.entry(index)
+        yield CopyrightedImage.model_construct(
+            id=entry.id,
+            hash=serialize_hash(unpack_hash(entry.hash)),
+            original_name=entry.original_name,
+            link=entry.link,
+        )
+
+
+def _manifest_entries(images: Iterable[CopyrightedImage]) -> Generator[ManifestEntry, None, None]:
+    for image in images:
+        yield ManifestEntry(
+            id=image.id,
+            hash=pack_hash(deserialize_hash(image.hash)),
+            original_name=image.original_name,
+            link=image.link,
+        )
+
+
+@main_try_except_wrapper(logger=lgr)
+def convert(input_file: str, output_file: str) -> None:
+    """
+    Convert a known copyrighted images catalogue, e.g. a CSV file, to a manifest file.
+    """
+    images, amount_of_rows = read_known_copyrighted_images(input_file)
+    lgr.info(f"Converting {amount_of_rows} known images from '{input_file}' to '{output_file}'...")
+
+    count = write_hash_manifest(_manifest_entries(images), output_file)
+
+    lgr.info(f"{count} known images written to '{output_file}'")
+
+
+@main_try_except_wrapper(logger=lgr)
+def info(input_file: str) -> None:
+    manifest = HashManifest(input_file)
+    print(f"{input_file}: hash manifest version {MANIFEST_FORMAT_VERSION}, {len(manifest)} known images")
+
+
+def cli() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description=f"Manage '{MANIFEST_EXTENSION}' known copyrighted image manifests.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = subparsers.add_parser("convert", help="Convert a CSV catalogue of known images to a manifest.")
+    convert_parser.add_argument(
+        "-i",
+        "--input_file",
+        type=str,
+        required=True,
+        help="Path to the catalogue to convert, in the CopyrightedImage CSV schema.",
+    )
+    convert_parser.add_argument(
+        "-o",
+        "--output_file",
+        type=str,
+        default="",
+        help=f"Path to the output manifest. Defaults to the input file with the '{MANIFEST_EXTENSION}' extension.",
+    )
+
+    info_parser = subparsers.add_parser("info", help="Print the version and size of a manifest.")
+    info_parser.add_argument("-i", "--input_file", type=str, required=True, help="Path to the manifest.")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "convert":
+            output_file = args.output_file or str(Path(args.input_file).with_suffix(MANIFEST_EXTENSION))
+            result = convert(input_file=args.input_file, output_file=output_file)
+        case _:
+            result = info(input_file=args.input_file)
+
+    match result:
+        case Ok(out=_):
+            pass
+        case Err(err):
+            lgr.error(f"Error: {err}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,338 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from types import TracebackType
+from typing import BinaryIO, Tuple, Type
+
+from base_types import ExifReport
+from image_decoding import DEFAULT_DECODE_POLICY, DecodePolicy
+from image_hashing import TCompositeHash, deserialize_hash, serialize_hash
+
+DEFAULT_CACHE_FILE = str(Path.home() / ".cache" / "philosophie-copyright" / "image_cache.sqlite3")
+
+DEFAULT_MAX_ENTRIES = 2_000_000
+
+# Writes are grouped in transactions of this many statements
+COMMIT_INTERVAL = 500
+
+DIGEST_BLOCK_SIZE = 1 << 20
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_cache (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    composite_hash TEXT,
+    hash_fast_decode INTEGER,
+    hash_max_pixels INTEGER,
+    exif_copyright TEXT,
+    exif_status TEXT,
+    exif_error_message TEXT,
+    exif_error_context TEXT,
+    last_access INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS image_cache_digest ON image_cache (size, digest) WHERE digest != '';
+CREATE INDEX IF NOT EXISTS image_cache_last_access ON image_cache (last_access);
+"""
+
+_HASH_COLUMNS = ("composite_hash", "hash_fast_decode", "hash_max_pixels")
+_EXIF_COLUMNS = ("exif_copyright", "exif_status", "exif_error_message", "exif_error_context")
+_CACHED_COLUMNS = _HASH_COLUMNS + _EXIF_COLUMNS
+
+
+@dataclass(frozen=True, slots=True)
+class FileFingerprint:
+    path: str
+    size: int
+    mtime_ns: int
+    digest: str
+
+
+def file_digest(file: BinaryIO) -> str:
+    """
+    Digest of the contents of a file opened in binary mode. The file is rewound before and after.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    file.seek(0)
+    while block := file.read(DIGEST_BLOCK_SIZE):
+        h.update(block)
+    file.seek(0)
+
+    return h.hexdigest()
+
+
+def fingerprint_file(path: str, use_digest: bool = False, file: BinaryIO | None = None) -> FileFingerprint:
+    """
+    Fingerprint a file by path, or through its already opened handle to spare a second path lookup. The path is made
+    absolute, so that relative and absolute invocations share cache entries.
+    """
+    if file is not None:
+        stat = os.fstat(file.fileno())
+        digest = file_digest(file) if use_digest else ""
+    else:
+        stat = os.stat(path)
+        if use_digest:
+            with open(path, "rb") as f:
+                digest = file_digest(f)
+        else:
+            digest = ""
+
+    return FileFingerprint(path=os.path.abspath(path), size=stat.st_size, mtime_ns=stat.st_mtime_ns, digest=digest)
+
+
+class ImageCache:
+    """
+    Local SQLite cache of composite hashes and EXIF reports, keyed by (path, size, mtime_ns).
+
+    With `use_digest`, a content digest of the file is also stored and must match. It then doubles as a
+    content-addressed key: a file that was copied, moved or touched without being modified is still a hit.
+
+    Only successful results are cached, so that transient errors are retried on the next run. The least recently
+    used entries beyond `max_entries` are evicted on `close()`.
+    """
+
+    def __init__(self, db_path: str, max_entries: int = DEFAULT_MAX_ENTRIES, use_digest: bool = False) -> None:
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+
+        self.max_entries = max_entries
+        self.use_digest = use_digest
+        self._now = int(time.time())
+        self._pending_writes = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+
+        # Caches created before hashes recorded their pixel limit. Their hashes, which may have been downsampled, are
+        # then never served, and are replaced as the images are hashed again.
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(image_cache)")}
+        if "hash_max_pixels" not in columns:
+            self._connection.execute("ALTER TABLE image_cache ADD COLUMN hash_max_pixels INTEGER")
+
+    def __enter__(self) -> "ImageCache":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Type[BaseException] | None,
+        exc_value: BaseException | None,
+        exc_traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def fingerprint(self, path: str, file: BinaryIO | None = None) -> FileFingerprint:
+        """
+        Fingerprint a file as `fingerprint_file` does, with a digest if the cache uses them.
+        """
+        return fingerprint_file(path, self.use_digest, file)
+
+    def _write(self, statement: str, parameters: Tuple[object, ...]) -> None:
+        # Must be called with the lock held
+        self._connection.execute(statement, parameters)
+        self._pending_writes += 1
+        if self._pending_writes >= COMMIT_INTERVAL:
+            self._connection.commit()
+            self._pending_writes = 0
+
+    def _lookup(self, fp: FileFingerprint, columns: str) -> Tuple[str, Tuple[object, ...]] | None:
+        # Must be called with the lock held. Returns the path of the matching entry and the requested columns.
+        row = self._connection.execute(
+            f"SELECT path, {columns} FROM image_cache WHERE path = ? AND size = ? AND mtime_ns = ? AND digest = ?",
+            (fp.path, fp.size, fp.mtime_ns, fp.digest),
+        ).fetchone()
+
+        if row is None and fp.digest:
+            row = self._connection.execute(
+                f"SELECT path, {columns} FROM image_cache WHERE size = ? AND digest = ? LIMIT 1",
+                (fp.size, fp.digest),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        self._write("UPDATE image_cache SET last_access = ? WHERE path = ?", (self._now, row[0]))
+
+        return row[0], tuple(row[1:])
+
+    def _upsert(self, fp: FileFingerprint, columns: Tuple[str, ...], values: Tuple[object, ...]) -> None:
+        # Must be called with the lock held. An entry whose file changed is reset before the new columns are set.
+        self._write(
+            f"""
+            INSERT INTO image_cache (path, size, mtime_ns, digest, last_access) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET
+                size = excluded.size,
+                mtime_ns = excluded.mtime_ns,
+                digest = excluded.digest,
+                {", ".join(f"{column} = NULL" for column in _CACHED_COLUMNS)}
+            WHERE size != excluded.size OR mtime_ns != excluded.mtime_ns OR digest != excluded.digest
+            """,
+            (fp.path, fp.size, fp.mtime_ns, fp.digest, self._now),
+        )
+        self._write(
+            f"UPDATE image_cache SET last_access = ?, {", ".join(f"{column} = ?" for column in columns)} WHERE path = ?",
+            (self._now,) + values + (fp.path,),
+        )
+
+    def get_hash(
+        self, fp: FileFingerprint, fast_decode: bool = False, policy: DecodePolicy = DEFAULT_DECODE_POLICY
+    ) -> TCompositeHash | None:
+        """
+        The cached hash of the file, if it was computed with the same `fast_decode`, and at full scale or downsampled
+        to the same pixel limit as `policy` would.
+        """
+        with self._lock:
+            found = self._lookup(fp, ", ".join(_HASH_COLUMNS))
+
+        if found is None:
+            return None
+
+        cached_path, (composite_hash, hash_fast_decode, hash_max_pixels) = found
+        if composite_hash is None or bool(hash_fast_decode) != fast_decode or hash_max_pixels is None:
+            return None
+
+        # 0 for hashes computed at full scale, valid whatever the policy
+        downsampled = hash_max_pixels != 0
+        if downsampled and (policy.oversize != "downsample" or hash_max_pixels != policy.max_pixels):
+            return None
+
+        hash = deserialize_hash(f"{composite_hash}")
+        if cached_path != fp.path:
+            self.put_hash(fp, hash, fast_decode, policy, downsampled)
+
+        return hash
+
+    def put_hash(
+        self,
+        fp: FileFingerprint,
+        hash: TCompositeHash,
+        fast_decode: bool = False,
+        policy: DecodePolicy = DEFAULT_DECODE_POLICY,
+        downsampled: bool = False,
+    ) -> None:
+        """
+        Cache the hash of the file. If the image was `downsampled` to fit the pixel limit of `policy`, the hash is only
+        served again under the same limit.
+        """
+        hash_max_pixels = policy.max_pixels if downsampled else 0
+        with self._lock:
+            self._upsert(fp, _HASH_COLUMNS, (serialize_hash(hash), int(fast_decode), hash_max_pixels))
+
+    def get_exif(self, fp: FileFingerprint) -> ExifReport | None:
+        with self._lock:
+            found = self._lookup(fp, ", ".join(_EXIF_COLUMNS))
+
+        if found is None:
+            return None
+
+        cached_path, (exif_copyright, status, error_message, error_context) = found
+        if status not in ("ok", "not_found"):
+            return None
+
+        report = ExifReport(
+            exif_copyright=f"{exif_copyright}",
+            status="ok" if status == "ok" else "not_found",
+            error_message=f"{error_message}",
+            error_context=f"{error_context}",
+        )
+        if cached_path != fp.path:
+            self.put_exif(fp, report)
+
+        return report
+
+    def put_exif(self, fp: FileFingerprint, report: ExifReport) -> None:
+        if report.status not in ("ok", "not_found"):
+            return
+
+        with self._lock:
+            self._upsert(
+                fp, _EXIF_COLUMNS, (report.exif_copyright, report.status, report.error_message, report.error_context)
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM image_cache")
+            self._connection.commit()
+            self._pending_writes = 0
+
+    def evict(self) -> int:
+        """
+        Delete the least recently used entries beyond `max_entries`. Returns the number of deleted entries.
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                """
+                DELETE FROM image_cache WHERE path IN (
+                    SELECT path FROM image_cache ORDER BY last_access ASC
+                    LIMIT max(0, (SELECT count(*) FROM image_cache) - ?)
+                )
+                """,
+                (self.max_entries,),
+            )
+            self._connection.commit()
+            self._pending_writes = 0
+
+        return cursor.rowcount
+
+    def close(self) -> None:
+        self.evict()
+        with self._lock:
+            self._connection.close()
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--cache_file",
+        type=str,
+        default=DEFAULT_CACHE_FILE,
+        help=f"Path to the image cache. Defaults to '{DEFAULT_CACHE_FILE}'.",
+    )
+
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Neither read nor write the image cache.",
+    )
+
+    parser.add_argument(
+        "--rebuild_cache",
+        action="store_true",
+        help="Empty the image cache before the run, so that everything is recomputed and cached again.",
+    )
+
+    parser.add_argument(
+        "--cache_digest",
+        action="store_true",
+        help="Also key the cache on a digest of the file contents. Reads every file once, but catches in-place edits "
+        "that keep size and modification time, and reuses results for copied or moved files.",
+    )
+
+    parser.add_argument(
+        "--cache_max_entries",
+        type=int,
+        default=DEFAULT_MAX_ENTRIES,
+        help="Maximum number of cached files, the least recently used ones are evicted beyond it.",
+    )
+
+
+def open_image_cache(
+    cache_file: str, no_cache: bool, rebuild_cache: bool, use_digest: bool, max_entries: int
+) -> ImageCache | None:
+    """
+    Open the cache as requested by the `--no_cache`, `--rebuild_cache`, `--cache_digest` and `--cache_max_entries`
+    command line options.
+    """
+    if no_cache:
+        return None
+
+    cache = ImageCache(cache_file, max_entries=max_entries, use_digest=use_digest)
+    if rebuild_cache:
+        cache.clear()
+
+    return cache
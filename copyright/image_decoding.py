@@ -0,0 +1,243 @@
+import argparse
+import io
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from types import TracebackType
+from typing import Any, BinaryIO, Callable, Dict, Iterator, Literal, Tuple, Type, cast
+
+from PIL import Image
+
+# Images above this many pixels are downsampled or skipped, see `DecodePolicy`. Hashing an image at the limit peaks
+# at about 700 MB per worker, most of it for the wavelet hash, which works on the largest power of two square that
+# fits in the image, against 2.5 GB for a 100 megapixel scan decoded in full.
+DEFAULT_MAX_PIXELS = 25_000_000
+
+# Smallest side kept when decoding with `fast_decode`, well above the 32x32 pHash input
+FAST_DECODE_MIN_SIZE = 512
+
+# Reduced scales, as divisors of each side, at which JPEGs can be decoded directly
+DRAFT_SCALES = (1, 2, 4, 8)
+
+type TOversizePolicy = Literal["downsample", "skip"]
+
+
+class ImageTooLargeError(ValueError):
+    """
+    The image has more pixels than the decode policy allows, and cannot be decoded within them.
+    """
+
+
+@dataclass(frozen=True, slots=True)
+class DecodePolicy:
+    """
+    What to do with images of more than `max_pixels` pixels, the only ones the policy applies to.
+
+    With 'downsample', they are decoded at the smallest reduced scale that fits, which only JPEGs support. With
+    'skip', or for the other formats, they are not decoded at all and `ImageTooLargeError` is raised: decoding them
+    in full is what the limit is there to prevent.
+
+    Pillow's own decompression bomb check still applies on top of the policy: images of more than twice
+    `Image.MAX_IMAGE_PIXELS` pixels, about 179 megapixels, cannot be opened at all, see `open_image`.
+    """
+
+    max_pixels: int = DEFAULT_MAX_PIXELS
+    oversize: TOversizePolicy = "downsample"
+
+
+DEFAULT_DECODE_POLICY = DecodePolicy()
+
+
+@contextmanager
+def open_image(source: str | BinaryIO) -> Iterator[Image.Image]:
+    """
+    Open an image, reading its headers only, and position it on its first frame. The file is closed on exit if it
+    was opened from a path, an open file being left to its owner.
+
+    :raises ImageTooLargeError: If Pillow refuses to open the image as a decompression bomb.
+    """
+    try:
+        image = Image.open(source)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e)) from e
+
+    with image as img:
+        # Only the first frame of animations is ever decoded
+        if getattr(img, "is_animated", False):
+            img.seek(0)
+
+        yield img
+
+
+def _draft_scale(width: int, height: int, max_pixels: int) -> int | None:
+    # Smallest scale at which the image is within `max_pixels`
+    for scale in DRAFT_SCALES:
+        if -(-width // scale) * -(-height // scale) <= max_pixels:
+            return scale
+
+    return None
+
+
+def _fast_decode_scale(width: int, height: int) -> int:
+    # Largest scale keeping both sides at least `FAST_DECODE_MIN_SIZE`
+    reduction = min(width, height) // FAST_DECODE_MIN_SIZE
+    return max((scale for scale in DRAFT_SCALES if scale <= reduction), default=1)
+
+
+def decode_grayscale(
+    source: str | BinaryIO, fast_decode: bool = False, policy: DecodePolicy = DEFAULT_DECODE_POLICY
+) -> Image.Image:
+    """
+    Decode the first frame of an image in grayscale, within the pixel limit of `policy`.
+
+    Images within the limit are decoded exactly. With `fast_decode`, JPEGs are decoded at a reduced DCT scale through
+    `draft()`, and other formats are box-reduced right after decoding; the result is close to, but not bit-identical
+    with, the exact decode. Oversized images are handled as described in `DecodePolicy`.
+
+    :param source: Path of the image, or the image opened in binary mode.
+    :raises ImageTooLargeError: If the image is over the limit and cannot or must not be downsampled.
+    """
+    gray, _ = decode_grayscale_downsampling(source, fast_decode, policy)
+    return gray
+
+
+def decode_grayscale_downsampling(
+    source: str | BinaryIO, fast_decode: bool = False, policy: DecodePolicy = DEFAULT_DECODE_POLICY
+) -> Tuple[Image.Image, bool]:
+    """
+    Same as `decode_grayscale`, also telling whether the image was downsampled to fit the pixel limit of `policy`.
+    The decode, and what is derived from it, then depends on that limit.
+    """
+    # In-memory streams have no name, their owner naming the image in its own error report
+    name = source if isinstance(source, str) else getattr(source, "name", "")
+    image_name = f" '{name}'" if name else ""
+
+    with open_image(source) as img:
+        width, height = img.size
+
+        scale = 1
+        downsampled = False
+        if width * height > policy.max_pixels:
+            draft_scale = _draft_scale(width, height, policy.max_pixels)
+            if policy.oversize == "skip" or draft_scale is None or img.format != "JPEG":
+                raise ImageTooLargeError(
+                    f"Image{image_name} of {width}x{height} pixels is above the limit of {policy.max_pixels} pixels"
+                )
+            scale = draft_scale
+            downsampled = True
+
+        if fast_decode:
+            scale = max(scale, _fast_decode_scale(width, height))
+
+        # No-op for the formats other than JPEG
+        if scale > 1:
+            img.draft("L", (width // scale, height // scale))
+
+        gray = img.convert("L")
+
+    if fast_decode:
+        factor = min(gray.size) // FAST_DECODE_MIN_SIZE
+        if factor >= 2:
+            gray = gray.reduce(factor)
+
+    return gray, downsampled
+
+
+class ImageHandle:
+    """
+    An image opened once and shared by several checks, which may run concurrently in threads.
+
+    The file is opened unbuffered. With `read_contents`, it is read in full up front and each check reads it through
+    its own in-memory stream, so that concurrent checks never compete for the file position; otherwise `stream()` is
+    the file itself, for a single check. Values derived from the image, such as its decode, are computed once per
+    handle through `memo`.
+    """
+
+    def __init__(self, image_path: str, read_contents: bool = False) -> None:
+        self.image_path = image_path
+        self.file: BinaryIO = open(image_path, "rb", buffering=0)
+        try:
+            self._contents = self.file.read() if read_contents else None
+        except BaseException:
+            self.file.close()
+            raise
+
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self._values: Dict[str, Any] = {}
+
+    def __enter__(self) -> "ImageHandle":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Type[BaseException] | None,
+        exc_value: BaseException | None,
+        exc_traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def stream(self) -> BinaryIO:
+        """
+        A stream over the image, of its own if the contents were read up front, else the shared file.
+        """
+        return io.BytesIO(self._contents) if self._contents is not None else self.file
+
+    def contents(self) -> bytes:
+        if self._contents is None:
+            raise ValueError(f"Image '{self.image_path}' was opened without reading its contents")
+        return self._contents
+
+    def memo[T](self, key: str, compute: Callable[[], T]) -> T:
+        """
+        Return the value computed by `compute` for `key`, computing it on first use only. Concurrent callers of the
+        same key wait for the first one. Exceptions are not memoized.
+        """
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            if key not in self._values:
+                self._values[key] = compute()
+            return cast(T, self._values[key])
+
+    def grayscale(self, fast_decode: bool = False, policy: DecodePolicy = DEFAULT_DECODE_POLICY) -> Image.Image:
+        """
+        The image decoded by `decode_grayscale`, once per handle. Not to be modified.
+        """
+        gray, _ = self._decode(fast_decode, policy)
+        return gray
+
+    def downsampled(self, fast_decode: bool = False, policy: DecodePolicy = DEFAULT_DECODE_POLICY) -> bool:
+        """
+        Whether `grayscale` downsampled the image to fit the pixel limit of `policy`.
+        """
+        _, downsampled = self._decode(fast_decode, policy)
+        return downsampled
+
+    def _decode(self, fast_decode: bool, policy: DecodePolicy) -> Tuple[Image.Image, bool]:
+        return self.memo(
+            f"grayscale:{fast_decode}:{policy}",
+            lambda: decode_grayscale_downsampling(self.stream(), fast_decode, policy),
+        )
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def add_decode_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--max_pixels",
+        type=int,
+        default=DEFAULT_MAX_PIXELS,
+        help="Images with more pixels are downsampled or skipped, see --oversize, which bounds the memory per worker.",
+    )
+
+    parser.add_argument(
+        "--oversize",
+        type=str,
+        choices=["downsample", "skip"],
+        default="downsample",
+        help="Decode images above --max_pixels at a reduced scale, JPEGs only, other formats being skipped, or skip "
+        "them all. Skipped images are reported as errors.",
+    )
@@ -1,9 +1,18 @@
-from PIL import Image
+import argparse
 import imagehash
+import numpy as np
+import numpy.typing as npt
+from dataclasses import dataclass
 from decimal import Decimal
-from typing import Tuple, Literal, Dict, NamedTuple
+from typing import Iterable, List, Sequence, Tuple, Literal, Dict, NamedTuple
+import heapq
 import inspect
 
+from PIL import Image
+
+from image_decoding import DEFAULT_DECODE_POLICY, DecodePolicy, ImageHandle, decode_grayscale_downsampling
+from job_metrics import stage_timer
+
 
 def fname() -> str:
     f = inspect.currentframe()
@@ -25,13 +34,56 @@ HASH_FUNCTIONS = (imagehash.average_hash, imagehash.phash, imagehash.dhash, imag
 COMPOSITE_HASH_LENGTH = len(HASH_FUNCTIONS)
 
 
-def compute_composite_hash(image_path: str) -> TCompositeHash:
-    img = Image.open(image_path)
-    hashes = tuple(f"{f(img)}" for f in HASH_FUNCTIONS)
+def compute_composite_hash(
+    image_path: str, fast_decode: bool = False, policy: DecodePolicy = DEFAULT_DECODE_POLICY
+) -> TCompositeHash:
+    """
+    Decode the first frame of the image once, in grayscale and within the pixel limit of `policy`, and compute every
+    function in `HASH_FUNCTIONS` on it. Their own `convert("L")` is then a plain copy instead of a full colour
+    conversion each. See `decode_grayscale` for `fast_decode`.
+    """
+    hash, _ = compute_composite_hash_downsampling(image_path, fast_decode, policy)
+    return hash
+
+
+def compute_composite_hash_downsampling(
+    image_path: str, fast_decode: bool = False, policy: DecodePolicy = DEFAULT_DECODE_POLICY
+) -> Tuple[TCompositeHash, bool]:
+    """
+    Same as `compute_composite_hash`, also telling whether the image was downsampled to fit the pixel limit of
+    `policy`, in which case the hash is only valid for that limit.
+    """
+    with stage_timer("open"):
+        gray, downsampled = decode_grayscale_downsampling(image_path, fast_decode, policy)
+
+    return hash_grayscale(gray), downsampled
+
+
+def hash_grayscale(gray: Image.Image) -> TCompositeHash:
+    """
+    Compute every function in `HASH_FUNCTIONS` on an image already decoded in grayscale.
+    """
+    with stage_timer("hash"):
+        hashes = tuple(f"{f(gray)}" for f in HASH_FUNCTIONS)
 
     return hashes
 
 
+def handle_composite_hash(
+    handle: ImageHandle, fast_decode: bool = False, policy: DecodePolicy = DEFAULT_DECODE_POLICY
+) -> TCompositeHash:
+    """
+    Same as `compute_composite_hash`, on an image shared between checks: decoded and hashed once per handle.
+    """
+
+    def compute() -> TCompositeHash:
+        with stage_timer("open"):
+            gray = handle.grayscale(fast_decode, policy)
+        return hash_grayscale(gray)
+
+    return handle.memo(f"composite_hash:{fast_decode}:{policy}", compute)
+
+
 def serialize_hash(hash: TCompositeHash) -> str:
     return ", ".join(hash)
 
@@ -40,22 +92,65 @@ def deserialize_hash(hash_str: str) -> TCompositeHash:
     return tuple(hash_str.split(", "))
 
 
-def _decode_single_hash(hash_str: str) -> imagehash.ImageHash:
+SINGLE_HASH_BITS = 64
+SINGLE_HASH_HEX_LENGTH = SINGLE_HASH_BITS // 4
+
+
+@dataclass(frozen=True, slots=True)
+class PackedCompositeHash:
+    """
+    Composite hash with every sub-hash packed into an unsigned 64-bit integer, in `HASH_FUNCTIONS` order.
+    """
+
+    parts: Tuple[int, ...]
+
+
+def _pack_single_hash(hash_str: str) -> int:
     if not hash_str:
-        raise ValueError(f"{__name__}::Empty hash string provided")
+        raise ValueError(f"{fname()}::Empty hash string provided")
+    if len(hash_str) != SINGLE_HASH_HEX_LENGTH:
+        raise ValueError(
+            f"{fname()}::Invalid hash string '{hash_str}', expected {SINGLE_HASH_HEX_LENGTH} hex digits, got {len(hash_str)}"
+        )
     try:
-        return imagehash.hex_to_hash(hash_str)
+        return int(hash_str, 16)
     except Exception as e:
         raise e.__class__(
             f"{fname()}::Unexpected '{e.__class__.__name__}' while decoding hash string '{hash_str}': {e}"
         ) from e
 
 
-def _single_hash_difference(hash1: str, hash2: str) -> Decimal:
-    h1 = _decode_single_hash(hash1)
-    h2 = _decode_single_hash(hash2)
-    diff = h1 - h2
-    return Decimal(diff)
+def pack_hash(hash: TCompositeHash) -> PackedCompositeHash:
+    if len(hash) != COMPOSITE_HASH_LENGTH:
+        raise ValueError(
+            f"{fname()}::Invalid composite hash, expected {COMPOSITE_HASH_LENGTH} serialized hashes, got {len(hash)}"
+        )
+
+    return PackedCompositeHash(parts=tuple(_pack_single_hash(h) for h in hash))
+
+
+def unpack_hash(packed: PackedCompositeHash) -> TCompositeHash:
+    return tuple(f"{part:0{SINGLE_HASH_HEX_LENGTH}x}" for part in packed.parts)
+
+
+def packed_hash_key(packed: PackedCompositeHash) -> int:
+    """
+    Concatenate the sub-hashes into a single integer. The popcount of the XOR of two keys is the total Hamming
+    distance between the composite hashes.
+    """
+    key = 0
+    for part in packed.parts:
+        key = (key << SINGLE_HASH_BITS) | part
+
+    return key
+
+
+def packed_hash_distance(hash1: PackedCompositeHash, hash2: PackedCompositeHash) -> int:
+    """
+    Total Hamming distance between two composite hashes, i.e. the sum of the distances of their sub-hashes.
+    Divide by `COMPOSITE_HASH_LENGTH` to get the averaged distance of `hash_difference`.
+    """
+    return sum((p1 ^ p2).bit_count() for p1, p2 in zip(hash1.parts, hash2.parts))
 
 
 def hash_difference(hash1: TCompositeHash, hash2: TCompositeHash) -> Decimal:
@@ -67,8 +162,8 @@ def hash_difference(hash1: TCompositeHash, hash2: TCompositeHash) -> Decimal:
             f"{fname()}::At least one invalid composite hash string provided, expected {COMPOSITE_HASH_LENGTH} serialized hashes, got {len(hash1)} and {len(hash2)}"
         )
 
-    diff = (_single_hash_difference(h1, h2) for h1, h2 in zip(hash1, hash2))
-    avg_diff = Decimal(sum(diff)) / Decimal(len(hash1))
+    distance = packed_hash_distance(pack_hash(hash1), pack_hash(hash2))
+    avg_diff = Decimal(distance) / Decimal(COMPOSITE_HASH_LENGTH)
 
     return avg_diff
 
@@ -76,6 +171,31 @@ def hash_difference(hash1: TCompositeHash, hash2: TCompositeHash) -> Decimal:
 type THashComparison = Literal["identical", "similar", "different"]
 
 
+def categorize_distance(distance: int, identity_threshold: int, similarity_threshold: int) -> THashComparison:
+    """
+    Categorize a total Hamming distance, as returned by `packed_hash_distance`.
+
+    Comparing `distance` against `threshold * COMPOSITE_HASH_LENGTH` is the same as comparing the averaged
+    distance against `threshold`, while staying in integers.
+    """
+    result: THashComparison
+
+    if distance <= identity_threshold * COMPOSITE_HASH_LENGTH:
+        result = "identical"
+    elif distance <= similarity_threshold * COMPOSITE_HASH_LENGTH:
+        result = "similar"
+    else:
+        result = "different"
+
+    return result
+
+
+def packed_hash_categorization(
+    hash1: PackedCompositeHash, hash2: PackedCompositeHash, identity_threshold: int, similarity_threshold: int
+) -> THashComparison:
+    return categorize_distance(packed_hash_distance(hash1, hash2), identity_threshold, similarity_threshold)
+
+
 def hash_categorization(
     hash1: TCompositeHash, hash2: TCompositeHash, identity_threshold: int, similarity_threshold: int
 ) -> THashComparison:
@@ -94,17 +214,256 @@ def hash_categorization(
     return result
 
 
+###
+# Cascaded comparison
+###
+
+type TAlgorithmThresholds = Tuple[int, ...]  # maximum distance of each sub-hash, in `HASH_FUNCTIONS` order
+
+
+def _check_algorithm_thresholds(algorithm_thresholds: TAlgorithmThresholds | None) -> None:
+    if algorithm_thresholds is not None and len(algorithm_thresholds) != COMPOSITE_HASH_LENGTH:
+        raise ValueError(
+            f"{fname()}::Expected {COMPOSITE_HASH_LENGTH} per-algorithm thresholds, got {len(algorithm_thresholds)}"
+        )
+
+
+def parse_algorithm_thresholds(value: str) -> TAlgorithmThresholds:
+    """
+    Parse per-algorithm thresholds given as comma-separated integers, e.g. '8,12,10,8'. Meant as an argparse `type`,
+    so that a malformed value fails at the command line instead of on every row.
+    """
+    try:
+        algorithm_thresholds = tuple(int(t) for t in value.split(","))
+    except ValueError:
+        algorithm_thresholds = ()
+
+    if len(algorithm_thresholds) != COMPOSITE_HASH_LENGTH or any(t < 0 for t in algorithm_thresholds):
+        raise argparse.ArgumentTypeError(
+            f"Expected {COMPOSITE_HASH_LENGTH} comma-separated non-negative integers, got '{value}'"
+        )
+
+    return algorithm_thresholds
+
+
+def cascaded_hash_distance(
+    hash1: PackedCompositeHash,
+    hash2: PackedCompositeHash,
+    max_distance: int,
+    algorithm_thresholds: TAlgorithmThresholds | None = None,
+) -> int | None:
+    """
+    Total Hamming distance between two composite hashes, if it is at most `max_distance`.
+
+    Sub-hashes are compared in `HASH_FUNCTIONS` order, the average hash first. Distances are never negative, so as
+    soon as the running total exceeds `max_distance`, the remaining sub-hashes cannot bring it back under and the
+    comparison stops there. With `algorithm_thresholds`, it also stops at the first sub-hash farther than its own
+    threshold.
+
+    :return: The total distance, or None if it exceeds `max_distance` or a sub-hash exceeds its threshold.
+    """
+    _check_algorithm_thresholds(algorithm_thresholds)
+
+    total = 0
+    for i, (p1, p2) in enumerate(zip(hash1.parts, hash2.parts)):
+        distance = (p1 ^ p2).bit_count()
+        total += distance
+        if total > max_distance or (algorithm_thresholds is not None and distance > algorithm_thresholds[i]):
+            return None
+
+    return total
+
+
+def cascaded_hash_categorization(
+    hash1: PackedCompositeHash,
+    hash2: PackedCompositeHash,
+    identity_threshold: int,
+    similarity_threshold: int,
+    algorithm_thresholds: TAlgorithmThresholds | None = None,
+) -> THashComparison:
+    """
+    Same result as `hash_categorization` on packed hashes, most 'different' pairs being settled after comparing a
+    single sub-hash. With `algorithm_thresholds`, a pair is also 'different' if any of its sub-hashes is farther than
+    its own threshold.
+    """
+    distance = cascaded_hash_distance(hash1, hash2, similarity_threshold * COMPOSITE_HASH_LENGTH, algorithm_thresholds)
+    if distance is None:
+        return "different"
+
+    return categorize_distance(distance, identity_threshold, similarity_threshold)
+
+
 class KnownImage(NamedTuple):
     id: str
     hash: TCompositeHash
 
 
+class PackedKnownImage(NamedTuple):
+    id: str
+    hash: PackedCompositeHash
+
+
+def pack_known_images(known_images: Iterable[KnownImage]) -> Tuple[PackedKnownImage, ...]:
+    """
+    Decode the hex hashes of known images once, so that they can be compared many times without reparsing.
+    """
+    return tuple(PackedKnownImage(id=img.id, hash=pack_hash(img.hash)) for img in known_images)
+
+
 type KnownImageComparison = Dict[str, THashComparison]  # image id  # comparison result
 
 
+###
+# Batch comparison
+###
+
+type THashMatrix = npt.NDArray[np.uint64]  # shape (M, COMPOSITE_HASH_LENGTH), one packed composite hash per row
+
+
+@dataclass(frozen=True, slots=True)
+class KnownHashCatalogue:
+    """
+    Known images as a hash matrix, row `i` of `hashes` being the packed composite hash of `ids[i]`.
+    """
+
+    ids: Sequence[str]
+    hashes: THashMatrix
+
+
+@dataclass(frozen=True, slots=True)
+class HashCategoryMasks:
+    """
+    Boolean masks over the rows of a hash matrix, exactly one of them being set for each row.
+    """
+
+    identical: npt.NDArray[np.bool_]
+    similar: npt.NDArray[np.bool_]
+    different: npt.NDArray[np.bool_]
+
+
+def build_hash_matrix(hashes: Iterable[PackedCompositeHash]) -> THashMatrix:
+    matrix = np.array([h.parts for h in hashes], dtype=np.uint64)
+
+    return matrix.reshape(-1, COMPOSITE_HASH_LENGTH)
+
+
+def build_known_hash_catalogue(known_images: Iterable[KnownImage | PackedKnownImage]) -> KnownHashCatalogue:
+    """
+    Decode all known hashes once into an (M, COMPOSITE_HASH_LENGTH) uint64 matrix.
+    """
+    ids = []
+    packed_hashes = []
+    for img in known_images:
+        ids.append(img.id)
+        packed_hashes.append(img.hash if isinstance(img.hash, PackedCompositeHash) else pack_hash(img.hash))
+
+    return KnownHashCatalogue(ids=tuple(ids), hashes=build_hash_matrix(packed_hashes))
+
+
+def batch_hash_distances(source_hash: PackedCompositeHash, hashes: THashMatrix) -> npt.NDArray[np.int64]:
+    """
+    Total Hamming distance between the source hash and every row of the hash matrix, in one XOR and popcount pass.
+    Same values as `packed_hash_distance` for each row.
+    """
+    source = np.array(source_hash.parts, dtype=np.uint64)
+
+    return np.bitwise_count(hashes ^ source).sum(axis=1, dtype=np.int64)
+
+
+def batch_hash_difference(source_hash: PackedCompositeHash, hashes: THashMatrix) -> npt.NDArray[np.float64]:
+    """
+    Averaged Hamming distance between the source hash and every row of the hash matrix, as `hash_difference` does
+    for a single pair.
+    """
+    return batch_hash_distances(source_hash, hashes) / COMPOSITE_HASH_LENGTH
+
+
+def batch_candidate_distances(
+    source_hash: PackedCompositeHash,
+    hashes: THashMatrix,
+    max_distance: int,
+    algorithm_thresholds: TAlgorithmThresholds | None = None,
+) -> Tuple[npt.NDArray[np.intp], npt.NDArray[np.int64]]:
+    """
+    Vectorized counterpart of `cascaded_hash_distance`: the rows of the hash matrix within `max_distance` of the
+    source hash, and their total distances.
+
+    The first column is compared for every row, and each following column only for the rows still within
+    `max_distance`, and within their per-algorithm thresholds if given. Most rows are ruled out by the first one.
+
+    :return: Indices of the matching rows, in increasing order, and their total distances.
+    """
+    _check_algorithm_thresholds(algorithm_thresholds)
+
+    candidates = np.arange(len(hashes))
+    totals = np.zeros(len(hashes), dtype=np.int64)
+
+    for i, part in enumerate(source_hash.parts):
+        column = hashes[:, i] if len(candidates) == len(hashes) else hashes[candidates, i]
+        distances = np.bitwise_count(column ^ np.uint64(part))
+        totals += distances
+
+        keep = totals <= max_distance
+        if algorithm_thresholds is not None:
+            keep &= distances <= algorithm_thresholds[i]
+
+        candidates = candidates[keep]
+        totals = totals[keep]
+
+    return candidates, totals
+
+
+def batch_hash_categorization(
+    source_hash: PackedCompositeHash,
+    hashes: THashMatrix,
+    identity_threshold: int,
+    similarity_threshold: int,
+    algorithm_thresholds: TAlgorithmThresholds | None = None,
+) -> HashCategoryMasks:
+    """
+    Categorize the source hash against every row of the hash matrix, with the same rules as
+    `cascaded_hash_categorization`.
+    """
+    candidates, distances = batch_candidate_distances(
+        source_hash, hashes, similarity_threshold * COMPOSITE_HASH_LENGTH, algorithm_thresholds
+    )
+
+    identical = np.zeros(len(hashes), dtype=np.bool_)
+    identical[candidates[distances <= identity_threshold * COMPOSITE_HASH_LENGTH]] = True
+    within_similarity = np.zeros(len(hashes), dtype=np.bool_)
+    within_similarity[candidates] = True
+
+    return HashCategoryMasks(
+        identical=identical,
+        similar=within_similarity & ~identical,
+        different=~within_similarity,
+    )
+
+
+def catalogue_hash_categorizations(
+    source_hash: PackedCompositeHash,
+    catalogue: KnownHashCatalogue,
+    identity_threshold: int,
+    similarity_threshold: int,
+    algorithm_thresholds: TAlgorithmThresholds | None = None,
+) -> KnownImageComparison:
+    """
+    Vectorized counterpart of `all_hash_categorizations`, for an already computed source hash.
+    """
+    masks = batch_hash_categorization(
+        source_hash, catalogue.hashes, identity_threshold, similarity_threshold, algorithm_thresholds
+    )
+
+    categories = np.full(len(catalogue.ids), "different", dtype=object)
+    categories[masks.similar] = "similar"
+    categories[masks.identical] = "identical"
+
+    return dict(zip(catalogue.ids, categories.tolist()))
+
+
 def all_hash_categorizations(
     source_image_path: str,
-    known_image_hashes: Tuple[KnownImage],
+    known_image_hashes: Tuple[KnownImage, ...] | Tuple[PackedKnownImage, ...] | KnownHashCatalogue,
     identity_threshold: int,
     similarity_threshold: int,
 ) -> KnownImageComparison:
@@ -112,21 +471,104 @@ def all_hash_categorizations(
     Compare a source image hash with a list of known image hashes and return the comparison results.
 
     :param source_image_path: Path to the source image.
-    :param known_image_hashes: List of known image hashes.
+    :param known_image_hashes: List of known image hashes, preferably already built into a catalogue with
+        `build_known_hash_catalogue` when comparing several source images.
     :param identity_threshold: Threshold for identical images.
     :param similarity_threshold: Threshold for similar images.
-    :param lenght: Number of hashes in the composite hash.
     :return: Dictionary with image IDs as keys and comparison results as values.
     """
 
-    source_hash = compute_composite_hash(source_image_path)
+    source_hash = pack_hash(compute_composite_hash(source_image_path))
 
-    result = {
-        img.id: hash_categorization(source_hash, img.hash, identity_threshold, similarity_threshold)
-        for img in known_image_hashes
-    }
+    catalogue = (
+        known_image_hashes
+        if isinstance(known_image_hashes, KnownHashCatalogue)
+        else build_known_hash_catalogue(known_image_hashes)
+    )
 
-    return result
+    return catalogue_hash_categorizations(source_hash, catalogue, identity_threshold, similarity_threshold)
+
+
+###
+# Top-k matches
+###
+
+
+class HashMatch(NamedTuple):
+    image_id: str
+    distance: int  # total Hamming distance, as returned by `packed_hash_distance`
+    category: THashComparison
+
+
+def catalogue_top_k_matches(
+    source_hash: PackedCompositeHash,
+    catalogue: KnownHashCatalogue,
+    k: int,
+    identity_threshold: int,
+    similarity_threshold: int,
+    algorithm_thresholds: TAlgorithmThresholds | None = None,
+) -> List[HashMatch]:
+    """
+    The `k` known images closest to the source hash, among the identical and similar ones.
+
+    Images past `similarity_threshold` are dropped before anything else, and only the `k` nearest of the remaining
+    ones are kept with a heap, so that the result stays small however large the catalogue is.
+
+    :param source_hash: Packed composite hash of the source image.
+    :param catalogue: Known images, as built by `build_known_hash_catalogue`.
+    :param k: Maximum number of matches to return.
+    :param identity_threshold: Threshold for identical images.
+    :param similarity_threshold: Threshold for similar images.
+    :param algorithm_thresholds: Optional maximum distance of each sub-hash, see `cascaded_hash_distance`.
+    :return: Matches sorted by increasing distance, ties in catalogue order.
+    """
+    if k < 1:
+        raise ValueError(f"{fname()}::k must be at least 1, got {k}")
+
+    candidates, distances = batch_candidate_distances(
+        source_hash, catalogue.hashes, similarity_threshold * COMPOSITE_HASH_LENGTH, algorithm_thresholds
+    )
+    nearest = heapq.nsmallest(k, zip(distances.tolist(), candidates.tolist()))
+
+    return [
+        HashMatch(
+            image_id=catalogue.ids[i],
+            distance=distance,
+            category=categorize_distance(distance, identity_threshold, similarity_threshold),
+        )
+        for distance, i in nearest
+    ]
+
+
+def top_k_hash_matches(
+    source_image_path: str,
+    known_image_hashes: Tuple[KnownImage, ...] | Tuple[PackedKnownImage, ...] | KnownHashCatalogue,
+    k: int,
+    identity_threshold: int,
+    similarity_threshold: int,
+    algorithm_thresholds: TAlgorithmThresholds | None = None,
+) -> List[HashMatch]:
+    """
+    Bounded counterpart of `all_hash_categorizations`, see `catalogue_top_k_matches`.
+    """
+    source_hash = pack_hash(compute_composite_hash(source_image_path))
+
+    catalogue = (
+        known_image_hashes
+        if isinstance(known_image_hashes, KnownHashCatalogue)
+        else build_known_hash_catalogue(known_image_hashes)
+    )
+
+    return catalogue_top_k_matches(
+        source_hash, catalogue, k, identity_threshold, similarity_threshold, algorithm_thresholds
+    )
+
+
+def serialize_hash_matches(matches: Iterable[HashMatch]) -> str:
+    """
+    Serialize matches to a string, in the format of `serialize_hash_categorizations` plus the averaged distance.
+    """
+    return ", ".join(f"[ {m.image_id}: {m.category} ({Decimal(m.distance) / COMPOSITE_HASH_LENGTH}) ]" for m in matches)
 
 
 def filter_hash_categorizations(
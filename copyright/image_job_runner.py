@@ -0,0 +1,545 @@
+import csv
+import json
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from functools import partial
+from itertools import batched, islice
+from pathlib import Path
+from typing import Iterable, Iterator, Tuple
+
+from aletk.utils import get_logger
+from aletk.ResultMonad import main_try_except_wrapper, Ok, Err
+from hash_index import (
+    BKTree,
+    build_known_image_index,
+    catalogue_stamp,
+    indexed_top_k_matches,
+    load_known_image_index,
+    save_known_image_index,
+)
+from image_decoding import (
+    DEFAULT_DECODE_POLICY,
+    DEFAULT_MAX_PIXELS,
+    DecodePolicy,
+    TOversizePolicy,
+    add_decode_arguments,
+)
+from image_hashing import (
+    KnownImage,
+    TAlgorithmThresholds,
+    compute_composite_hash,
+    deserialize_hash,
+    parse_algorithm_thresholds,
+    serialize_hash,
+    serialize_hash_matches,
+)
+from image_metadata_io import (
+    IMAGE_COMPARED_FIELDS,
+    ImageCompared,
+    read_image_metadata,
+    read_known_copyrighted_images,
+)
+from job_metrics import (
+    add_metrics_arguments,
+    count_status,
+    enable_worker_metrics,
+    merge_observations,
+    metrics_enabled,
+    observed,
+    open_metrics,
+    stage_timer,
+)
+from parallel import bounded_map
+
+lgr = get_logger(__name__)
+
+DEFAULT_IDENTITY_THRESHOLD = 5
+DEFAULT_SIMILARITY_THRESHOLD = 10
+
+DEFAULT_TOP_K = 10
+
+DEFAULT_CHUNK_SIZE = 16
+
+DEFAULT_CHECKPOINT_INTERVAL = 1000
+
+CHECKPOINT_FORMAT_VERSION = 1
+
+
+###
+# Jobs
+###
+
+# Set once per worker process by `_init_worker`, so that the index is sent to each worker only once
+_worker_index: BKTree | None = None
+
+
+def _init_worker(index: BKTree | None, metrics: bool) -> None:
+    global _worker_index
+    _worker_index = index
+    if metrics:
+        enable_worker_metrics()
+
+
+def run_job(
+    job: ImageCompared,
+    index: BKTree | None,
+    top_k: int,
+    identity_threshold: int,
+    similarity_threshold: int,
+    algorithm_thresholds: TAlgorithmThresholds | None = None,
+    policy: DecodePolicy = DEFAULT_DECODE_POLICY,
+) -> ImageCompared:
+    """
+    Execute the request of a row: compute the hash of its asset, and for 'COMPARE' also find the closest known
+    images. A 'COMPARE' row that already has a hash is not hashed again.
+
+    :param job: Row to execute. Rows that could not be parsed, with status 'error', are returned as they are.
+    :param index: Index of the known images, only needed for 'COMPARE' rows.
+    :param top_k: Maximum number of identical or similar known images reported per 'COMPARE' row.
+    :param identity_threshold: Threshold for identical images.
+    :param similarity_threshold: Threshold for similar images.
+    :param algorithm_thresholds: Optional maximum distance of each sub-hash, see `cascaded_hash_distance`.
+    :param policy: Pixel limit of the decoded assets, see `DecodePolicy`.
+    :return: The row with its results and a 'success' or 'error' status.
+    """
+    if job.status == "error":
+        return job
+
+    try:
+        match job.request:
+            case "COMPUTE HASH":
+                hash = serialize_hash(compute_composite_hash(job.asset_path, policy=policy))
+                comparisons = ""
+
+            case "COMPARE":
+                if index is None:
+                    raise ValueError("No known images to compare against, see --known_images")
+                hash = job.hash or serialize_hash(compute_composite_hash(job.asset_path, policy=policy))
+                with stage_timer("compare"):
+                    matches = indexed_top_k_matches(
+                        deserialize_hash(hash),
+                        index,
+                        top_k,
+                        identity_threshold,
+                        similarity_threshold,
+                        algorithm_thresholds,
+                    )
+                comparisons = serialize_hash_matches(matches)
+
+            case _:
+                raise ValueError(f"Unknown request '{job.request}' for image with id: {job.id}")
+
+        return job.model_copy(
+            update={
+                "hash": hash,
+                "copyright_comparisons": comparisons,
+                "status": "success",
+                "message": "",
+                "traceback": "",
+            }
+        )
+
+    except Exception as e:
+        return job.model_copy(
+            update={
+                "status": "error",
+                "message": f"Error running '{job.request}' for image with id {job.id}: {e.__class__.__name__}: {e}",
+                "traceback": traceback.format_exc(),
+                "object_dump": str(job.model_dump()),
+            }
+        )
+
+
+def _run_chunk(
+    chunk: Tuple[ImageCompared, ...],
+    top_k: int,
+    identity_threshold: int,
+    similarity_threshold: int,
+    algorithm_thresholds: TAlgorithmThresholds | None,
+    policy: DecodePolicy,
+) -> Tuple[ImageCompared, ...]:
+    return tuple(
+        run_job(job, _worker_index, top_k, identity_threshold, similarity_threshold, algorithm_thresholds, policy)
+        for job in chunk
+    )
+
+
+def run_jobs(
+    jobs: Iterable[ImageCompared],
+    index: BKTree | None,
+    top_k: int,
+    identity_threshold: int,
+    similarity_threshold: int,
+    algorithm_thresholds: TAlgorithmThresholds | None,
+    workers: int,
+    chunk_size: int,
+    policy: DecodePolicy = DEFAULT_DECODE_POLICY,
+) -> Iterator[ImageCompared]:
+    """
+    Run jobs on a process pool, yielding the results in input order, so that the output is always a prefix of the
+    input that a checkpoint can refer to. With metrics enabled, the stage durations observed by the workers are sent
+    back along with each chunk.
+    """
+    run_chunk = observed(
+        partial(
+            _run_chunk,
+            top_k=top_k,
+            identity_threshold=identity_threshold,
+            similarity_threshold=similarity_threshold,
+            algorithm_thresholds=algorithm_thresholds,
+            policy=policy,
+        )
+    )
+
+    initargs = (index, metrics_enabled())
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as executor:
+        chunks = batched(jobs, chunk_size)
+        for results, observations in bounded_map(executor, run_chunk, chunks, 2 * workers, ordered=True):
+            merge_observations(observations)
+            yield from results
+
+
+###
+# Checkpoints
+###
+
+
+@dataclass(frozen=True, slots=True)
+class Checkpoint:
+    """
+    The first `rows_done` input rows have their results in the first `output_bytes` bytes of the output file.
+    """
+
+    version: int
+    input_file: str
+    rows_done: int
+    output_bytes: int
+
+
+def default_checkpoint_file(output_file: str) -> str:
+    return f"{output_file}.checkpoint"
+
+
+def read_checkpoint(checkpoint_file: str) -> Checkpoint | None:
+    path = Path(checkpoint_file)
+    if not path.exists():
+        return None
+
+    checkpoint = Checkpoint(**json.loads(path.read_text()))
+    if checkpoint.version != CHECKPOINT_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported checkpoint version {checkpoint.version} in '{checkpoint_file}', "
+            f"expected {CHECKPOINT_FORMAT_VERSION}"
+        )
+
+    return checkpoint
+
+
+def write_checkpoint(checkpoint: Checkpoint, checkpoint_file: str) -> None:
+    # Written next to the target, then moved into place, so that a crash never leaves a partial checkpoint
+    path = Path(checkpoint_file)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_text(json.dumps(asdict(checkpoint)))
+    tmp_path.replace(path)
+
+
+def _resume_point(input_file: str, output_file: str, checkpoint_file: str, resume: bool) -> Checkpoint | None:
+    checkpoint = read_checkpoint(checkpoint_file) if resume else None
+    if checkpoint is None:
+        return None
+
+    if checkpoint.input_file != str(Path(input_file).resolve()):
+        raise ValueError(
+            f"Checkpoint '{checkpoint_file}' was written for '{checkpoint.input_file}', not '{input_file}'. "
+            "Remove it or run with --no_resume to start over."
+        )
+
+    if not Path(output_file).exists() or Path(output_file).stat().st_size < checkpoint.output_bytes:
+        raise ValueError(
+            f"Output file '{output_file}' is missing or shorter than its checkpoint '{checkpoint_file}'. "
+            "Remove the checkpoint or run with --no_resume to start over."
+        )
+
+    return checkpoint
+
+
+###
+# Known images
+###
+
+
+def load_known_images_index(known_images_file: str, index_file: str) -> BKTree:
+    """
+    Load the index of the known images from `index_file` if it exists and was built from the catalogue as it is now,
+    otherwise build it from the catalogue and, if `index_file` is set, save it there for the next runs. Without a
+    catalogue, the index is loaded as is.
+    """
+    stamp = catalogue_stamp(known_images_file) if known_images_file else None
+
+    if index_file and Path(index_file).exists():
+        lgr.info(f"Loading the known images index from '{index_file}'...")
+        index, index_stamp = load_known_image_index(index_file)
+        if stamp is None or index_stamp == stamp:
+            return index
+
+        lgr.info(f"'{known_images_file}' changed since '{index_file}' was built, rebuilding the index...")
+
+    images, amount_of_rows = read_known_copyrighted_images(known_images_file)
+    lgr.info(f"Indexing {amount_of_rows} known images from '{known_images_file}'...")
+    index = build_known_image_index(KnownImage(id=img.id, hash=deserialize_hash(img.hash)) for img in images)
+
+    if index_file:
+        save_known_image_index(index, index_file, stamp)
+        lgr.info(f"Known images index saved to '{index_file}'")
+
+    return index
+
+
+###
+# Main
+###
+
+
+@main_try_except_wrapper(logger=lgr)
+def main(
+    input_file: str,
+    output_file: str,
+    known_images_file: str,
+    index_file: str,
+    top_k: int,
+    identity_threshold: int,
+    similarity_threshold: int,
+    algorithm_thresholds: TAlgorithmThresholds | None,
+    workers: int,
+    chunk_size: int,
+    checkpoint_file: str,
+    checkpoint_interval: int,
+    resume: bool,
+    max_pixels: int = DEFAULT_MAX_PIXELS,
+    oversize: TOversizePolicy = "downsample",
+    metrics_textfile: str = "",
+    metrics_port: int = 0,
+    metrics_address: str = "127.0.0.1",
+) -> None:
+    """
+    Execute the 'COMPUTE HASH' and 'COMPARE' requests of an ImageCompared CSV file, streaming the results to another.
+
+    Every `checkpoint_interval` rows, the output is flushed to disk and the number of rows done is recorded in the
+    checkpoint file. An interrupted run then resumes from the last checkpoint: rows written after it are truncated
+    away and computed again, the ones before it are skipped. The checkpoint is removed once the run completes.
+
+    Assets above `max_pixels` are downsampled or skipped according to `oversize`, see `DecodePolicy`.
+
+    Stage durations and row statuses are exported as Prometheus metrics if `metrics_textfile` or `metrics_port` is set.
+    """
+    checkpoint_file = checkpoint_file or default_checkpoint_file(output_file)
+    checkpoint = _resume_point(input_file, output_file, checkpoint_file, resume)
+
+    index = load_known_images_index(known_images_file, index_file) if known_images_file or index_file else None
+
+    jobs, amount_of_rows = read_image_metadata(input_file)
+    rows_done = 0 if checkpoint is None else checkpoint.rows_done
+
+    if checkpoint is None:
+        file = open(output_file, "w", newline="")
+        writer = csv.DictWriter(file, fieldnames=IMAGE_COMPARED_FIELDS)
+        writer.writeheader()
+    else:
+        lgr.info(f"Resuming from checkpoint '{checkpoint_file}', {rows_done} rows already done")
+        with open(output_file, "r+b") as f:
+            f.truncate(checkpoint.output_bytes)
+        file = open(output_file, "a", newline="")
+        writer = csv.DictWriter(file, fieldnames=IMAGE_COMPARED_FIELDS)
+
+    lgr.info(f"Running {amount_of_rows - rows_done} jobs from '{input_file}' with {workers} workers...")
+
+    def commit() -> None:
+        file.flush()
+        os.fsync(file.fileno())
+        write_checkpoint(
+            Checkpoint(
+                version=CHECKPOINT_FORMAT_VERSION,
+                input_file=str(Path(input_file).resolve()),
+                rows_done=rows_done,
+                output_bytes=file.tell(),
+            ),
+            checkpoint_file,
+        )
+
+    metrics = open_metrics("image_job_runner", metrics_textfile, metrics_port, metrics_address)
+
+    try:
+        with file:
+            commit()
+            results = run_jobs(
+                islice(jobs, rows_done, None),
+                index,
+                top_k,
+                identity_threshold,
+                similarity_threshold,
+                algorithm_thresholds,
+                workers,
+                chunk_size,
+                DecodePolicy(max_pixels=max_pixels, oversize=oversize),
+            )
+            for result in results:
+                with stage_timer("csv_write"):
+                    writer.writerow(result.model_dump())
+                count_status(result.status)
+                rows_done += 1
+
+                if rows_done % checkpoint_interval == 0:
+                    commit()
+                    lgr.info(f"{rows_done}/{amount_of_rows} rows done")
+
+            commit()
+    finally:
+        if metrics is not None:
+            metrics.close()
+
+    Path(checkpoint_file).unlink()
+
+    lgr.info(f"All {rows_done} rows done, results written to '{output_file}'")
+
+
+def cli() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Run the 'COMPUTE HASH' and 'COMPARE' requests of an ImageCompared CSV file, resumably."
+    )
+
+    parser.add_argument(
+        "-i",
+        "--input_file",
+        type=str,
+        required=True,
+        help="Path to the input CSV file, in the ImageCompared schema.",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output_file",
+        type=str,
+        required=True,
+        help="Path to the output CSV file, in the same schema.",
+    )
+
+    parser.add_argument(
+        "-k",
+        "--known_images",
+        type=str,
+        default="",
+        help="Path to the known copyrighted images, as a '.csv' or '.chash' catalogue. Required for 'COMPARE' rows.",
+    )
+
+    parser.add_argument(
+        "--index_file",
+        type=str,
+        default="",
+        help="Path to the index of the known images. Loaded if it exists and --known_images did not change since it "
+        "was built, otherwise built and saved there.",
+    )
+
+    parser.add_argument(
+        "--top_k",
+        type=int,
+        default=DEFAULT_TOP_K,
+        help="Maximum number of identical or similar known images reported per 'COMPARE' row, the closest ones.",
+    )
+
+    parser.add_argument(
+        "--identity_threshold",
+        type=int,
+        default=DEFAULT_IDENTITY_THRESHOLD,
+        help="Maximum averaged Hamming distance for images to be considered identical.",
+    )
+
+    parser.add_argument(
+        "--similarity_threshold",
+        type=int,
+        default=DEFAULT_SIMILARITY_THRESHOLD,
+        help="Maximum averaged Hamming distance for images to be considered similar.",
+    )
+
+    parser.add_argument(
+        "--algorithm_thresholds",
+        type=parse_algorithm_thresholds,
+        default=None,
+        help="Comma-separated maximum Hamming distance of each sub-hash (average, perceptual, difference, wavelet), "
+        "e.g. '8,12,10,8'. Images with any sub-hash farther than its threshold are considered different.",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes. Defaults to the number of CPUs.",
+    )
+
+    parser.add_argument(
+        "-c",
+        "--chunk_size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="Number of rows sent to a worker at once.",
+    )
+
+    parser.add_argument(
+        "--checkpoint_file",
+        type=str,
+        default="",
+        help="Path to the checkpoint file. Defaults to the output file with a '.checkpoint' suffix.",
+    )
+
+    parser.add_argument(
+        "--checkpoint_interval",
+        type=int,
+        default=DEFAULT_CHECKPOINT_INTERVAL,
+        help="Number of rows between checkpoints.",
+    )
+
+    parser.add_argument(
+        "--no_resume",
+        action="store_true",
+        help="Ignore any existing checkpoint and start over.",
+    )
+
+    add_decode_arguments(parser)
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+
+    result = main(
+        input_file=args.input_file,
+        output_file=args.output_file,
+        known_images_file=args.known_images,
+        index_file=args.index_file,
+        top_k=args.top_k,
+        identity_threshold=args.identity_threshold,
+        similarity_threshold=args.similarity_threshold,
+        algorithm_thresholds=args.algorithm_thresholds,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        checkpoint_file=args.checkpoint_file,
+        checkpoint_interval=args.checkpoint_interval,
+        resume=not args.no_resume,
+        max_pixels=args.max_pixels,
+        oversize=args.oversize,
+        metrics_textfile=args.metrics_textfile,
+        metrics_port=args.metrics_port,
+        metrics_address=args.metrics_address,
+    )
+
+    match result:
+        case Ok(out=_):
+            pass
+        case Err(err):
+            lgr.error(f"Error: {err}")
+
+
+if __name__ == "__main__":
+    cli()
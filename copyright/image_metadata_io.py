@@ -1,16 +1,98 @@
 import csv
-from io import TextIOWrapper
+from itertools import islice
 from pathlib import Path
 import traceback
-from typing import Any, Dict, Generator, Literal, Tuple
-from pydantic import BaseModel, field_validator
-from copyright.image_hashing import (
+from typing import Any, Dict, Generator, List, Literal, NamedTuple, Tuple
+from pydantic import BaseModel, TypeAdapter, ValidationError, field_validator
+from image_hashing import (
     COMPOSITE_HASH_LENGTH,
     KnownImageComparison,
 )
 
 HASHES_SEPARATOR = ", "
 
+READ_BLOCK_SIZE = 1 << 20
+
+VALIDATION_BATCH_SIZE = 4096
+
+
+###
+# CSV streaming
+###
+
+def count_csv_rows(path: Path) -> int:
+    """
+    Count the data rows of a CSV file in a single buffered pass, without parsing it.
+
+    Only newlines outside of quoted fields end a row, so multi-line fields such as tracebacks are counted right.
+    Blank lines, which `csv.DictReader` skips, are the only rows counted in excess.
+    """
+    in_quotes = False
+    newlines = 0
+    last_byte = b""
+
+    with path.open("rb") as file:
+        while block := file.read(READ_BLOCK_SIZE):
+            # Quotes toggle the state, escaped quotes ("") toggling it twice
+            for i, segment in enumerate(block.split(b'"')):
+                if i > 0:
+                    in_quotes = not in_quotes
+                if not in_quotes:
+                    newlines += segment.count(b"\n")
+            last_byte = block[-1:]
+
+    lines = newlines + (1 if last_byte not in (b"", b"\n") else 0)
+
+    # Without the header
+    return max(lines - 1, 0)
+
+
+def _check_csv_headers(path: Path, expected_fields: List[str]) -> None:
+    with path.open("r", newline="") as file:
+        headers = next(csv.reader(file), None)
+
+    if headers is None:
+        raise ValueError("CSV file has no headers")
+
+    if headers != expected_fields:
+        raise ValueError(
+            f"CSV file headers do not match expected fields, expected, in order {expected_fields}, got {headers}"
+        )
+
+
+type TRawRow = Dict[str | Any, str | Any]
+
+
+def _iter_csv_batches(path: Path) -> Generator[Tuple[int, List[TRawRow]], None, None]:
+    """
+    Yield the rows of a CSV file in batches of `VALIDATION_BATCH_SIZE`, each with the number of its first row.
+    The file stays open for as long as the generator is being consumed.
+    """
+    with path.open("r", newline="") as file:
+        reader = csv.DictReader(file)
+        first_row_number = 1
+        while batch := list(islice(reader, VALIDATION_BATCH_SIZE)):
+            yield first_row_number, batch
+            first_row_number += len(batch)
+
+
+###
+# Validation
+###
+
+class RowError(NamedTuple):
+    row_number: int
+    message: str
+
+
+def _hash_separator_error(v: str) -> str | None:
+    expected = COMPOSITE_HASH_LENGTH - 1
+    actual = v.count(HASHES_SEPARATOR)
+    if actual != expected:
+        return f"'hash' must contain exactly {expected} occurences of [[ {HASHES_SEPARATOR} ]], got {actual}"
+
+    return None
+
 
 ###
 # CopyrightedImage
@@ -24,12 +106,9 @@ class CopyrightedImage(BaseModel):
 
     @field_validator("hash")
     def validate_hash_separator_count(cls, v: str) -> str:
-        expected = COMPOSITE_HASH_LENGTH - 1
-        actual = v.count(HASHES_SEPARATOR)
-        if actual != expected:
-            raise ValueError(
-                f"'hash' must contain exactly {expected} occurences of [[ {HASHES_SEPARATOR} ]], got {actual}"
-            )
+        error = _hash_separator_error(v)
+        if error is not None:
+            raise ValueError(error)
 
         return v
 
@@ -53,30 +132,65 @@ def parse_copyrighted_image(raw_obj: Dict[str | Any, str | Any]) -> CopyrightedI
     return CopyrightedImage.model_validate(obj)
 
 
-def _read_known_copyrighted_images_from_csv(file: TextIOWrapper) -> Tuple[Tuple[CopyrightedImage, ...], int]:
-    d = csv.DictReader(file)
+_COPYRIGHTED_IMAGES_ADAPTER = TypeAdapter(List[CopyrightedImage])
 
-    headers = d.fieldnames
-    if headers is None:
-        raise ValueError("CSV file has no headers")
 
-    headers_list = [header for header in headers]
+def validate_copyrighted_images(
+    raw_rows: List[TRawRow], first_row_number: int = 1
+) -> Tuple[List[CopyrightedImage], List[RowError]]:
+    """
+    Bulk counterpart of `parse_copyrighted_image`, for whole batches of CSV rows.
 
-    if headers_list != COPYRIGHTED_IMAGE_FIELDS:
-        raise ValueError(
-            f"CSV file headers do not match expected fields, expected, in order {COPYRIGHTED_IMAGE_FIELDS}, got {headers_list}"
-        )
+    The batch is validated with a single pydantic call, which is much cheaper than one `model_validate` per row.
+    Only if that fails are the rows parsed one by one, to find and report each invalid one.
 
-    amount_of_rows = sum(1 for _ in d)
-    images = tuple(
-        parse_copyrighted_image(row)
-        for row in d
-    )
+    :param raw_rows: Rows as read by `csv.DictReader`.
+    :param first_row_number: Number of the first row, for error reporting.
+    :return: The valid images, and one error per invalid row.
+    """
+    if all(raw_obj.get("hash") for raw_obj in raw_rows):
+        try:
+            return _COPYRIGHTED_IMAGES_ADAPTER.validate_python(raw_rows), []
+        except ValidationError:
+            pass
+
+    images = []
+    errors = []
+    for row_number, raw_obj in enumerate(raw_rows, start=first_row_number):
+        try:
+            images.append(parse_copyrighted_image(raw_obj))
+        except ValueError as e:
+            errors.append(RowError(row_number=row_number, message=f"{e}"))
+
+    return images, errors
+
+
+def _iter_known_copyrighted_images(path: Path) -> Generator[CopyrightedImage, None, None]:
+    for first_row_number, batch in _iter_csv_batches(path):
+        images, errors = validate_copyrighted_images(batch, first_row_number)
+        if errors:
+            raise ValueError(
+                f"Invalid rows in '{path}':\n" + "\n".join(f"row {e.row_number}: {e.message}" for e in errors)
+            )
+
+        yield from images
 
-    return images, amount_of_rows
-    
 
-def read_known_copyrighted_images(file_path: str) -> Tuple[Tuple[CopyrightedImage, ...], int]:
+def _read_known_copyrighted_images_from_csv(path: Path) -> Tuple[Generator[CopyrightedImage, None, None], int]:
+    _check_csv_headers(path, COPYRIGHTED_IMAGE_FIELDS)
+    amount_of_rows = count_csv_rows(path)
+
+    return _iter_known_copyrighted_images(path), amount_of_rows
+
+
+def read_known_copyrighted_images(file_path: str) -> Tuple[Generator[CopyrightedImage, None, None], int]:
+    """
+    Stream the known copyrighted images of a catalogue file.
+
+    :param file_path: Path to the catalogue.
+    :return: Lazy generator over the validated images, which keeps the file open while it is consumed, and the
+        number of images.
+    """
 
     path = Path(file_path)
     if not path.exists():
@@ -86,8 +200,14 @@ def read_known_copyrighted_images(file_path: str) -> Tuple[Tuple[CopyrightedImag
 
     match extension:
         case ".csv":
-            with path.open("r") as file:
-                return _read_known_copyrighted_images_from_csv(file)
+            return _read_known_copyrighted_images_from_csv(path)
+
+        case ".chash":
+            # Imported here, as converting to a manifest relies on this module
+            from hash_manifest import HashManifest, iter_manifest_images
+
+            manifest = HashManifest(file_path)
+            return iter_manifest_images(manifest), len(manifest)
 
         case _:
             raise ValueError(f"Unsupported file format: {extension}")
@@ -113,14 +233,11 @@ class ImageCompared(BaseModel):
 
     @field_validator("hash")
     def validate_hash_separator_count(cls, v: str) -> str:
-        if v is "":
+        if v == "":
             return v
-        expected = COMPOSITE_HASH_LENGTH - 1
-        actual = v.count(HASHES_SEPARATOR)
-        if actual != expected:
-            raise ValueError(
-                f"'hash' must contain exactly {expected} occurences of [[ {HASHES_SEPARATOR} ]], got {actual}"
-            )
+        error = _hash_separator_error(v)
+        if error is not None:
+            raise ValueError(error)
         return v
 
 IMAGE_COMPARED_FIELDS = list(ImageCompared.model_fields.keys())
@@ -142,7 +259,7 @@ def parse_image_metadata(raw_obj: Dict[str | Any, str | Any]) -> ImageCompared:
             "request": parsed_request,
             "asset_path": parsed_asset_path,
             "hash": parsed_hash,
-            "copyright_comparisons": {},
+            "copyright_comparisons": "",
             "status": "not started",
             "message": "",
             "traceback": "",
@@ -151,7 +268,7 @@ def parse_image_metadata(raw_obj: Dict[str | Any, str | Any]) -> ImageCompared:
         return ImageCompared.model_validate(obj)
     
     except Exception as e:
-        parsed_id = f"{obj.get("id", "<unknown>")}"
+        parsed_id = f"{raw_obj.get("id", "<unknown>")}"
         return ImageCompared(
             id = parsed_id,
             request = "",
@@ -161,35 +278,67 @@ def parse_image_metadata(raw_obj: Dict[str | Any, str | Any]) -> ImageCompared:
             status = "error",
             message = f"Error parsing image metadata: {e}",
             traceback = str(traceback.format_exc()),
-            object_dump = str(obj),
+            object_dump = str(raw_obj),
         )
             
 
-def _read_image_metadata_from_csv(file: TextIOWrapper) -> Tuple[Generator[ImageCompared, None, None], int]:
+_IMAGES_COMPARED_ADAPTER = TypeAdapter(List[ImageCompared])
 
-    d = csv.DictReader(file)
 
-    headers = d.fieldnames
-    if headers is None:
-        raise ValueError("CSV file has no headers")
+def validate_image_metadata(raw_rows: List[TRawRow]) -> List[ImageCompared]:
+    """
+    Bulk counterpart of `parse_image_metadata`, for whole batches of CSV rows.
 
-    headers_list = [header for header in headers]
+    The batch is validated with a single pydantic call, which is much cheaper than one `model_validate` per row.
+    Only if that fails are the rows parsed one by one, so that each invalid one becomes its own 'error' row.
 
-    if headers_list != IMAGE_COMPARED_FIELDS:
-        raise ValueError(
-            f"CSV file headers do not match expected fields, expected, in order {IMAGE_COMPARED_FIELDS}, got {headers_list}"
-        )
+    :param raw_rows: Rows as read by `csv.DictReader`.
+    :return: One parsed row per input row, in order.
+    """
+    objs = [
+        {
+            "id": raw_obj.get("id", "<unknown>"),
+            "request": raw_obj.get("request", ""),
+            "asset_path": raw_obj.get("asset_path", ""),
+            "hash": raw_obj.get("hash", ""),
+            "copyright_comparisons": "",
+            "status": "not started",
+            "message": "",
+            "traceback": "",
+            "object_dump": "",
+        }
+        for raw_obj in raw_rows
+    ]
 
-    amount_of_rows = sum(1 for _ in d)
-    images = (
-            parse_image_metadata(row)
-            for row in d
-    )
+    if all(obj["asset_path"] for obj in objs):
+        try:
+            return _IMAGES_COMPARED_ADAPTER.validate_python(objs)
+        except ValidationError:
+            pass
+
+    return [parse_image_metadata(raw_obj) for raw_obj in raw_rows]
+
+
+def _iter_image_metadata(path: Path) -> Generator[ImageCompared, None, None]:
+    for _, batch in _iter_csv_batches(path):
+        yield from validate_image_metadata(batch)
+
+
+def _read_image_metadata_from_csv(path: Path) -> Tuple[Generator[ImageCompared, None, None], int]:
+    _check_csv_headers(path, IMAGE_COMPARED_FIELDS)
+    amount_of_rows = count_csv_rows(path)
+
+    return _iter_image_metadata(path), amount_of_rows
 
-    return images, amount_of_rows
-          
 
 def read_image_metadata(file_path: str) -> Tuple[Generator[ImageCompared, None, None], int]:
+    """
+    Stream the rows of an image manifest.
+
+    :param file_path: Path to the manifest.
+    :return: Lazy generator over the parsed rows, which keeps the file open while it is consumed, and the number of
+        rows.
+    """
     path = Path(file_path)
     if not path.exists():
         raise FileNotFoundError(f"File not found: {file_path}")
@@ -198,10 +347,7 @@ def read_image_metadata(file_path: str) -> Tuple[Generator[ImageCompared, None,
 
     match extension:
         case ".csv":
-            with path.open("r") as file:
-                return _read_image_metadata_from_csv(file)
+            return _read_image_metadata_from_csv(path)
 
         case _:
             raise ValueError(f"Unsupported file format: {extension}")
-
-
@@ -0,0 +1,355 @@
+import argparse
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import nullcontext
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import TracebackType
+from typing import Callable, ContextManager, Deque, Dict, List, Tuple, Type
+
+from aletk.utils import get_logger
+
+lgr = get_logger(__name__)
+
+# Stages of the copyright jobs:
+#   open       opening the file, and for hashing also decoding the image
+#   exif       reading the EXIF Copyright tag
+#   hash       computing the composite hash of a decoded image
+#   compare    looking up the closest known images
+#   csv_write  writing one output row
+STAGES = ("open", "exif", "hash", "compare", "csv_write")
+
+# Upper bounds, in seconds, of the stage duration histogram buckets
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Current throughput is averaged over this many seconds
+THROUGHPUT_WINDOW = 60.0
+
+DEFAULT_TEXTFILE_INTERVAL = 15.0
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Stage -> (count per bucket, the last one unbounded, and sum of the observed durations)
+type TObservations = Dict[str, Tuple[List[int], float]]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(**labels: str) -> str:
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class JobMetrics:
+    """
+    Stage duration histograms, item counters by status and current throughput of one job, rendered in the Prometheus
+    text exposition format. Thread-safe.
+    """
+
+    def __init__(self, job: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.job = job
+        self.buckets = buckets
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+        self._observations: TObservations = {}
+        self._counts: Dict[Tuple[str, str], int] = {}
+        self._items = 0
+        self._samples: Deque[Tuple[float, int]] = deque([(time.monotonic(), 0)])
+
+    def observe(self, stage: str, seconds: float) -> None:
+        bucket = bisect_left(self.buckets, seconds)
+        with self._lock:
+            counts, total = self._observations.get(stage) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bucket] += 1
+            self._observations[stage] = (counts, total + seconds)
+
+    def count(self, status: str, field: str = "status") -> None:
+        """
+        Count one item by the value of one of its status fields. Items counted with the default `field` are the
+        output rows of the job, and make up its throughput.
+        """
+        with self._lock:
+            self._counts[(field, status)] = self._counts.get((field, status), 0) + 1
+            if field == "status":
+                self._items += 1
+
+    def take_observations(self) -> TObservations:
+        """
+        Return the stage durations observed so far and forget them, to send them from a worker process to the parent.
+        """
+        with self._lock:
+            observations, self._observations = self._observations, {}
+        return observations
+
+    def merge(self, observations: TObservations) -> None:
+        with self._lock:
+            for stage, (counts, total) in observations.items():
+                own_counts, own_total = self._observations.get(stage) or ([0] * len(counts), 0.0)
+                self._observations[stage] = ([a + b for a, b in zip(own_counts, counts)], own_total + total)
+
+    def _throughput(self) -> float:
+        # Must be called with the lock held
+        now = time.monotonic()
+        self._samples.append((now, self._items))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= THROUGHPUT_WINDOW:
+            self._samples.popleft()
+
+        then, items = self._samples[0]
+        return (self._items - items) / (now - then) if now > then else 0.0
+
+    def render(self) -> str:
+        with self._lock:
+            observations = {stage: (list(counts), total) for stage, (counts, total) in self._observations.items()}
+            counts = dict(self._counts)
+            throughput = self._throughput()
+
+        job = self.job
+        lines = [
+            "# HELP copyright_stage_duration_seconds Duration of each stage of a copyright job, per item.",
+            "# TYPE copyright_stage_duration_seconds histogram",
+        ]
+        for stage, (stage_counts, total) in sorted(observations.items()):
+            cumulative = 0
+            for bound, n in zip((*(f"{b}" for b in self.buckets), "+Inf"), stage_counts):
+                cumulative += n
+                labels = _labels(copyright_job=job, stage=stage, le=bound)
+                lines.append(f"copyright_stage_duration_seconds_bucket{labels} {cumulative}")
+            stage_labels = _labels(copyright_job=job, stage=stage)
+            lines.append(f"copyright_stage_duration_seconds_sum{stage_labels} {total}")
+            lines.append(f"copyright_stage_duration_seconds_count{stage_labels} {cumulative}")
+
+        lines += [
+            "# HELP copyright_items_total Items processed by a copyright job, by status field and value.",
+            "# TYPE copyright_items_total counter",
+        ]
+        for (field, status), n in sorted(counts.items()):
+            lines.append(f"copyright_items_total{_labels(copyright_job=job, field=field, status=status)} {n}")
+
+        lines += [
+            f"# HELP copyright_items_per_second Output rows per second over the last {THROUGHPUT_WINDOW:g} seconds.",
+            "# TYPE copyright_items_per_second gauge",
+            f"copyright_items_per_second{_labels(copyright_job=job)} {throughput}",
+            "# HELP copyright_job_start_time_seconds Start of a copyright job, in seconds since the epoch.",
+            "# TYPE copyright_job_start_time_seconds gauge",
+            f"copyright_job_start_time_seconds{_labels(copyright_job=job)} {self.start_time}",
+        ]
+
+        return "\n".join(lines) + "\n"
+
+
+###
+# Instrumentation
+###
+
+# Metrics of the running job, None unless enabled, in which case all instrumentation is a no-op
+_active: JobMetrics | None = None
+
+
+class _StageTimer:
+    __slots__ = ("_metrics", "_stage", "_start")
+
+    def __init__(self, metrics: JobMetrics, stage: str) -> None:
+        self._metrics = metrics
+        self._stage = stage
+        self._start = 0.0
+
+    def __enter__(self) -> None:
+        self._start = time.perf_counter()
+
+    def __exit__(
+        self,
+        exc_type: Type[BaseException] | None,
+        exc_value: BaseException | None,
+        exc_traceback: TracebackType | None,
+    ) -> None:
+        self._metrics.observe(self._stage, time.perf_counter() - self._start)
+
+
+def stage_timer(stage: str) -> ContextManager[None]:
+    """
+    Time the enclosed block as one item of `stage`, if metrics are enabled.
+    """
+    if _active is None:
+        return nullcontext()
+    return _StageTimer(_active, stage)
+
+
+def count_status(status: str, field: str = "status") -> None:
+    if _active is not None:
+        _active.count(status, field)
+
+
+def metrics_enabled() -> bool:
+    return _active is not None
+
+
+def enable_worker_metrics() -> None:
+    """
+    Process pool initializer collecting stage durations in the workers, to be sent back through `observed`.
+    """
+    global _active
+    _active = JobMetrics(job="worker")
+
+
+def _observed_call[T, R](func: Callable[[T], R], arg: T) -> Tuple[R, TObservations]:
+    result = func(arg)
+    return result, _active.take_observations() if _active is not None else {}
+
+
+def observed[T, R](func: Callable[[T], R]) -> Callable[[T], Tuple[R, TObservations]]:
+    """
+    Wrap a function run in worker processes so that it also returns the stage durations it observed, to be passed
+    to `merge_observations` in the parent. Picklable if `func` is.
+    """
+    return partial(_observed_call, func)
+
+
+def merge_observations(observations: TObservations) -> None:
+    if _active is not None and observations:
+        _active.merge(observations)
+
+
+###
+# Exporters
+###
+
+
+def write_metrics_textfile(metrics: JobMetrics, textfile: str) -> None:
+    """
+    Write the metrics for the node exporter textfile collector. The file is replaced atomically, so that the
+    collector never reads a partial one.
+    """
+    path = Path(textfile)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(metrics.render())
+    tmp_path.replace(path)
+
+
+class MetricsExporter:
+    """
+    Expose the metrics of a job while it runs: rewritten to a textfile every `interval` seconds, and/or served on
+    `http://address:port/metrics`. The textfile is written a last time on `close()`, so that it holds the final
+    counts of the job.
+    """
+
+    def __init__(
+        self,
+        metrics: JobMetrics,
+        textfile: str = "",
+        port: int = 0,
+        address: str = "127.0.0.1",
+        interval: float = DEFAULT_TEXTFILE_INTERVAL,
+    ) -> None:
+        self.metrics = metrics
+        self.textfile = textfile
+        self.interval = interval
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._server: ThreadingHTTPServer | None = None
+
+        if textfile:
+            self._threads.append(threading.Thread(target=self._write_periodically, daemon=True))
+
+        if port:
+            self._server = ThreadingHTTPServer((address, port), self._handler())
+            self._threads.append(threading.Thread(target=self._server.serve_forever, daemon=True))
+            lgr.info(f"Serving metrics on http://{address}:{port}/metrics")
+
+        for thread in self._threads:
+            thread.start()
+
+    def _handler(self) -> Type[BaseHTTPRequestHandler]:
+        metrics = self.metrics
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+                self.send_header("Content-Length", f"{len(body)}")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: object) -> None:
+                pass
+
+        return MetricsHandler
+
+    def _write_periodically(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                write_metrics_textfile(self.metrics, self.textfile)
+            except OSError as e:
+                lgr.warning(f"Could not write metrics to '{self.textfile}': {e}")
+
+    def __enter__(self) -> "MetricsExporter":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Type[BaseException] | None,
+        exc_value: BaseException | None,
+        exc_traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+
+        if self.textfile:
+            write_metrics_textfile(self.metrics, self.textfile)
+
+
+def add_metrics_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--metrics_textfile",
+        type=str,
+        default="",
+        help="Path to a '.prom' file in the node exporter textfile collector directory, rewritten every "
+        f"{DEFAULT_TEXTFILE_INTERVAL:g} seconds with the metrics of the job.",
+    )
+
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=0,
+        help="Serve the metrics of the job on http://<address>:<port>/metrics while it runs. Disabled by default.",
+    )
+
+    parser.add_argument(
+        "--metrics_address",
+        type=str,
+        default="127.0.0.1",
+        help="Address the metrics endpoint listens on, e.g. '0.0.0.0' for Prometheus to scrape it from a container.",
+    )
+
+
+def open_metrics(
+    job: str, metrics_textfile: str, metrics_port: int, metrics_address: str = "127.0.0.1"
+) -> MetricsExporter | None:
+    """
+    Enable the instrumentation and export the metrics as requested by the `--metrics_textfile`, `--metrics_port` and
+    `--metrics_address` command line options. Without the first two, metrics stay disabled and this returns None.
+    """
+    global _active
+
+    if not metrics_textfile and not metrics_port:
+        return None
+
+    _active = JobMetrics(job)
+
+    return MetricsExporter(_active, textfile=metrics_textfile, port=metrics_port, address=metrics_address)
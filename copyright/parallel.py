@@ -0,0 +1,55 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, wait
+from itertools import islice
+from typing import Callable, Deque, Iterable, Iterator, Set
+
+
+def bounded_map[T, R](
+    executor: Executor,
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    max_pending: int,
+    ordered: bool = False,
+) -> Iterator[R]:
+    """
+    Map `fn` over `items` on `executor`, with at most `max_pending` tasks submitted at any time.
+
+    Unlike `Executor.map`, the input is consumed lazily and results are yielded as they come, so arbitrarily long
+    inputs are processed in bounded memory.
+
+    :param executor: Thread or process pool to run `fn` on.
+    :param fn: Function to apply. Must be picklable for process pools.
+    :param items: Input items, consumed lazily.
+    :param max_pending: Maximum number of submitted but not yet yielded tasks.
+    :param ordered: Yield results in input order instead of completion order. A slow task then holds back the
+        results behind it, but never more than `max_pending` of them.
+    :return: Iterator over the results.
+    """
+    if max_pending < 1:
+        raise ValueError(f"max_pending must be at least 1, got {max_pending}")
+
+    iterator = iter(items)
+
+    if ordered:
+        queue: Deque[Future[R]] = deque(executor.submit(fn, item) for item in islice(iterator, max_pending))
+        try:
+            while queue:
+                future = queue.popleft()
+                queue.extend(executor.submit(fn, item) for item in islice(iterator, 1))
+                yield future.result()
+        finally:
+            for future in queue:
+                future.cancel()
+
+        return
+
+    pending: Set[Future[R]] = {executor.submit(fn, item) for item in islice(iterator, max_pending)}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            pending.update(executor.submit(fn, item) for item in islice(iterator, len(done)))
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
@@ -1,12 +1,52 @@
+import sqlite3
 import time
-from typing import Tuple
+from collections import deque
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterable, Iterator, List, NamedTuple, Tuple
+from urllib.parse import urlsplit, urlunsplit
 import aiohttp
 import asyncio
 import csv
 
 TIMEOUT = 1000  # Adjust for performance
-CONCURRENCY = 100  # Adjust for performance
+CONCURRENCY = 100  # Adjust for performance, total requests in flight
+PER_HOST_CONCURRENCY = 8  # Workers, hence requests in flight, per host
+MAX_HOST_BACKLOG = 1000  # URLs waiting for a busy host, beyond which workers wait for room
 MAX_REDIRECTS = 20  # Prevent infinite loops
+PROGRESS_INTERVAL = 1000  # Print progress every this many links
+
+# Adaptive rate limit per host: requests start at the rate given by --throttle. Until the host first pushes back
+# with 429 or 503, the rate is multiplied by RATE_GROWTH per success, and afterwards increased by RATE_INCREASE per
+# success, up to MAX_HOST_RATE. Each push back multiplies it by RATE_DECREASE, down to MIN_HOST_RATE, and is retried
+# up to MAX_RETRIES times, after its Retry-After if any.
+MAX_HOST_RATE = 200.0  # Requests per second
+MIN_HOST_RATE = 0.2
+RATE_GROWTH = 1.05
+RATE_INCREASE = 0.2
+RATE_DECREASE = 0.5
+MAX_RETRY_AFTER = 300.0  # Seconds, longer Retry-After are capped
+MAX_RETRIES = 3
+THROTTLED_STATUSES = (429, 503)
+
+# Links are probed with HEAD, and confirmed with a GET of their first byte only if HEAD fails, as some servers answer
+# HEAD wrongly. Hosts answering HEAD with one of HEAD_UNSUPPORTED_STATUSES for HEAD_UNSUPPORTED_AFTER URLs in a row
+# are only probed with GET afterwards. Bodies up to MAX_DRAINED_BODY are read, so that the connection is reused.
+HEAD_UNSUPPORTED_STATUSES = (405, 501)
+HEAD_UNSUPPORTED_AFTER = 5
+RANGE_HEADERS = {"Range": "bytes=0-0"}
+MAX_DRAINED_BODY = 64 * 1024  # Bytes
+
+# Results are cached on disk, each for the TTL of its outcome, in hours. Expired OK results with an ETag or a
+# Last-Modified are revalidated with a conditional request, the others are checked again. Links still throttled
+# after MAX_RETRIES are not cached, as their host said nothing about them.
+DEFAULT_CACHE_FILE = str(Path.home() / ".cache" / "philosophie-links" / "link_cache.sqlite3")
+TTL_OK = 14 * 24.0
+TTL_BROKEN = 24.0  # NonSuccessCode
+TTL_ERROR = 1.0  # Errors without an HTTP answer, e.g. timeouts
+CACHE_COMMIT_INTERVAL = 1000
+
+DEFAULT_PORTS = {"http": 80, "https": 443}  # Dropped from canonical URLs
 
 type TRawUrl = str
 type TScheme = str
@@ -17,100 +57,540 @@ type TError = str
 
 type UrlReport = Tuple[TRawUrl, TScheme, TUrl, TStatus, TErrorType, TError]
 
-CSV_HEADER = ["url", "scheme", "url_stripped", "status", "error_type", "error"]
 
+class Probe(NamedTuple):
+    """Answer to a request for a URL: its status line, and the headers the checks rely on"""
+
+    status: int
+    reason: str
+    retry_after: float | None
+    final_url: str
+    etag: str
+    last_modified: str
+
+
+class CachedLink(NamedTuple):
+    status: TStatus
+    error_type: TErrorType
+    error: TError
+    final_url: str
+    etag: str
+    last_modified: str
+    checked: float  # Seconds since the epoch
+
+    def report(self, raw_url: str) -> UrlReport:
+        return raw_url, "", "", self.status, self.error_type, self.error
+
+    def validators(self) -> Dict[str, str]:
+        """Headers of a conditional request revalidating an OK result, empty if it cannot be revalidated"""
+        if self.status != "OK":
+            return {}
+
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class LinkCache:
+    """SQLite cache of link check results, keyed by the requested URL"""
+
+    def __init__(
+        self, db_path: str, ttl_ok: float = TTL_OK, ttl_broken: float = TTL_BROKEN, ttl_error: float = TTL_ERROR
+    ):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+
+        # TTLs in seconds
+        self.ttl_ok = ttl_ok * 3600
+        self.ttl_broken = ttl_broken * 3600
+        self.ttl_error = ttl_error * 3600
+
+        self._connection = sqlite3.connect(db_path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS link_cache ("
+            "url TEXT PRIMARY KEY, status TEXT NOT NULL, error_type TEXT NOT NULL, error TEXT NOT NULL, "
+            "final_url TEXT NOT NULL, etag TEXT NOT NULL, last_modified TEXT NOT NULL, checked REAL NOT NULL)"
+        )
+        self._pending_writes = 0
+
+    def get(self, url: str) -> CachedLink | None:
+        row = self._connection.execute(
+            "SELECT status, error_type, error, final_url, etag, last_modified, checked FROM link_cache WHERE url = ?",
+            (url,),
+        ).fetchone()
+        return CachedLink(*row) if row is not None else None
+
+    def is_fresh(self, entry: CachedLink) -> bool:
+        match entry.status:
+            case "OK":
+                ttl = self.ttl_ok
+            case "NonSuccessCode":
+                ttl = self.ttl_broken
+            case _:
+                ttl = self.ttl_error
+
+        return time.time() - entry.checked < ttl
+
+    def put(self, url: str, report: UrlReport, probe: Probe | None, previous: CachedLink | None) -> None:
+        if probe is not None and probe.status in THROTTLED_STATUSES:
+            return
+
+        final_url = etag = last_modified = ""
+        if probe is not None:
+            final_url, etag, last_modified = probe.final_url, probe.etag, probe.last_modified
+            if probe.status == 304 and previous is not None:
+                # Not Modified: the validators may be left out of the answer
+                etag = etag or previous.etag
+                last_modified = last_modified or previous.last_modified
+
+        _, _, _, status, error_type, error = report
+        self._connection.execute(
+            "INSERT OR REPLACE INTO link_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (url, status, error_type, error, final_url, etag, last_modified, time.time()),
+        )
+        self._pending_writes += 1
+        if self._pending_writes >= CACHE_COMMIT_INTERVAL:
+            self._connection.commit()
+            self._pending_writes = 0
+
+    def close(self) -> None:
+        self._connection.commit()
+        self._connection.close()
 
-async def check_url(session, raw_url: str, check_philch: bool) -> UrlReport:
-    """Check if a URL is broken, ignoring redirects"""
-    try:
 
-        url = raw_url
-
-        if (
-            raw_url.startswith("data:")
-            or raw_url.startswith("mailto:")
-            or raw_url.startswith("tel:")
-            or raw_url.startswith("javascript:")
-            or raw_url.startswith("ftp:")
-            or raw_url.startswith("file:")
-        ):
-            scheme_url = raw_url.split(":")
-            return raw_url, scheme_url[0], scheme_url[1], "Skipped", "Scheme", ""
-
-        elif raw_url.startswith("data_link"):
-            return raw_url, "data", "", "Skipped", "DataLink", ""
-
-        elif raw_url.startswith("/"):
-            url = f"https://www.philosophie.ch{raw_url}"
-            if url.startswith("https://www.philosophie.ch/profil/"):
-                return raw_url, "", url, "Skipped", "PhilosophieCH-Profile", "To check against existing profiles"
-            elif not url.startswith("https://www.philosophie.ch/profil/") and not check_philch:
-                return (
-                    raw_url,
-                    "",
-                    url,
-                    "Skipped",
-                    "PhilosophieCH",
-                    "To check independently, else we get 'too many requests'",
-                )
-
-        elif "philosophie.ch" in raw_url and not check_philch:
+CSV_HEADER = ["url", "scheme", "url_stripped", "status", "error_type", "error"]
+
+
+def resolve_url(raw_url: str, check_philch: bool) -> TUrl | UrlReport:
+    """Return the URL to request, or the report of a URL that is not to be checked"""
+    url = raw_url
+
+    if (
+        raw_url.startswith("data:")
+        or raw_url.startswith("mailto:")
+        or raw_url.startswith("tel:")
+        or raw_url.startswith("javascript:")
+        or raw_url.startswith("ftp:")
+        or raw_url.startswith("file:")
+    ):
+        scheme_url = raw_url.split(":")
+        return raw_url, scheme_url[0], scheme_url[1], "Skipped", "Scheme", ""
+
+    elif raw_url.startswith("data_link"):
+        return raw_url, "data", "", "Skipped", "DataLink", ""
+
+    elif raw_url.startswith("/"):
+        url = f"https://www.philosophie.ch{raw_url}"
+        if url.startswith("https://www.philosophie.ch/profil/"):
+            return raw_url, "", url, "Skipped", "PhilosophieCH-Profile", "To check against existing profiles"
+        elif not url.startswith("https://www.philosophie.ch/profil/") and not check_philch:
             return (
                 raw_url,
                 "",
-                "",
+                url,
                 "Skipped",
                 "PhilosophieCH",
-                "To check independently, else we get 'too many requests'",
+                "Run with --philch to check them too",
             )
 
-        elif raw_url.startswith("#"):
-            return raw_url, "", "", "Skipped", "Anchor", ""
+    elif "philosophie.ch" in raw_url and not check_philch:
+        return (
+            raw_url,
+            "",
+            "",
+            "Skipped",
+            "PhilosophieCH",
+            "To check independently, else we get 'too many requests'",
+        )
 
-        if not url.startswith("http"):
-            return raw_url, "Unknown", "", "Skipped", "UnknownScheme", ""
+    elif raw_url.startswith("#"):
+        return raw_url, "", "", "Skipped", "Anchor", ""
 
-        async with session.get(url, timeout=TIMEOUT, max_redirects=MAX_REDIRECTS, allow_redirects=True) as response:
+    if not url.split(":", 1)[0].lower().startswith("http"):
+        return raw_url, "Unknown", "", "Skipped", "UnknownScheme", ""
 
-            if 400 <= response.status < 600:
-                return (
-                    raw_url,
-                    "",
-                    "",
-                    "NonSuccessCode",
-                    f"{response.status}",
-                    f"Code {response.status}: {response.reason}",
-                )
-            return raw_url, "", "", "OK", "", ""
+    return url
 
-    except aiohttp.TooManyRedirects:
-        print(f"🟠 Too many redirects: {raw_url}")
-        return raw_url, "", "", "Error", "TooManyRedirects", f"Error: Too many redirects (max: {MAX_REDIRECTS})"
 
-    except Exception as e:
-        print(f"❌ Error for [[ {raw_url} ]] ::: {e.__class__.__name__}: {str(e)}")
-        return raw_url, "", "", "Unhandled Error", f"{e.__class__.__name__}", f"Error: {e.__class__.__name__}: {str(e)}"
+def canonical_url(url: TUrl, fold_trailing_slash: bool = False) -> TUrl:
+    """
+    Return the form of a URL under which it is checked, once for all its variants: lowercase scheme and host, no
+    default port, no fragment, which never reaches the server, and an explicit root path. With `fold_trailing_slash`,
+    a trailing slash is dropped too, e.g. 'https://x.org/a/' is checked as 'https://x.org/a'.
+    """
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        # Invalid port, left to fail when requested
+        return url
+
+    scheme = parts.scheme.lower()
+    host = parts.hostname or ""
+    if ":" in host:
+        host = f"[{host}]"  # IPv6
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{port}"
+    userinfo = parts.netloc.rpartition("@")[0]
+    netloc = f"{userinfo}@{host}" if userinfo else host
+
+    path = parts.path or "/"
+    if fold_trailing_slash:
+        path = path.rstrip("/") or "/"
+
+    return urlunsplit((scheme, netloc, path, parts.query, ""))
+
+
+def group_urls(
+    raw_urls: Iterable[str], check_philch: bool, fold_trailing_slash: bool = False
+) -> Tuple[List[UrlReport], Dict[str, Dict[TUrl, List[TRawUrl]]]]:
+    """
+    Resolve and canonicalize the URLs. Return the reports of those not to be checked, and the others grouped by host,
+    then by canonical URL, with the raw URLs each canonical URL stands for.
+    """
+    skipped = []
+    by_host: Dict[str, Dict[TUrl, List[TRawUrl]]] = {}
+
+    for raw_url in raw_urls:
+        resolved = resolve_url(raw_url, check_philch)
+        if not isinstance(resolved, str):
+            skipped.append(resolved)
+            continue
+
+        url = canonical_url(resolved, fold_trailing_slash)
+        host = urlsplit(url).hostname or ""
+        by_host.setdefault(host, {}).setdefault(url, []).append(raw_url)
+
+    return skipped, by_host
+
+
+def interleave_hosts(by_host: Dict[str, Dict[TUrl, List[TRawUrl]]]) -> Iterator[Tuple[TUrl, List[TRawUrl]]]:
+    """Yield the canonical URLs of each host in turn, so that the workers are spread over the hosts"""
+    hosts: Deque[Iterator[Tuple[TUrl, List[TRawUrl]]]] = deque(iter(urls.items()) for urls in by_host.values())
+    while hosts:
+        urls = hosts.popleft()
+        item = next(urls, None)
+        if item is not None:
+            yield item
+            hosts.append(urls)
+
+
+def retry_after_seconds(value: str | None) -> float | None:
+    """Parse a Retry-After header, given either in seconds or as an HTTP date"""
+    if not value:
+        return None
 
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+class HostState:
+    """
+    Rate limit of one host: a token bucket of one token, refilled at `rate` requests per second, and the URLs waiting
+    for a worker of the host. The rate adapts to the answers of the host, see `succeeded` and `throttled`.
+    """
+
+    def __init__(self, rate: float, max_rate: float):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.next_start = 0.0  # Event loop time before which no request may start
+        self.epoch = 0  # Number of rate decreases, so that requests sent at the same rate decrease it only once
+        self.head_rejections = 0  # HEAD answered with one of HEAD_UNSUPPORTED_STATUSES, in a row
+        self.workers = 0
+        self.backlog: Deque[Tuple[TUrl, List[TRawUrl], CachedLink | None]] = deque()
+        self.room = asyncio.Condition()  # Notified whenever a URL leaves the backlog
+        self.waiting = 0  # Workers waiting for room in the backlog
+
+    async def turn(self) -> int:
+        """Wait for the next request to the host to be allowed, and return the epoch it starts in"""
+        loop = asyncio.get_running_loop()
+        while True:
+            # Each request reserves the next start time, so waiting requests are spaced by 1 / rate
+            epoch = self.epoch
+            start = max(loop.time(), self.next_start)
+            self.next_start = start + 1 / self.rate
+            await asyncio.sleep(start - loop.time())
+
+            # Reservations made before the host pushed back are made again, at the new rate and after the pause
+            if epoch == self.epoch:
+                return epoch
+
+    def succeeded(self) -> None:
+        rate = self.rate + RATE_INCREASE if self.epoch else self.rate * RATE_GROWTH
+        self.rate = min(self.max_rate, rate)
+
+    def throttled(self, epoch: int, retry_after: float | None) -> None:
+        """A request started in `epoch` was answered 429 or 503: slow down, and pause for `retry_after` if given"""
+        if epoch == self.epoch:
+            self.epoch += 1
+            self.rate = max(MIN_HOST_RATE, self.rate * RATE_DECREASE)
+
+        pause = retry_after if retry_after is not None else 1 / self.rate
+        self.next_start = max(self.next_start, asyncio.get_running_loop().time() + pause)
+
+
+class HostScheduler:
+    """
+    Per-host rate limits, letting different hosts run in parallel, each at the highest rate it tolerates. Hosts with
+    nothing learnt, neither push backs nor HEAD support, are forgotten once idle, so memory stays flat over many hosts.
+    """
+
+    def __init__(self, rate: float, max_rate: float):
+        self.rate = rate
+        self.max_rate = max_rate
+        self._hosts: Dict[str, HostState] = {}
+
+    def host(self, host: str) -> HostState:
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = HostState(self.rate, self.max_rate)
+        return state
+
+    def release(self, host: str) -> None:
+        state = self._hosts[host]
+        if not state.workers and not state.waiting and not state.epoch and not state.head_rejections:
+            del self._hosts[host]
+
+
+async def request_status(
+    session: aiohttp.ClientSession, method: str, url: str, headers: Dict[str, str] | None = None
+) -> Probe:
+    """Make a request, following redirects, and return its answer without its body"""
+    async with session.request(
+        method, url, headers=headers, max_redirects=MAX_REDIRECTS, allow_redirects=True
+    ) as response:
+        # Small bodies, such as the first byte or an error page, are read so that the connection goes back to the pool.
+        # Larger or unknown ones are left unread, which closes the connection instead of downloading them
+        if response.content_length is not None and response.content_length <= MAX_DRAINED_BODY:
+            try:
+                await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+        return Probe(
+            status=response.status,
+            reason=response.reason or "",
+            retry_after=retry_after_seconds(response.headers.get("Retry-After")),
+            final_url=str(response.url),
+            etag=response.headers.get("ETag", ""),
+            last_modified=response.headers.get("Last-Modified", ""),
+        )
+
+
+async def probe_url(
+    session: aiohttp.ClientSession, url: str, host: HostState, validators: Dict[str, str]
+) -> Tuple[int, Probe]:
+    """
+    Request a URL without downloading its body: HEAD first, then a GET of its first byte if HEAD fails, or straight
+    away if the host keeps rejecting HEAD. Both requests are conditional on `validators`, if any. Return the rate
+    limit epoch of the last request, and its answer.
+    """
+    if host.head_rejections < HEAD_UNSUPPORTED_AFTER:
+        epoch = await host.turn()
+        probe = await request_status(session, "HEAD", url, validators)
+        if probe.status in HEAD_UNSUPPORTED_STATUSES:
+            host.head_rejections += 1
+        elif probe.status not in THROTTLED_STATUSES:
+            host.head_rejections = 0
+        if probe.status < 400 or probe.status in THROTTLED_STATUSES:
+            return epoch, probe
+
+    epoch = await host.turn()
+    probe = await request_status(session, "GET", url, {**RANGE_HEADERS, **validators})
+    if probe.status == 416:
+        # Range Not Satisfiable: the resource exists, but is empty
+        return epoch, probe._replace(status=200, reason="OK")
+
+    return epoch, probe
+
+
+async def check_url(
+    session: aiohttp.ClientSession, raw_url: str, url: str, host: HostState, validators: Dict[str, str] | None = None
+) -> Tuple[UrlReport, Probe | None]:
+    """
+    Check if a URL is broken, following redirects, within the rate limit of its host. Return the report, and the
+    answer it is based on, None if there was none. A URL revalidated with `validators` and not modified is OK.
+    """
+    try:
 
-async def check_all_urls(urls, check_philch, throttle):
-    """Check all URLs asynchronously"""
-    broken_urls = []
-    connector = aiohttp.TCPConnector(limit_per_host=CONCURRENCY)
+        for attempt in range(MAX_RETRIES + 1):
+            epoch, probe = await probe_url(session, url, host, validators or {})
 
-    if not check_philch:
-        async with aiohttp.ClientSession(connector=connector) as session:
-            tasks = [check_url(session, url, check_philch) for url in urls]
-            results = await asyncio.gather(*tasks)
-            broken_urls = tuple(r for r in results if r is not None)
-    else:
-        # throttle requests to avoid "too many requests" error
-        async with aiohttp.ClientSession(connector=connector) as session:
-            for url in urls:
-                report = await check_url(session, url, check_philch)
-                broken_urls.append(report)
-                await asyncio.sleep(throttle)
+            if probe.status in THROTTLED_STATUSES:
+                host.throttled(epoch, probe.retry_after)
+                if attempt < MAX_RETRIES:
+                    hostname = urlsplit(url).hostname
+                    print(f"🐢 {probe.status} for [[ {raw_url} ]], {hostname} slowed to {host.rate:.2f} req/s")
+                    continue
+            else:
+                host.succeeded()
+            break
 
-    return broken_urls
+        if 400 <= probe.status < 600:
+            return (
+                raw_url,
+                "",
+                "",
+                "NonSuccessCode",
+                f"{probe.status}",
+                f"Code {probe.status}: {probe.reason}",
+            ), probe
+        return (raw_url, "", "", "OK", "", ""), probe
+
+    except aiohttp.TooManyRedirects:
+        print(f"🟠 Too many redirects: {raw_url}")
+        return (
+            raw_url,
+            "",
+            "",
+            "Error",
+            "TooManyRedirects",
+            f"Error: Too many redirects (max: {MAX_REDIRECTS})",
+        ), None
+
+    except Exception as e:
+        print(f"❌ Error for [[ {raw_url} ]] ::: {e.__class__.__name__}: {str(e)}")
+        return (
+            raw_url,
+            "",
+            "",
+            "Unhandled Error",
+            f"{e.__class__.__name__}",
+            f"Error: {e.__class__.__name__}: {str(e)}",
+        ), None
+
+
+async def check_all_urls(
+    urls: Iterable[str],
+    check_philch: bool,
+    throttle: float,
+    writer: Any,
+    concurrency: int = CONCURRENCY,
+    per_host: int = PER_HOST_CONCURRENCY,
+    cache: LinkCache | None = None,
+    fold_trailing_slash: bool = False,
+) -> int:
+    """
+    Check all URLs on a pool of `concurrency` workers, and write each report to `writer` as soon as it is done. The
+    URLs are grouped in memory first, see `group_urls`; the queue between them and the workers is bounded, and so are
+    the backlogs of the hosts, so the requests in flight do not grow with the number of URLs. Return the number of
+    URLs checked.
+
+    Variants of the same URL, see `canonical_url`, are checked once, and the result is reported for each of them. The
+    hosts are taken in turn, see `interleave_hosts`.
+
+    Each host gets at most `per_host` workers, started at most every `throttle` seconds at first, then at the rate it
+    tolerates, see `HostState`; its other URLs wait in its backlog, so that a slow host does not hold up the workers
+    of the others. Once a backlog holds `MAX_HOST_BACKLOG` URLs, the workers with more URLs for its host wait for
+    room, and in turn the queue fills up and the URLs wait to be read. philosophie.ch URLs, checked with
+    `check_philch`, run alongside the others.
+
+    With a `cache`, URLs with a fresh result are not requested at all, and expired OK results are revalidated with a
+    conditional request when possible. Every result from the network is cached, except for links still throttled.
+    """
+    queue: asyncio.Queue[Tuple[TUrl, List[TRawUrl]] | None] = asyncio.Queue(maxsize=2 * concurrency)
+    scheduler = HostScheduler(1 / throttle if throttle > 0 else MAX_HOST_RATE, MAX_HOST_RATE)
+    from_cache = 0
+    revalidated = 0
+
+    skipped, by_host = group_urls(urls, check_philch, fold_trailing_slash)
+    to_check = sum(len(host_urls) for host_urls in by_host.values())
+    variants = sum(len(raw_urls) for host_urls in by_host.values() for raw_urls in host_urls.values())
+    print(f"🧹 {variants} links to check, {to_check} once canonicalized, over {len(by_host)} hosts")
+
+    for report in skipped:
+        writer.writerow(report)
+    done = len(skipped)
+
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host)
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+        def write(report: UrlReport, raw_urls: List[TRawUrl]) -> None:
+            # The same result for every variant of the URL
+            nonlocal done
+            for raw_url in raw_urls:
+                writer.writerow((raw_url, *report[1:]))
+                done += 1
+                if done % PROGRESS_INTERVAL == 0:
+                    print(f"🔗 {done} links checked")
+
+        async def check_and_cache(
+            url: TUrl, raw_urls: List[TRawUrl], host: HostState, cached: CachedLink | None
+        ) -> None:
+            nonlocal revalidated
+            report, probe = await check_url(session, raw_urls[0], url, host, cached.validators() if cached else None)
+            if probe is not None and probe.status == 304:
+                revalidated += 1
+            if cache is not None:
+                cache.put(url, report, probe, cached)
+            write(report, raw_urls)
+
+        async def check_on_host(url: TUrl, raw_urls: List[TRawUrl], cached: CachedLink | None) -> None:
+            name = urlsplit(url).hostname or ""
+            host = scheduler.host(name)
+            while host.workers >= per_host:
+                if len(host.backlog) < MAX_HOST_BACKLOG:
+                    host.backlog.append((url, raw_urls, cached))
+                    return
+
+                # Back pressure: the host is checked again once its workers took URLs from its backlog
+                host.waiting += 1
+                try:
+                    async with host.room:
+                        await host.room.wait()
+                finally:
+                    host.waiting -= 1
+
+            host.workers += 1
+            try:
+                await check_and_cache(url, raw_urls, host, cached)
+                while host.backlog:
+                    url, raw_urls, cached = host.backlog.popleft()
+                    async with host.room:
+                        host.room.notify()
+                    await check_and_cache(url, raw_urls, host, cached)
+            finally:
+                host.workers -= 1
+                scheduler.release(name)
+
+        async def worker() -> None:
+            nonlocal from_cache
+            while (item := await queue.get()) is not None:
+                url, raw_urls = item
+                cached = cache.get(url) if cache is not None else None
+                if cached is not None and cache is not None and cache.is_fresh(cached):
+                    from_cache += 1
+                    write(cached.report(raw_urls[0]), raw_urls)
+                    continue
+
+                await check_on_host(url, raw_urls, cached)
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        try:
+            for item in interleave_hosts(by_host):
+                await queue.put(item)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+
+    if cache is not None:
+        print(f"🗄️  {from_cache} links served from the cache, {revalidated} revalidated unchanged")
+
+    return done
 
 
 def read_urls_from_file(file_path):
@@ -119,25 +599,41 @@ def read_urls_from_file(file_path):
         return {line.strip() for line in file if line.strip()}  # Keep unique URLs
 
 
-def save_broken_urls(broken_urls, output_file):
-    """Save broken URLs to a CSV file"""
-    with open(output_file, "w", newline="", encoding="utf-8", errors="ignore") as file:
-        writer = csv.writer(file)
-        writer.writerow(CSV_HEADER)
-        writer.writerows(broken_urls)
-
-
-def main(file: str, output: str, check_philch: bool, throttle: float):
+def main(
+    file: str,
+    output: str,
+    check_philch: bool,
+    throttle: float,
+    concurrency: int,
+    per_host: int,
+    cache_file: str = DEFAULT_CACHE_FILE,
+    no_cache: bool = False,
+    ttl_ok: float = TTL_OK,
+    ttl_broken: float = TTL_BROKEN,
+    ttl_error: float = TTL_ERROR,
+    fold_trailing_slash: bool = False,
+):
     start_time = time.time()
     print(f"{start_time=}")
 
     urls = read_urls_from_file(file)
     print(f"Checking {len(urls)} URLs...")
 
-    broken_urls = asyncio.run(check_all_urls(urls, check_philch, throttle))
-    print(f"\n✅ Done! Processed {len(broken_urls)} links.")
+    cache = None if no_cache else LinkCache(cache_file, ttl_ok, ttl_broken, ttl_error)
+
+    # Reports are streamed to the CSV as they come, in completion order
+    try:
+        with open(output, "w", newline="", encoding="utf-8", errors="ignore") as out:
+            writer = csv.writer(out)
+            writer.writerow(CSV_HEADER)
+            processed = asyncio.run(
+                check_all_urls(urls, check_philch, throttle, writer, concurrency, per_host, cache, fold_trailing_slash)
+            )
+    finally:
+        if cache is not None:
+            cache.close()
 
-    save_broken_urls(broken_urls, output)
+    print(f"\n✅ Done! Processed {processed} links.")
     print(f"💾 Saved links to {output}")
 
     end_time = time.time()
@@ -171,20 +667,92 @@ def cli():
         "--philch",
         required=False,
         default=False,
-        help="Check only philosophie.ch URLs",
+        help="Also check philosophie.ch URLs, alongside the others, within the rate limit of their host",
     )
 
     parser.add_argument(
         "-t",
         "--throttle",
+        type=float,
         required=False,
         default=0.1,
-        help="Throttle requests to avoid 'too many requests' error, when checking philosophie.ch URLs",
+        help="Initial delay between requests to the same host, in seconds. The rate then adapts to each host: it "
+        "grows while the host answers, and drops on 429 or 503, honouring Retry-After",
+    )
+
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=CONCURRENCY,
+        help="Maximum number of requests in flight",
+    )
+
+    parser.add_argument(
+        "--per_host",
+        type=int,
+        default=PER_HOST_CONCURRENCY,
+        help="Maximum number of requests in flight to the same host",
+    )
+
+    parser.add_argument(
+        "--fold_trailing_slash",
+        action="store_true",
+        help="Check URLs differing only by a trailing slash once, e.g. 'https://x.org/a/' as 'https://x.org/a'. Off by "
+        "default, as some servers answer them differently",
+    )
+
+    parser.add_argument(
+        "--cache_file",
+        type=str,
+        default=DEFAULT_CACHE_FILE,
+        help=f"Path to the cache of link check results. Defaults to '{DEFAULT_CACHE_FILE}'",
+    )
+
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Neither read nor write the cache: check every link again",
+    )
+
+    parser.add_argument(
+        "--ttl_ok",
+        type=float,
+        default=TTL_OK,
+        help="Hours during which an OK link is not checked again. Afterwards, it is revalidated with If-None-Match or "
+        "If-Modified-Since when the server gave an ETag or a Last-Modified",
+    )
+
+    parser.add_argument(
+        "--ttl_broken",
+        type=float,
+        default=TTL_BROKEN,
+        help="Hours during which a link answered with an error code, other than 429 or 503, is not checked again",
+    )
+
+    parser.add_argument(
+        "--ttl_error",
+        type=float,
+        default=TTL_ERROR,
+        help="Hours during which a link that could not be reached, e.g. timed out, is not checked again",
     )
 
     args = parser.parse_args()
 
-    return main(file=args.file, output=args.output, check_philch=args.philch, throttle=args.throttle)
+    return main(
+        file=args.file,
+        output=args.output,
+        check_philch=args.philch,
+        throttle=args.throttle,
+        concurrency=args.concurrency,
+        per_host=args.per_host,
+        cache_file=args.cache_file,
+        no_cache=args.no_cache,
+        ttl_ok=args.ttl_ok,
+        ttl_broken=args.ttl_broken,
+        ttl_error=args.ttl_error,
+        fold_trailing_slash=args.fold_trailing_slash,
+    )
 
 
 if __name__ == "__main__":